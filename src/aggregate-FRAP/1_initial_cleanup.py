@@ -6,6 +6,8 @@ import skimage.io
 
 
 from loguru import logger
+from utilities.chunked import concatenate_stack, file_shape, read_array
+from utilities.manifest import build_manifest, save_manifest, dataset_folder_name
 logger.info('Import ok')
 
 def jarvis(input_path, output_path):
@@ -29,7 +31,7 @@ def jarvis(input_path, output_path):
         for replicate in replicates:
             replicate
             file_list = [filename for filename in os.listdir(f'{input_path}{folder}/{replicate}/') if '.tif' in filename]
-            images = {}
+            series = {}
             for filename in file_list:
                 pathname = os.path.join(input_path, folder, replicate, filename)
                 details = re.split(' ', filename)
@@ -37,18 +39,24 @@ def jarvis(input_path, output_path):
                 if len(details) == 2:
                     new_name = f'{folder}_{replicate}_s1'+'.tif'
                     copyfile(pathname, output_path+'tifs/'+new_name)
-                    images[1] = skimage.io.imread(f'{pathname}').transpose(1, 2, 0)
+                    series[1] = pathname
                     logger.info(f'{new_name}')
                 elif len(details) == 3:
                     new_name = f'{folder}_{replicate}_s'+details[1].split('Pb')[1]+'.tif'
                     copyfile(pathname, output_path+'tifs/'+new_name)
-                    images[int(details[1].split('Pb')[1])] = skimage.io.imread(f'{pathname}').transpose(1, 2, 0)
+                    series[int(details[1].split('Pb')[1])] = pathname
                     logger.info(f'{new_name}')
-            # combine images into a single stack
-            array_stack = np.dstack(tuple(images[key] for key in sorted(images.keys())))
-            np.save(f'{output_path}{folder}_{replicate.strip("r")}.npy', array_stack)
+            # combine images into a single stack, written to disk one series at a time so the full stack is never held in memory
+            # series are (T, H, W) TIFs, sized from their headers before each is decoded once and written as (H, W, T)
+            concatenate_stack([series[key] for key in sorted(series.keys())], f'{output_path}{folder}_{replicate.strip("r")}.npy', load=lambda pathname: read_array(pathname).transpose(1, 2, 0), shape=lambda pathname: tuple(np.take(file_shape(pathname), (1, 2, 0))))
                 
 
-jarvis(input_path='data/example_aggregate-FRAP/',
+input_path = 'data/example_aggregate-FRAP/'
+jarvis(input_path=input_path,
        output_path='results/aggregate-FRAP/initial_cleanup/')
 
+# index combined stacks once, with metadata parsed from filenames, for all later stages
+save_manifest(
+    build_manifest('results/aggregate-FRAP/initial_cleanup/', metadata_cols=['mutant', 'replicate'], extension='.npy', dataset=dataset_folder_name(input_path)),
+    'results/aggregate-FRAP/manifest.csv')
+
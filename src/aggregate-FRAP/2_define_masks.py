@@ -1,5 +1,4 @@
 
-import napari
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -14,8 +13,22 @@ from skimage.morphology import closing, square, remove_small_objects
 
 from loguru import logger
 
+from utilities.manifest import load_manifest
+from utilities.chunked import open_stack
+from utilities.label_store import save_mask
+from utilities.review import ReviewSession
+from utilities.pyramid import build_pyramid, pyramid_layer, pyramid_frame
+from utilities.roi import detect_bleach_rois, place_rois, placed_shapes, rasterise_shapes, roi_mask_stacks
+
 input_folder = f'results/aggregate-FRAP/initial_cleanup/'
 output_folder = f'results/aggregate-FRAP/napari_masking/'
+manifest_path = f'results/aggregate-FRAP/manifest.csv'
+pyramid_folder = f'results/aggregate-FRAP/pyramids/'
+
+# review frames from cached multiscale pyramids, so only the visible region and resolution is read
+use_pyramids = False
+# generate masks from automatically placed ROIs without review, e.g. on batch nodes with no display
+headless = False
 
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
@@ -40,33 +53,19 @@ def mask_per_stack(image_stack, image_name, num_pre=5, num_bleach=30):
         coords: df mapping x, y pixels inside the thresholded bleach ROI
         timepoints: dict mapping each timepoint to ROI mask array containing background, non-bleached and bleached masks
     """
-    # Threshold fist bleach image to create bleach mask
-    bleach_image = image_stack[:, :, num_pre+1]
-    # plt.imshow(bleach_image)
-    # apply threshold
-    thresh = threshold_otsu(bleach_image)
-    bw = closing(bleach_image > thresh, square(4))
-    # label image regions
-    bleach_ROIs = label(bw)
-
-    # calculate radius and centroid for circle shape
-    # get list of positions for each ROI
-    pixel_array = np.where(bleach_ROIs != 0, bleach_ROIs, np.nan)
-    # plt.imshow(pixel_array)
-    coords = pd.DataFrame(pixel_array).unstack().reset_index().dropna()
-    coords.columns = ['y', 'x', 'label']
-    # calculate position info for shape data 
-    # centroid is mean x+y positions
-    centroids = coords.groupby('label').mean()
-    # radius is max - min /2
-    centroids['radii'] = ((coords.groupby('label').max() - coords.groupby('label').min()) / 2).min(axis=1)
+    # napari is imported only for interactive masking, so headless masking runs without a display
+    import napari
+    # Threshold fist bleach image to create bleach mask, with centroid and radius for circle shapes
+    bleach_ROIs, centroids = detect_bleach_rois(image_stack[:, :, num_pre+1])
+    coords = bleach_coords(bleach_ROIs)
+    # non-bleach and background ROIs start from automatically placed positions, scored on the mean pre-bleach frame
+    initial_shapes = placed_shapes(place_rois(np.mean(image_stack[:, :, :num_pre], axis=2), centroids))
+    frame_shape = image_stack.shape[:2]
 
     masks = {}
 
-    for roi_label, roi in centroids.iterrows():
-        bleach_roi_shape = np.array([[roi['x'], roi['y']], [roi['radii'], roi['radii']]])
-        background_roi_shape = np.array([[roi['radii']+1, roi['radii']+1], [roi['radii'], roi['radii']]])
-        nonbleach_roi_shape = np.array([[roi['x'], roi['y']], [roi['radii'], roi['radii']]])
+    for roi_label, shapes in initial_shapes.items():
+        bleach_roi_shape, nonbleach_roi_shape, background_roi_shape = shapes['bleach'], shapes['non-bleach'], shapes['background']
 
         with napari.gui_qt():
             # create the viewer and add the image
@@ -78,29 +77,61 @@ def mask_per_stack(image_stack, image_name, num_pre=5, num_bleach=30):
             nb_layer = viewer.add_shapes(nonbleach_roi_shape, shape_type='ellipse', edge_width=1, name='non-bleach')
             bg_layer = viewer.add_shapes(background_roi_shape, shape_type='ellipse', edge_width=1, name='background')
 
-        bg_mask = bg_layer.to_labels((256, 256))
-        nb_mask = nb_layer.to_labels((256, 256))
-        b_mask = b_layer.to_labels((256, 256))
+        # ROIs are rasterised at the frame size of the stack
+        bg_mask = rasterise_shapes(frame_shape, bg_layer.data)
+        nb_mask = rasterise_shapes(frame_shape, nb_layer.data)
+        b_mask = rasterise_shapes(frame_shape, b_layer.data)
 
-        timepoints = {
-            timepoint: np.array([bg_mask, nb_mask, b_mask])
-            for timepoint in range(image_stack.shape[2])
-        }
+        # ROIs are boolean, and the same (read-only) stack is shared by every timepoint rather than copied
+        roi_stack = np.stack([bg_mask, nb_mask, b_mask])
+        roi_stack.flags.writeable = False
+        timepoints = {timepoint: roi_stack for timepoint in range(image_stack.shape[2])}
 
         masks[f'{image_name}_{int(roi_label)}'] = timepoints
 
     return coords, masks
 
 
-def mask_per_timepoint(image_stack, image_name, num_pre=5, num_bleach=30, visualise_timepoints=False):
+def bleach_coords(bleach_ROIs):
+    """Map x, y pixels inside each thresholded bleach ROI"""
+    y, x = np.nonzero(bleach_ROIs)
+    return pd.DataFrame({'y': y, 'x': x, 'label': bleach_ROIs[y, x]})
+
+
+def mask_headless(images, num_pre=5, num_bleach=30, output_folder=None):
+    """Generate ROI masks for every image without display, from thresholded bleach ROIs and automatically placed non-bleach and background ROIs (see utilities.roi.place_rois), which are mapped across all timepoints.
+
+    Returns
+    -------
+    tuple(dict, dict)
+        coords: dict mapping image name to df of x, y pixels inside the thresholded bleach ROI
+        masks: dict mapping each ROI name to a dict mapping each timepoint to ROI mask array containing background, non-bleached and bleached masks
+    """
+    coords, masks = {}, {}
+    for image_name, image_stack in images.items():
+        bleach_ROIs, centroids = detect_bleach_rois(image_stack[:, :, num_pre+1])
+        coords[image_name] = bleach_coords(bleach_ROIs)
+        shapes = placed_shapes(place_rois(np.mean(image_stack[:, :, :num_pre], axis=2), centroids))
+        # all ROIs of an image are rasterised together, and each (read-only) stack is shared by every timepoint
+        for roi_label, roi_stack in roi_mask_stacks(image_stack.shape[:2], shapes).items():
+            roi_stack.flags.writeable = False
+            roi_name = f'{image_name}_{int(roi_label)}'
+            masks[roi_name] = {timepoint: roi_stack for timepoint in range(image_stack.shape[2])}
+            if output_folder:
+                save_roi_masks(output_folder, roi_name, masks[roi_name])
+        logger.info(f'Masks generated for {len(shapes)} ROIs in {image_name}')
+    return coords, masks
+
+
+def mask_per_timepoint(images, num_pre=5, num_bleach=30, visualise_timepoints=False, output_folder=None, pyramid_folder=None):
     """Spawn editable ROIs for individual timepoints, which are then carried over subsequent timepoints until next edit point. Useful for cells that are moving, or with long per-frame intervals where the position of the thresholded bleaching ROI is insufficient to set the bleached ROI over the recovery period.
 
+    All images, ROIs and timepoints are reviewed in a single viewer (see utilities.review.ReviewSession), moving to the next frame with PageDown and back with PageUp. Only the frame being reviewed is displayed.
+
     Parameters
     ----------
-    image_stack : array
-        original image stack where z-dimension are timepoints
-    image_name : str
-        name of image to be processed
+    images : dict
+        mapping of image name to original image stack where z-dimension are timepoints
     num_pre : int, optional
         number of frames taken pre-bleach, by default 5
     num_bleach : int, optional
@@ -109,87 +140,108 @@ def mask_per_timepoint(image_stack, image_name, num_pre=5, num_bleach=30, visual
         Dictionary mapping number of frames post-bleach to how often images should be displayed for ROI editing
         e.g. visualise_timepoints={30: 5, 20: 2, 10: 1} visualises every 5 frames from 35-65,  every 5 frames from 65-85 and every frame from 85-95 assuming default num_pre and num_bleach. Any unaccounted for frames from end of visualise_timepoints to total frames will be assigned identical ROI to the last visualise_timepoints frame, so when specifying this method it is recommended to account for all frames.
         By default False to visualise all timepoints.
+    output_folder : str, optional
+        if provided, masks for every timepoint of an ROI are saved to {output_folder}{roi_name}/ each time one of its frames is saved (and for unedited ROIs once review is complete), by default None
+    pyramid_folder : str, optional
+        if provided, frames and segmentation are displayed from multiscale pyramids cached in pyramid_folder (see utilities.pyramid), by default None displays full resolution frames
 
     Returns
     -------
-    tuple(df, dict)
-        coords: df mapping x, y pixels inside the thresholded bleach ROI
-        timepoints: dict mapping each timepoint to ROI mask array containing background, non-bleached and bleached masks
+    tuple(dict, dict)
+        coords: dict mapping image name to df of x, y pixels inside the thresholded bleach ROI
+        masks: dict mapping each ROI name to a dict mapping each timepoint to ROI mask array containing background, non-bleached and bleached masks
     """
-    # Threshold fist bleach image to create bleach mask
-    bleach_image = image_stack[:, :, num_pre+1]
-    # plt.imshow(bleach)
-    # apply threshold
-    thresh = threshold_otsu(bleach_image)
-    bw = closing(bleach_image > thresh, square(4))
-    # label image regions
-    bleach_ROIs = label(bw)
-
-    # calculate radius and centroid for circle shape
-    # get list of positions for each ROI
-    pixel_array = np.where(bleach_ROIs != 0, bleach_ROIs, np.nan)
-    # plt.imshow(pixel_array)
-    coords = pd.DataFrame(pixel_array).unstack().reset_index().dropna()
-    coords.columns = ['y', 'x', 'label']
-    # calculate position info for shape data 
-    # centroid is mean x+y positions
-    centroids = coords.groupby('label').mean()
-    # radius is max - min /2
-    centroids['radii'] = ((coords.groupby('label').max() - coords.groupby('label').min()) / 2).min(axis=1)
-
+    first_frame = num_pre + num_bleach
+    coords, segmentations, initial_shapes, pyramids = {}, {}, {}, {}
+    for image_name, image_stack in images.items():
+        # Threshold fist bleach image to create bleach mask, with centroid and radius for circle shapes
+        segmentations[image_name], centroids = detect_bleach_rois(image_stack[:, :, num_pre+1])
+        coords[image_name] = bleach_coords(segmentations[image_name])
+
+        if pyramid_folder:
+            # the image pyramid is cached between runs until the memory-mapped stack file changes, while segmentation is rebuilt as it is recalculated here
+            pyramids[image_name] = build_pyramid(image_stack.transpose(2, 0, 1), f'{pyramid_folder}{image_name}/', source=getattr(image_stack, 'filename', None))
+            pyramids[f'{image_name}_segmentation'] = build_pyramid(segmentations[image_name], f'{pyramid_folder}{image_name}_segmentation/', is_labels=True, overwrite=True)
+
+        # non-bleach and background ROIs start from automatically placed positions, scored on the mean pre-bleach frame
+        for roi_label, shapes in placed_shapes(place_rois(np.mean(image_stack[:, :, :num_pre], axis=2), centroids)).items():
+            initial_shapes[f'{image_name}_{int(roi_label)}'] = shapes
+
+    # frames to review for every ROI, always including the first post-bleach frame
+    frames_to_view = {image_name: list(range(first_frame, image_stack.shape[2])) for image_name, image_stack in images.items()}
     if visualise_timepoints:
         # Visualise timepoints should be provided in as dict(number of frames, steps)
-        frames = [(num_pre+num_bleach)] + list(visualise_timepoints.keys())
-        frames = np.cumsum(frames)
-        frames_to_view = [list(np.arange(frames[x], frames[x + 1] + 1, step))for x, step in enumerate(visualise_timepoints.values())        ]
-
-        frames_to_view = list({item for sublist in frames_to_view for item in sublist})
-
-    masks = {}
-
-    for roi_label, roi in centroids.iterrows():
-        bleach_roi = np.array([[roi['x'], roi['y']], [roi['radii'], roi['radii']]])
-        background_roi = np.array([[roi['radii']+1, roi['radii']+1], [roi['radii'], roi['radii']]])
-        nonbleach_roi = np.array([[roi['x'], roi['y']], [roi['radii'], roi['radii']]])
-
-        # apply ROIs to all post-bleached images
-        timepoints = {}
-        for timepoint in range((num_pre+num_bleach), image_stack.shape[2]):
-            if timepoint in frames_to_view:
-                with napari.gui_qt():
-                    # create the viewer and add the image
-                    viewer = napari.view_image(image_stack[:, :, timepoint], name='image')
-                    # add the labels
-                    viewer.add_labels(bleach_ROIs, name='segmentation')
-                    # add shapes
-                    b_layer = viewer.add_shapes(bleach_roi, shape_type='ellipse', edge_width=1, name=f'bleach_{timepoint}')
-                    nb_layer = viewer.add_shapes(nonbleach_roi, shape_type='ellipse', edge_width=1, name=f'non-bleach_{timepoint}')
-                    bg_layer = viewer.add_shapes(background_roi, shape_type='ellipse', edge_width=1, name=f'background_{timepoint}')
-
-            bg_mask = bg_layer.to_labels((256, 256))
-            nb_mask = nb_layer.to_labels((256, 256))
-            b_mask = b_layer.to_labels((256, 256))
-            timepoints[timepoint] = np.array([bg_mask, nb_mask, b_mask])
-
-            bleach_roi = b_layer.data
-            nonbleach_roi = nb_layer.data
-            background_roi = bg_layer.data
-
+        frames = np.cumsum([first_frame] + list(visualise_timepoints.keys()))
+        selected = {item for x, step in enumerate(visualise_timepoints.values()) for item in np.arange(frames[x], frames[x + 1] + 1, step)}
+        frames_to_view = {image_name: sorted((selected | {first_frame}) & set(timepoints)) for image_name, timepoints in frames_to_view.items()}
+
+    # edited shapes for each ROI, keyed by the frame at which they were saved
+    edits = {roi_name: {} for roi_name in initial_shapes}
+
+    def shapes_at(roi_name, timepoint):
+        # ROIs carry over from the latest edited frame at or before timepoint
+        edited = [frame for frame in edits[roi_name] if frame <= timepoint]
+        return edits[roi_name][max(edited)] if edited else initial_shapes[roi_name]
+
+    def roi_masks(roi_name):
+        image_name = roi_name.rsplit('_', 1)[0]
+        # one mask stack per edited frame, rasterised together and shared by all timepoints it carries over to
+        frame_shapes = {timepoint: shapes_at(roi_name, timepoint) for timepoint in range(first_frame, images[image_name].shape[2])}
+        shared = roi_mask_stacks(images[image_name].shape[:2], {id(shapes): shapes for shapes in frame_shapes.values()})
+        timepoints = {timepoint: shared[id(shapes)] for timepoint, shapes in frame_shapes.items()}
         # apply first post-bleach ROIs to all pre-bleach and bleach images
-        for timepoint in range((num_pre+num_bleach)):
-            timepoints[timepoint] = timepoints[(num_pre+num_bleach)]  
+        for timepoint in range(first_frame):
+            timepoints[timepoint] = timepoints[first_frame]
+        return timepoints
+
+    def load_frame(item):
+        roi_name, timepoint = item
+        image_name = roi_name.rsplit('_', 1)[0]
+        shapes = shapes_at(roi_name, timepoint)
+        if pyramid_folder:
+            image, image_kwargs = pyramid_layer(pyramid_frame(pyramids[image_name], timepoint))
+            segmentation, segmentation_kwargs = pyramid_layer(pyramids[f'{image_name}_segmentation'])
+        else:
+            image, image_kwargs = np.asarray(images[image_name][:, :, timepoint]), {}
+            segmentation, segmentation_kwargs = segmentations[image_name], {}
+        return [
+            ('image', 'image', image, image_kwargs),
+            ('segmentation', 'labels', segmentation, segmentation_kwargs),
+        ] + [
+            (name, 'shapes', shapes[name], {'shape_type': 'ellipse', 'edge_width': 1})
+            for name in ['bleach', 'non-bleach', 'background']
+        ]
+
+    def save_frame(item, layers):
+        roi_name, timepoint = item
+        edits[roi_name][timepoint] = {name: [np.asarray(shape) for shape in layers[name]] for name in ['bleach', 'non-bleach', 'background']}
+        if output_folder:
+            save_roi_masks(output_folder, roi_name, roi_masks(roi_name))
+
+    items = [(roi_name, timepoint) for roi_name in initial_shapes for timepoint in frames_to_view[roi_name.rsplit('_', 1)[0]]]
+    # frames depend on edits to earlier frames, so are not preloaded
+    ReviewSession(items, load_item=load_frame, save_item=save_frame, title='FRAP ROIs', preload=False).run()
+
+    masks = {roi_name: roi_masks(roi_name) for roi_name in initial_shapes}
+    if output_folder:
+        # ROIs which were never edited have not yet been saved
+        for roi_name in [roi_name for roi_name, roi_edits in edits.items() if not roi_edits]:
+            save_roi_masks(output_folder, roi_name, masks[roi_name])
+    return coords, masks
 
-        masks[f'{image_name}_{int(roi_label)}'] = timepoints
 
-    return coords, masks
+def save_roi_masks(output_folder, roi_name, timepoints):
+    """Save mask stack for each timepoint of an ROI to {output_folder}{roi_name}/, bit-packed as ROI masks are boolean"""
+    if not os.path.exists(f'{output_folder}{roi_name}/'):
+        os.makedirs(f'{output_folder}{roi_name}/')
+    for timepoint, array_stack in timepoints.items():
+        save_mask(f'{output_folder}{roi_name}/{timepoint}', array_stack)
 
 
 # --------------Initialise file list--------------
-# read in pre-stacked arrays
-file_list = [filename for filename in os.listdir(input_folder) if '.npy' in filename]
-
-# reading in all images, and transposing to correct dimension of array
-images = {filename.replace('.npy', ''): np.load(f'{input_folder}{filename}') for filename in file_list}
+# memory-map pre-stacked arrays, so that only frames being reviewed are read
+manifest = load_manifest(manifest_path)
+images = {image_name: open_stack(image_path) for image_name, image_path in manifest[['image_name', 'image_path']].values}
 
 # with napari.gui_qt():
 #    viewer = napari.view_image(images['example_1'].transpose(2, 0, 1))
@@ -202,22 +254,18 @@ if len(images_to_process) < 1:
     logger.info('Processing all images')
 
 # ----------generate masks for each ROI----------
-for image_name in images_to_process:
-    image = images[image_name]
-    # coords, mask = mask_per_stack(image_stack=image, image_name=image_name, num_pre=5, num_bleach=30)
-
-    visualise_timepoints={
-    30: 5, # for 30 frames post-beach, show me every 5 frames
-    20: 2, # for the next 20 frames, show me every 2 frames
-    10: 1, # for the next 10 frames, show me every frame
-    }
-    coords, mask = mask_per_timepoint(image_stack=image, image_name=image_name, num_pre=5, num_bleach=30, visualise_timepoints=visualise_timepoints)
-
-    # -----------------save arrays-----------------
-    for roi_name, timepoints in mask.items():
-        if not os.path.exists(f'{output_folder}{roi_name}/'):
-            os.makedirs(f'{output_folder}{roi_name}/')
-
-        for timepoint, array_stack in timepoints.items():
-            # save associated arrays
-            np.save(f'{output_folder}{roi_name}/{timepoint}.npy', array_stack)
+# for image_name in images_to_process:
+#     coords, mask = mask_per_stack(image_stack=images[image_name], image_name=image_name, num_pre=5, num_bleach=30)
+#     for roi_name, timepoints in mask.items():
+#         save_roi_masks(output_folder, roi_name, timepoints)
+
+visualise_timepoints={
+30: 5, # for 30 frames post-beach, show me every 5 frames
+20: 2, # for the next 20 frames, show me every 2 frames
+10: 1, # for the next 10 frames, show me every frame
+}
+if headless:
+    coords, mask = mask_headless(images={image_name: images[image_name] for image_name in images_to_process}, num_pre=5, num_bleach=30, output_folder=output_folder)
+else:
+    # ROIs for all images are reviewed in one viewer, and masks for each ROI are saved as its frames are edited
+    coords, mask = mask_per_timepoint(images={image_name: images[image_name] for image_name in images_to_process}, num_pre=5, num_bleach=30, visualise_timepoints=visualise_timepoints, output_folder=output_folder, pyramid_folder=pyramid_folder if use_pyramids else None)
@@ -7,6 +7,9 @@ import skimage.io
 import functools
 
 from utilities.pixel_operations import pixel_collector
+from utilities.chunked import open_stack, label_frame_means
+from utilities.label_store import load_mask
+from utilities.manifest import load_manifest, roi_manifest
 
 from loguru import logger
 
@@ -16,29 +19,35 @@ logger.info('Import OK')
 image_folder = f'results/aggregate-FRAP/initial_cleanup/'
 mask_folder = f'results/aggregate-FRAP/napari_masking/'
 output_folder = f'results/aggregate-FRAP/pixel_collection/'
+manifest_path = f'results/aggregate-FRAP/manifest.csv'
+
+# 'pixels' saves every ROI pixel at every timepoint, 'means' saves only the mean intensity and pixel centroid of each ROI at each timepoint (all 4_summary_calculation.py and plot_ROI.py use), accumulated over chunks of rows of the memory-mapped stack without building per-pixel tables
+collection_method = 'pixels'
+# maximum bytes of each image stack (and temporaries derived from it) held in memory while collecting means
+memory_limit = 2 * 1024 ** 3
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
 
 # --------------Initialise file lists--------------
-mask_list = [folder for folder in os.listdir(mask_folder) if '.DS' not in folder]
-image_names = list({'_'.join(folder.split('_')[:-1]) for folder in mask_list})
+rois = roi_manifest(load_manifest(manifest_path), mask_folder)
+mask_list = rois['roi_name'].tolist()
 
-# reading in all images, and transposing to correct dimension of array
-images = {filename.replace('.npy', ''): np.load(f'{image_folder}{filename}.npy') for filename in image_names}
+# memory-map all image stacks, so that only the timepoint being processed is read into memory
+images = {image_name: open_stack(image_path) for image_name, image_path in rois[['image_name', 'image_path']].drop_duplicates().values}
 
 
 # read in masks, collect timepoints
 # - remember that stack format is [background, nonbleach, bleach]
 masks = {}
-for roi_name in mask_list:
+for roi_name, image_name in rois[['roi_name', 'image_name']].values:
     logger.info(f'Processing {roi_name}')
     try:
-        masks[roi_name] = {timepoint.replace('.npy', ''): np.load(f'{mask_folder}{roi_name}/{timepoint}') for timepoint in os.listdir(f'{mask_folder}{roi_name}/')}
+        masks[roi_name] = {f'{timepoint}': load_mask(f'{mask_folder}{roi_name}/{timepoint}') for timepoint in range(images[image_name].shape[2])}
         logger.info(f'Masks loaded for {len(masks[roi_name].keys())} timepoints')
     except:
-        logger.info(f'{image_name} not processed as no mask found')
+        logger.info(f'{roi_name} not processed as no mask found')
 
 
 # # Example napari visualisation to test matching mask array to image
@@ -53,21 +62,38 @@ for roi_name in mask_list:
 
 # ---------------collect pixel information---------------
 pixel_information = {}
-for roi_name in mask_list:
+for roi_name, image_name in rois[['roi_name', 'image_name']].values:
+    if roi_name not in masks:
+        continue
     logger.info(f'Processing {roi_name}')
-    image_name = '_'.join(roi_name.split('_')[:-1])
     image = images[image_name]
     timepoints = []
-    for timepoint in range(image.shape[2]):
-        # logger.info(f'Processing timepoint {timepoint} pixels')
-        # collect only one timepoint
-        image_array = image[:, :, timepoint]
-        mask_array = masks[roi_name][f'{timepoint}']
-        # for each timepoint, collect background, bleach and non-bleach pixels
-        roi_pixels = pd.concat([pixel_collector(image_array, mask_array[i, :, :], visualise=False, mask_type=mask_type) for i, mask_type in enumerate(['background', 'nonbleach', 'bleach'])])
-        # add identifiers
-        roi_pixels['timepoint'] = timepoint
-        timepoints.append(roi_pixels)
+    if collection_method == 'means':
+        # masks are applied to every timepoint at once where they were not edited over time
+        static = all(np.array_equal(masks[roi_name][f'{timepoint}'], masks[roi_name]['0']) for timepoint in range(image.shape[2]))
+        for i, mask_type in enumerate(['background', 'nonbleach', 'bleach']):
+            labels = masks[roi_name]['0'][i, :, :] if static else np.stack([masks[roi_name][f'{timepoint}'][i, :, :] for timepoint in range(image.shape[2])], axis=-1)
+            means = label_frame_means(image, labels != 0, memory_limit=memory_limit)
+            if len(means) < 2:
+                continue
+            roi_means = pd.DataFrame({'intensity': means[1], 'mask_type': mask_type, 'timepoint': np.arange(image.shape[2])})
+            # pixel centroid of the mask at each timepoint, as x (column) and y (row) averaged over collected pixels (e.g. for plot_ROI.py)
+            centroids = [np.nonzero(masks[roi_name]['0'][i, :, :])] * image.shape[2] if static else [np.nonzero(masks[roi_name][f'{timepoint}'][i, :, :]) for timepoint in range(image.shape[2])]
+            roi_means['x'] = [np.mean(cols) if len(cols) else np.nan for rows, cols in centroids]
+            roi_means['y'] = [np.mean(rows) if len(rows) else np.nan for rows, cols in centroids]
+            # timepoints where the mask is empty have no pixels, as for pixel collection
+            timepoints.append(roi_means.dropna(subset=['intensity']))
+    else:
+        for timepoint in range(image.shape[2]):
+            # logger.info(f'Processing timepoint {timepoint} pixels')
+            # collect only one timepoint
+            image_array = np.asarray(image[:, :, timepoint])
+            mask_array = masks[roi_name][f'{timepoint}']
+            # for each timepoint, collect background, bleach and non-bleach pixels
+            roi_pixels = pd.concat([pixel_collector(image_array, mask_array[i, :, :], visualise=False, mask_type=mask_type) for i, mask_type in enumerate(['background', 'nonbleach', 'bleach'])])
+            # add identifiers
+            roi_pixels['timepoint'] = timepoint
+            timepoints.append(roi_pixels)
     timepoints = pd.concat(timepoints)
     timepoints['roi_name'] = roi_name
 
@@ -8,16 +8,33 @@ import functools
 
 from loguru import logger
 from utilities.file_handling import df_to_excel
+from utilities.background import frame_background
+from utilities.chunked import open_stack
+from utilities.manifest import load_manifest, roi_manifest, dataset_name
+from utilities.results_db import append_results
+from utilities.statistics import condition_statistics, pairwise_permutation_tests
 
 logger.info('Import OK')
 
 # define location parameters, assign number of frames for pre- and bleach portions
 input_folder = f'results/aggregate-FRAP/pixel_collection/'
+image_folder = f'results/aggregate-FRAP/initial_cleanup/'
+mask_folder = f'results/aggregate-FRAP/napari_masking/'
 output_folder = f'results/aggregate-FRAP/summary_calculations/'
+manifest_path = f'results/aggregate-FRAP/manifest.csv'
 
 num_prebleach = 5
 num_bleach = 30
 
+# number of bootstrap resamples and permutations used for per-condition statistics
+num_resamples = 10000
+
+# replace the manual background ROI with an automatic per-frame estimate over the whole stack
+# one of 'percentile', 'otsu' or 'morphological' (see utilities.background.frame_background), or None to use the background ROI
+background_method = None
+# maximum bytes of each image stack held in memory while estimating background
+memory_limit = 2 * 1024 ** 3
+
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
@@ -26,16 +43,30 @@ if not os.path.exists(output_folder):
 # -----Process dataset-----
 
 # read in calculated pixel data
-file_list = [filename for filename in os.listdir(input_folder) if '.csv' in filename]
-pixels = {filename.replace('.csv', ''): pd.read_csv(f'{input_folder}{filename}') for filename in file_list}
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+rois = roi_manifest(manifest, mask_folder)
+pixels = {roi_name: pd.read_csv(f'{input_folder}{roi_name}.csv') for roi_name in rois['roi_name'] if os.path.exists(f'{input_folder}{roi_name}.csv')}
 pixels.update({key: value.drop([col for col in value.columns.tolist() if 'Unnamed: ' in col], axis=1) for key, value in pixels.items()})
 
 # generate summary df for mask, timepoint of interest
 pixels_compiled = pd.concat(pixels.values())
 
-# generate mean values for each ROI for each timepoint
+# generate mean values for each ROI for each timepoint, from per-pixel rows or the per-ROI means saved by 3_pixel_collection.py with collection_method = 'means'
 pixels_mean = pixels_compiled.copy().groupby(['roi_name', 'mask_type', 'timepoint']).mean().reset_index()
 
+# optionally replace background ROI with automatic background estimated for all frames of each image stack
+if background_method:
+    processed = rois[rois['roi_name'].isin(pixels_mean['roi_name'])]
+    backgrounds = []
+    for image_name, image_path in processed[['image_name', 'image_path']].drop_duplicates().values:
+        background = frame_background(open_stack(image_path), method=background_method, memory_limit=memory_limit)
+        backgrounds.append(pd.DataFrame({'image_name': image_name, 'timepoint': np.arange(len(background)), 'intensity': background}))
+    backgrounds = pd.merge(processed[['roi_name', 'image_name']], pd.concat(backgrounds), on='image_name').drop('image_name', axis=1)
+    backgrounds['mask_type'] = 'background'
+    pixels_mean = pd.concat([pixels_mean[pixels_mean['mask_type'] != 'background'], backgrounds]).reset_index(drop=True)
+    logger.info(f'Background ROIs replaced by {background_method} background')
+
 # assign timepoint identifiers - this will allow taking mean for pre-bleach, and removing bleach timepoints
 timepoint_map = {}
 timepoint_map.update(dict(zip(np.arange(0, num_prebleach), [-1] * num_prebleach)))
@@ -63,11 +94,17 @@ for roi_name, df in pixels_corrected.groupby('roi_name'):
     pixels_summary.append(df)
 pixels_summary = pd.concat(pixels_summary)
 
-# Assign sample identifiers
-pixels_summary['mutant'] = pixels_summary['roi_name'].str.split('_').str[0]
+# Assign sample identifiers from the ROI manifest
+pixels_summary = pd.merge(pixels_summary, rois[['roi_name', 'roi_id', 'image_name', 'mutant', 'replicate']], on='roi_name', how='left')
+
+# per-mutant recovery at each timepoint with bootstrap confidence intervals, and permutation tests between mutants at each timepoint
+frap_statistics = condition_statistics(pixels_summary, 'FRAP_corrected', ['mutant', 'timepoint_map'], num_resamples=num_resamples)
+frap_tests = pairwise_permutation_tests(pixels_summary, 'FRAP_corrected', ['mutant'], within=['timepoint_map'], num_permutations=num_resamples)
 
 # save to excel
 df_to_excel(
     output_path=f'{output_folder}FRAP_summary.xlsx',
-    sheetnames=['summary', 'compiled'],
-    data_frames=[pixels_summary, pixels_mean])
\ No newline at end of file
+    sheetnames=['summary', 'compiled', 'statistics', 'tests'],
+    data_frames=[pixels_summary, pixels_mean, frap_statistics, frap_tests])
+append_results(pixels_summary, 'frap_timepoints', experiment)
+append_results(pd.merge(pixels_mean, rois[['roi_name', 'image_name', 'mutant', 'replicate']], on='roi_name', how='left'), 'frap_roi_means', experiment)
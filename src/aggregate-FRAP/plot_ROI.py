@@ -6,11 +6,15 @@ import seaborn as sns
 
 from loguru import logger
 
+from utilities.chunked import open_stack
+from utilities.manifest import load_manifest, roi_manifest
+
 logger.info('Import OK')
 
 input_path = 'results/aggregate-FRAP/summary_calculations/FRAP_summary.xlsx'
-image_folder = 'results/aggregate-FRAP/initial_cleanup/'
+mask_folder = 'results/aggregate-FRAP/napari_masking/'
 output_folder = 'results/aggregate-FRAP/plot_ROI/'
+manifest_path = 'results/aggregate-FRAP/manifest.csv'
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
@@ -22,14 +26,13 @@ pixel_summary.drop([col for col in pixel_summary.columns.tolist() if 'Unnamed: '
 # Calculate centre of each ROI
 pixel_summary = pixel_summary[pixel_summary['timepoint'] == 0]
 roi_centroid = pixel_summary.groupby(['roi_name', 'mask_type']).mean().reset_index()
-roi_centroid['image_name'] = roi_centroid['roi_name'].str.split('_').str[:-1].str.join('_')
-pixel_summary['image_name'] = pixel_summary['roi_name'].str.split('_').str[:-1].str.join('_')
 
-# read in images
-file_list = [filename for filename in os.listdir(image_folder) if '.npy' in filename]
+# assign image names from the ROI manifest
+rois = roi_manifest(load_manifest(manifest_path), mask_folder)
+roi_centroid = pd.merge(roi_centroid, rois[['roi_name', 'image_name']], on='roi_name')
 
-# reading in all images, and collecting t0
-images = {filename.replace('.npy', ''): np.load(f'{image_folder}{filename}') for filename in file_list}
+# memory-map images, so that only the plotted timepoint is read
+images = {image_name: open_stack(image_path) for image_name, image_path in rois[['image_name', 'image_path']].drop_duplicates().values}
 
 # Generate plots for each image_name
 for image_name, df in roi_centroid.groupby('image_name'):
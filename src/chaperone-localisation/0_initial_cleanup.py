@@ -6,6 +6,7 @@ import skimage.io
 
 
 from loguru import logger
+from utilities.manifest import build_manifest, save_manifest, dataset_folder_name
 logger.info('Import ok')
 
 def jarvis(input_path, output_path):
@@ -32,6 +33,12 @@ def jarvis(input_path, output_path):
                 
 if __name__ == "__main__":
 
-    jarvis(input_path='data/example_chaperone-localisation/',
+    input_path = 'data/example_chaperone-localisation/'
+    jarvis(input_path=input_path,
         output_path='results/chaperone_localisation/initial_cleanup/')
 
+    # index cleaned images once, with metadata parsed from filenames, for all later stages
+    save_manifest(
+        build_manifest('results/chaperone_localisation/initial_cleanup/', metadata_cols=['treatment', 'chaperone', 'image_number'], dataset=dataset_folder_name(input_path)),
+        'results/chaperone_localisation/manifest.csv')
+
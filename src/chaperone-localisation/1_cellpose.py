@@ -13,12 +13,37 @@ from cellpose import plot
 import collections
 from skimage import exposure
 
+from utilities.label_store import save_label_store
+from utilities.manifest import load_manifest
+from utilities.prefetch import prefetch
+from utilities.segmentation import segment_tiled, segment_downsampled, resolution_factor, resolution_report, watershed_segment, apply_watershed, backend_report, spot_segment, apply_spots
+from utilities.image_cache import read_image
+
 #import napari
 
 
 input_folder = f'results/chaperone_localisation/initial_cleanup/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
 output_folder = f'results/chaperone_localisation/cellpose/'
 
+# segment large tiled/mosaic acquisitions tile-by-tile, stitching labels across tile seams
+# flows are not stitched, so cellpose results are not visualised in tiled mode
+tiled = False
+
+# segment large-diameter objects at reduced resolution, upsampling the labels with boundary refinement
+# reduced-resolution labels are compared against a full-resolution run for the first validation_size images
+reduced_resolution = False
+validation_size = 3
+
+# segmentation backend for each channel, either 'cellpose' or 'watershed' (classical smoothing, threshold and seeded watershed, requiring no model weights)
+# inclusions can also use 'spots' (multi-scale LoG spot detection with region growing, applied to batches of images)
+backends = {'cyto': 'cellpose', 'nuclei': 'cellpose', 'inclusions': 'cellpose'}
+# compare throughput and agreement of the watershed (and for inclusions, spots) backend against cellpose for the first validation_size images of each channel
+backend_validation = False
+
+# mean object diameters the cellpose models were trained at
+model_diameters = {'cyto': 30., 'nuclei': 17.}
+
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
@@ -31,6 +56,52 @@ def apply_cellpose(images, image_type='cyto', channels=[0,0], diameter=None, flo
     masks, flows, styles, diams = model.eval(images, diameter=diameter, channels=channels, flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold, resample=resample)
     return masks, flows, styles, diams
 
+def apply_cellpose_tiled(images, image_type='cyto', channels=[0,0], diameter=None, flow_threshold=0.4, cellprob_threshold=0.0, resample=False, tile_size=2048, overlap=256, max_workers=1):
+    """Apply model to list of large (e.g. mosaic) images tile-by-tile, stitching tile labels into a single label image per image. Returns masks only, as flows are not stitched.
+    - overlap (pixels) should exceed the largest expected object diameter
+    - images can be memory-mapped arrays, in which case only the tiles currently being segmented are held in memory
+    """
+    model = models.Cellpose(model_type=image_type)
+
+    def segment_tile(tile):
+        masks, flows, styles, diams = model.eval([tile], diameter=diameter, channels=channels, flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold, resample=resample)
+        return masks[0]
+
+    return [segment_tiled(image, segment_tile, tile_size=tile_size, overlap=overlap, max_workers=max_workers) for image in images]
+
+def cellpose_segmenter(image_type='cyto', channels=[0,0], diameter=None, flow_threshold=0.4, cellprob_threshold=0.0, resample=False):
+    """Load model once and return a function segmenting a single image at a given downsampling factor, where the diameter is scaled to match"""
+    model = models.Cellpose(model_type=image_type)
+
+    def segment(image, factor=1):
+        masks, flows, styles, diams = model.eval([image], diameter=None if diameter is None else diameter / factor, channels=channels, flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold, resample=resample)
+        return masks[0]
+
+    return segment
+
+def apply_cellpose_reduced(images, image_type='cyto', factor=None, refine=True, **kwargs):
+    """Apply model to list of images downsampled by factor, returning masks upsampled to full resolution. Returns masks, segmenter, factor.
+    - factor defaults to the largest integer factor keeping objects at or above the diameter the model was trained on
+    - segmenter can be passed to resolution_report to compare against full resolution segmentation
+    """
+    if factor is None:
+        factor = resolution_factor(kwargs.get('diameter'), model_diameters[image_type])
+    segment = cellpose_segmenter(image_type=image_type, **kwargs)
+    masks = [segment_downsampled(image, segment, factor, refine=refine) for image in images]
+    return masks, segment, factor
+
+def write_backend_report(images, channel, image_type='cyto', diameter=None, spots=False, **kwargs):
+    """Compare watershed (and spots if spots) against cellpose for the first validation_size images, saving the report to backend_report_{channel}.csv"""
+    segmenters = {
+        'cellpose': cellpose_segmenter(image_type=image_type, diameter=diameter, **kwargs),
+        'watershed': lambda image: watershed_segment(image, diameter=diameter),
+    }
+    if spots:
+        segmenters['spots'] = lambda image: spot_segment(image, diameter=diameter)
+    report = backend_report(images[:validation_size], segmenters, reference='cellpose', image_names=img_names[:validation_size])
+    report.to_csv(f'{output_folder}backend_report_{channel}.csv')
+    return report
+
 def visualise_cell_pose(images, masks, flows, channels=[0,0]):
     """Display cellpose results for each image
     """
@@ -45,35 +116,32 @@ def visualise_cell_pose(images, masks, flows, channels=[0,0]):
 
 def edge_filter(mask):
     """Collect boundary pixel values for all edges, return unique values
-    which correspond to cells that are touching/over the edge boundaries""" 
-    size = mask.shape[0]
-    edge_1_cells = set(list(mask[0:1, 0:size].flatten()))
-    edge_2_cells = set(list(mask[0:size, (size-1):size].flatten()))
-    edge_3_cells = set(list(mask[(size-1):size, 0:size].flatten()))
-    edge_4_cells = set(list(mask[0:size, 0:1].flatten()))
-    return edge_1_cells | edge_2_cells | edge_3_cells | edge_4_cells
+    which correspond to cells that are touching/over the edge boundaries. Handles non-square (e.g. stitched mosaic) masks""" 
+    edges = np.concatenate([mask[0, :], mask[:, -1], mask[-1, :], mask[:, 0]])
+    return set(np.unique(edges).tolist())
 
 def size_filter(mask, lower_size=1500, upper_size=10000):
     """Collect cells that are outside the cell size bounds as those to
     be excluded""" 
-    cell_size = dict(collections.Counter(mask.flatten()))
+    cell_size = np.bincount(mask.ravel())
     bs_cells = [
         cell_number
-        for cell_number, cell_size in cell_size.items()
-        if cell_size < lower_size or cell_size > upper_size
+        for cell_number, size in enumerate(cell_size)
+        if size > 0 and (size < lower_size or size > upper_size)
     ]
 
     return set(bs_cells)
 
 # --------------------------------------Initialise file list--------------------------------------
 
-file_list = [filename for filename in os.listdir(input_folder) if '.tif' in filename]
+manifest = load_manifest(manifest_path)
 
 # reading in all channels for each image, and transposing to correct dimension of array
-imgs = [skimage.io.imread(f'{input_folder}{filename}').transpose(0, 1, 2) for filename in file_list]
+# images are decoded in parallel on background threads
+imgs = [image for image_path, image in prefetch(manifest['image_path'], lambda image_path: read_image(image_path).transpose(0, 1, 2))]
 
 # clean filenames
-img_names = [filename.replace('.tif', '') for filename in file_list]
+img_names = manifest['image_name'].tolist()
 
 # -----------------------Complete cellpose with cytoplasm channel---------------------------------
 # channel 0: Hoechst 
@@ -86,9 +154,21 @@ img_names = [filename.replace('.tif', '') for filename in file_list]
 cytoplasm_images = [image[:, :, 3] for image in imgs]
 plt.imshow(cytoplasm_images[0])
 
-# Apply cellpose then visualise
-masks, flows, styles, diams = apply_cellpose(cytoplasm_images, image_type='cyto', diameter=100)
-visualise_cell_pose(cytoplasm_images, masks, flows, channels=[0, 0])
+# Apply cellpose (or watershed) then visualise
+if backend_validation:
+    write_backend_report(cytoplasm_images, 'cyto', image_type='cyto', diameter=100)
+
+if backends['cyto'] == 'watershed':
+    masks = apply_watershed(cytoplasm_images, diameter=100, tiled=tiled, overlap=256)
+elif tiled:
+    masks = apply_cellpose_tiled(cytoplasm_images, image_type='cyto', diameter=100, overlap=256)
+elif reduced_resolution:
+    masks, segment, factor = apply_cellpose_reduced(cytoplasm_images, image_type='cyto', diameter=100)
+    report = resolution_report(cytoplasm_images[:validation_size], segment, factor, image_names=img_names[:validation_size])
+    report.to_csv(f'{output_folder}reduced_resolution_cyto.csv')
+else:
+    masks, flows, styles, diams = apply_cellpose(cytoplasm_images, image_type='cyto', diameter=100)
+    visualise_cell_pose(cytoplasm_images, masks, flows, channels=[0, 0])
 
 # # -----------------------If NES image, use inversion of venus channel to define nuclei---------------------------------
 # nuc_masks, nuc_flows, nuc_styles, nuc_diams = apply_cellpose([65000 - array for array in cytoplasm_images], image_type='nuclei', diameter=20)
@@ -98,8 +178,20 @@ visualise_cell_pose(cytoplasm_images, masks, flows, channels=[0, 0])
 # collecting only channel 0's for masking
 nuc_images = [image[:, :, 0] for image in imgs]
 
-nuc_masks, nuc_flows, nuc_styles, nuc_diams = apply_cellpose(nuc_images, image_type='nuclei', diameter=100, resample=True)
-visualise_cell_pose(nuc_images, nuc_masks, nuc_flows, channels=[0, 0])
+if backend_validation:
+    write_backend_report(nuc_images, 'nuclei', image_type='nuclei', diameter=100, resample=True)
+
+if backends['nuclei'] == 'watershed':
+    nuc_masks = apply_watershed(nuc_images, diameter=100, tiled=tiled, overlap=256)
+elif tiled:
+    nuc_masks = apply_cellpose_tiled(nuc_images, image_type='nuclei', diameter=100, resample=True, overlap=256)
+elif reduced_resolution:
+    nuc_masks, segment, factor = apply_cellpose_reduced(nuc_images, image_type='nuclei', diameter=100, resample=True)
+    report = resolution_report(nuc_images[:validation_size], segment, factor, image_names=img_names[:validation_size])
+    report.to_csv(f'{output_folder}reduced_resolution_nuclei.csv')
+else:
+    nuc_masks, nuc_flows, nuc_styles, nuc_diams = apply_cellpose(nuc_images, image_type='nuclei', diameter=100, resample=True)
+    visualise_cell_pose(nuc_images, nuc_masks, nuc_flows, channels=[0, 0])
 
 # -----------------------outline Htt inclusions---------------------------------
 htt_images = [image[:, :, 2] for image in imgs]
@@ -111,11 +203,21 @@ for image in htt_images:
     new_image = gaussian_filter(new_image, sigma=10)
     smooth_images.append(new_image)
 
-htt_masks, htt_flows, htt_styles, htt_diams = apply_cellpose(smooth_images, image_type='nuclei', diameter=40, flow_threshold=10, cellprob_threshold=-3)
-visualise_cell_pose(htt_images, htt_masks, htt_flows, channels=[0, 0])
+if backend_validation:
+    write_backend_report(smooth_images, 'inclusions', image_type='nuclei', diameter=40, spots=True, flow_threshold=10, cellprob_threshold=-3)
+
+if backends['inclusions'] == 'watershed':
+    htt_masks = apply_watershed(smooth_images, diameter=40, tiled=tiled, overlap=128)
+elif backends['inclusions'] == 'spots':
+    htt_masks = apply_spots(smooth_images, diameter=40)
+elif tiled:
+    htt_masks = apply_cellpose_tiled(smooth_images, image_type='nuclei', diameter=40, flow_threshold=10, cellprob_threshold=-3, overlap=128)
+else:
+    htt_masks, htt_flows, htt_styles, htt_diams = apply_cellpose(smooth_images, image_type='nuclei', diameter=40, flow_threshold=10, cellprob_threshold=-3)
+    visualise_cell_pose(htt_images, htt_masks, htt_flows, channels=[0, 0])
 
 
-# save associated cell mask arrays
-np.save(f'{output_folder}cellpose_masks.npy', masks)
-np.save(f'{output_folder}cellpose_nuclei.npy', nuc_masks)
-np.save(f'{output_folder}cellpose_inclusions.npy', htt_masks)
+# save associated cell mask arrays, keyed by image name
+save_label_store(f'{output_folder}cellpose_masks.npz', dict(zip(img_names, masks)))
+save_label_store(f'{output_folder}cellpose_nuclei.npz', dict(zip(img_names, nuc_masks)))
+save_label_store(f'{output_folder}cellpose_inclusions.npz', dict(zip(img_names, htt_masks)))
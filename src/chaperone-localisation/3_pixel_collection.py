@@ -10,48 +10,43 @@ import functools
 from GEN_Utils.FileHandling import df_to_excel
 from loguru import logger
 
+from utilities.compartments import load_compartments
+from utilities.pixel_operations import label_pixel_collector
+from utilities.roi_statistics import roi_histograms
+from utilities.prefetch import prefetch
+from utilities.manifest import load_manifest
+from utilities.image_cache import read_image
+
 logger.info('Import OK')
 
 # define location parameters
 image_folder = f'results/chaperone_localisation/initial_cleanup/'
 mask_folder = f'results/chaperone_localisation/napari_masking/'
 output_folder = f'results/chaperone_localisation/pixel_collection/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
+histogram_folder = f'results/chaperone_localisation/roi_histograms/'
 
-if not os.path.exists(output_folder):
-    os.mkdir(output_folder)
-
-
-# define function to collect pixel location and intensity for a given mask, image combination
-def pixel_collector(image_array, mask, mask_type=None, visualise=False, size=(1024, 1024)):
-    pixel_array = np.where(mask != 0, image_array, np.nan)
-    # plt.imshow(pixel_array)
-    coords = pd.DataFrame(pixel_array).unstack().reset_index().dropna()
-    coords.columns = ['y', 'x', 'intensity']
-
-    if mask_type != None:
-        coords['mask_type'] = mask_type
+# per-pixel tables are no longer needed for summary calculations, which use the ROI histograms
+save_pixels = True
 
-    if visualise:
-        # test visualisation, compare to plt.show
-        fig, ax = plt.subplots(figsize=(20, 20))
-        sns.scatterplot(coords['x'], coords['y'], hue=coords['intensity'], palette='magma_r', size=0.5,linewidth=0, alpha = 0.7)
-        plt.ylim(size[0], 0)
-        plt.xlim(0, size[1])
+for folder in [output_folder, histogram_folder]:
+    if not os.path.exists(folder):
+        os.mkdir(folder)
 
-    return coords
 
 # --------------Initialise file lists--------------
-# reading in all images, and transposing to correct dimension of array
-images = { image_name.replace('.tif', ''): skimage.io.imread(f'{image_folder}{image_name}') for image_name in os.listdir(f'{image_folder}') if '.tif' in image_name}
+# collect image names - images are read one at a time during pixel collection, with the next images decoded in the background
+manifest = load_manifest(manifest_path)
+image_names = manifest['image_name'].tolist()
 
-# read in masks - remember that stack format is [barnase, aggregates]
+# read in masks - remember that stack format is [cytoplasm, aggregate, nucleus], where each layer is labelled by cell number
 # fails try/except if no masks found therefore skip that image
 masks = {}
-for image_name in images.keys():
+for image_name in image_names:
     logger.info(f'Processing {image_name}')
     try:
-        masks[f'{image_name}'] = {cell.replace('.npy', ''): np.load(f'{mask_folder}{image_name}/{cell}') for cell in os.listdir(f'{mask_folder}{image_name}/')}
-        logger.info(f'Masks loaded for {len(masks[f"{image_name}"].keys())} cells')
+        masks[f'{image_name}'] = load_compartments(f'{mask_folder}{image_name}/')
+        logger.info(f'Masks loaded for {len(np.unique(masks[f"{image_name}"])) - 1} cells')
     except:
         logger.info(f'{image_name} not processed as no mask found')
 
@@ -59,42 +54,45 @@ for image_name in images.keys():
 # Example napari visualisation to test matching mask array to image
 import napari
 image_test_name = '72Q Httex1_HSP40_Series003'
-cyto_mask = np.zeros((1024, 1024))
-nuc_mask = np.zeros((1024, 1024))
-agg_mask = np.zeros((1024, 1024))
 with napari.gui_qt():
     viewer = napari.Viewer()
-    viewer.add_image(images[image_test_name].transpose(2, 0, 1), name='raw_image')
-    for cell in masks[f'{image_test_name}'].keys():
-        cyto_mask = np.where(masks[f'{image_test_name}'][cell][0, :, :] == 1, int(cell.split('_')[-1]), cyto_mask)
-        agg_mask = np.where(masks[f'{image_test_name}'][cell][1, :, :] == 1, int(cell.split('_')[-1]), agg_mask)
-        nuc_mask = np.where(masks[f'{image_test_name}'][cell][2, :, :] == 1, int(cell.split('_')[-1]), nuc_mask)
-
-    viewer.add_labels(cyto_mask, name=f'cytoplasm')
-    viewer.add_labels(agg_mask, name=f'aggregate')
-    viewer.add_labels(nuc_mask, name=f'nucleus')
+    viewer.add_image(read_image(f'{image_folder}{image_test_name}.tif').transpose(2, 0, 1), name='raw_image')
+    viewer.add_labels(masks[f'{image_test_name}'][0, :, :], name=f'cytoplasm')
+    viewer.add_labels(masks[f'{image_test_name}'][1, :, :], name=f'aggregate')
+    viewer.add_labels(masks[f'{image_test_name}'][2, :, :], name=f'nucleus')
 
 
 
 # ---------------collect pixel information---------------
 pixel_information = {}
-for image_name in masks.keys():
+histograms = {}
+for image_name, image in prefetch(list(masks.keys()), lambda image_name: read_image(f'{image_folder}{image_name}.tif')):
     logger.info(f'Processing {image_name}')
-    image = images[image_name].copy()
+    mask_stack = masks[image_name]
+    cell_names = {label: f'{image_name}_cell_{label}' for label in np.unique(mask_stack) if label > 0}
+
+    # exact intensity histograms for every cell, compartment and channel
+    image_histograms = roi_histograms(image, mask_stack, ['cytoplasm', 'aggregate', 'nucleus'])
+    image_histograms['cell'] = image_histograms['label'].map(cell_names)
+    histograms[image_name] = image_histograms.drop('label', axis=1)
+
+    if not save_pixels:
+        continue
     pixels = []
     for channel in range(image.shape[2]):
-        image_array = image[:, :, channel].copy()
-        for cell, mask_stack in masks[image_name].items():
-            # for each cell, collect barnase and aggregate pixels
-            cell_pixels = pd.concat([pixel_collector(image_array, mask_stack[i, :, :], visualise=False, mask_type=mask_type) for i, mask_type in enumerate(['cytoplasm', 'aggregate', 'nucleus'])])
-            # add identifiers
-            cell_pixels['channel'] = channel
-            cell_pixels['cell'] = f'{image_name}_{cell}'
-            pixels.append(cell_pixels)
+        image_array = image[:, :, channel]
+        # collect cytoplasm, aggregate and nucleus pixels for all cells at once
+        for i, mask_type in enumerate(['cytoplasm', 'aggregate', 'nucleus']):
+            compartment_pixels = label_pixel_collector(image_array, mask_stack[i, :, :], mask_type=mask_type)
+            compartment_pixels['channel'] = channel
+            pixels.append(compartment_pixels)
     pixels = pd.concat(pixels)
-    pixel_information[image_name] = pixels
+    # add identifiers
+    pixels['cell'] = pixels['label'].map(cell_names)
+    pixel_information[image_name] = pixels.drop('label', axis=1)
 logger.info('Completed pixel collection')
 
 # save to excel (although this will likely be unopenable if more than a few images) and csv
 # df_to_excel(output_path=f'{output_folder}pixel_information.xlsx', sheetnames=list(pixel_information.keys()), data_frames=list(pixel_information.values()))
 saved = [df.to_csv(f'{output_folder}{image_name}.csv') for image_name, df in pixel_information.items()]
+saved = [df.to_csv(f'{histogram_folder}{image_name}.csv') for image_name, df in histograms.items()]
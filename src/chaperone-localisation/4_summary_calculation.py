@@ -1,78 +1,106 @@
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import skimage.io
 import functools
 
 from GEN_Utils import FileHandling
 from loguru import logger
 
+from utilities.roi_statistics import histogram_summary
+from utilities.manifest import load_manifest, cell_manifest, dataset_name
+from utilities.incremental import update_partials
+from utilities.results_db import append_results
+from utilities.statistics import condition_statistics, pairwise_permutation_tests
+from utilities.plotting import condition_distributions, plot_distributions, save_figure
+
 logger.info('Import OK')
 
 # define location parameters
-input_folder = f'results/chaperone_localisation/pixel_collection/'
+input_folder = f'results/chaperone_localisation/roi_histograms/'
+mask_folder = f'results/chaperone_localisation/napari_masking/'
 output_folder = f'results/chaperone_localisation/summary_calculations/'
+partial_folder = f'results/chaperone_localisation/summary_calculations/partials/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
 
+# number of bootstrap resamples and permutations used for per-condition statistics
+num_resamples = 10000
 fret_channel = 3
 overlap_threshold = 0.5
+# ratio distributions are plotted as 'violin', 'box' or binned 'strip' plots from histograms with plot_bins bins
+plot_kind = 'violin'
+plot_bins = 100
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
-# read in calculated pixel data
-file_list = [filename for filename in os.listdir(input_folder) if '.csv' in filename]
-pixels = {filename.replace('.csv', ''): pd.read_csv(f'{input_folder}{filename}') for filename in file_list}
-pixels.update({key: value.drop([col for col in value.columns.tolist() if 'Unnamed: ' in col], axis=1) for key, value in pixels.items()})
-
-# generate summary df, collect only channel of interest
-pixels_compiled = pd.concat(pixels.values())
-pixels_compiled = pd.pivot_table(pixels_compiled, index=['x', 'y', 'mask_type', 'cell'], columns=['channel'], values=['intensity']).reset_index()
-pixels_compiled.columns = [
-    '_'.join(str(val) for val in x) if type(x[1]) == int else x[0]
-    for x in pixels_compiled.columns
-]
+# per-ROI intensity histograms for each image
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+sources = {image_name: f'{input_folder}{image_name}.csv' for image_name in manifest['image_name'] if os.path.exists(f'{input_folder}{image_name}.csv')}
 
+def image_statistics(image_name):
+    # generate median, quantiles, MAD and saturation for each ROI from histograms
+    histograms = pd.read_csv(sources[image_name])
+    histograms = histograms.drop([col for col in histograms.columns.tolist() if 'Unnamed: ' in col], axis=1)
+    return histogram_summary(histograms, group_cols=['cell', 'mask_type', 'channel'])
 
-# Add label if aggregate inside unmasked (i.e. same compartment)
-aggregate_cells = pixels_compiled[pixels_compiled['mask_type'] == 'aggregate']['cell'].unique()
+# every ROI belongs to a single image, so per-image statistics are only recalculated for new or changed images
+roi_statistics = update_partials(sources, image_statistics, partial_folder).drop('image_name', axis=1)
+roi_statistics['channel'] = roi_statistics['channel'].astype(int)
 
+# Add label if aggregate inside unmasked (i.e. same compartment)
+aggregate_cells = roi_statistics[roi_statistics['mask_type'] == 'aggregate']['cell'].unique()
 
-# generate mean values for each ROI for each timepoint
-pixels_mean = pixels_compiled.copy().groupby(['cell', 'mask_type']).median().reset_index()
+# generate median values for each ROI, one column per channel
+pixels_mean = pd.pivot_table(roi_statistics, index=['cell', 'mask_type'], columns=['channel'], values=['median']).reset_index()
+pixels_mean.columns = [
+    f'intensity_{x[1]}' if x[0] == 'median' else x[0]
+    for x in pixels_mean.columns
+]
 
-# assign identifiers
-pixels_mean[['treatment', 'chaperone', 'image_number', 'discard2', 'cell_number']] = pixels_mean['cell'].str.split('_', expand=True)
-pixels_mean.drop(['discard2'], axis=1, inplace=True)
+# assign identifiers from the cell manifest
+cells = cell_manifest(manifest, mask_folder)
+pixels_mean = pd.merge(pixels_mean, cells[['cell', 'image_name', 'treatment', 'chaperone', 'image_number', 'cell_number']], on='cell', how='left')
 
 pixels_mean['aggregate_cell'] = [1 if cell in aggregate_cells else np.nan for cell in pixels_mean['cell']]
 
 # generate nucleus vs cytoplasm ratio
 quant_col = 'intensity_3'
-info_cols = ['treatment', 'chaperone', 'image_number', 'cell_number', 'aggregate_cell']
+info_cols = ['image_name', 'treatment', 'chaperone', 'image_number', 'cell_number', 'aggregate_cell']
 cytoplasm = pixels_mean[pixels_mean['mask_type'] == 'cytoplasm'].copy().set_index(info_cols)[quant_col].reset_index().rename(columns={'intensity_3': 'cytoplasm'})
 nucleus = pixels_mean[pixels_mean['mask_type'] == 'nucleus'].copy().set_index(info_cols)[quant_col].reset_index().rename(columns={'intensity_3': 'nucleus'})
 
 ratio = functools.reduce(lambda left, right: pd.merge(left, right, on=info_cols, how='outer'), [cytoplasm, nucleus])
 ratio['nuc-cyto_ratio'] = ratio['nucleus'] / ratio['cytoplasm']
 
+# per-condition means and medians with bootstrap confidence intervals, and permutation tests between conditions
+condition_cols = ['treatment', 'chaperone', 'aggregate_cell']
+ratio_conditions = ratio.assign(aggregate_cell=ratio['aggregate_cell'].fillna(0))
+ratio_statistics = condition_statistics(ratio_conditions, 'nuc-cyto_ratio', condition_cols, num_resamples=num_resamples)
+ratio_tests = pairwise_permutation_tests(ratio_conditions, 'nuc-cyto_ratio', condition_cols, num_permutations=num_resamples)
 
 # save to excel
-FileHandling.df_to_excel(output_path=f'{output_folder}summary_calculations.xlsx', sheetnames=['summary', 'nuc-cyto_ratio'], data_frames=[pixels_mean, ratio])
+FileHandling.df_to_excel(output_path=f'{output_folder}summary_calculations.xlsx', sheetnames=['summary', 'nuc-cyto_ratio', 'roi_statistics', 'ratio_statistics', 'ratio_tests'], data_frames=[pixels_mean, ratio, roi_statistics, ratio_statistics, ratio_tests])
 # pixels_mean.to_csv(f'{output_folder}pixel_summary.csv')
+append_results(pixels_mean, 'chaperone_cells', experiment)
+append_results(ratio, 'chaperone_ratios', experiment)
+append_results(roi_statistics, 'chaperone_roi_statistics', experiment)
 
 # ------------------------visualise------------------------
+# distributions are drawn from per-condition histograms and quantiles rather than every cell, and rendered straight to file
 for_plotting = ratio.copy()
-for_plotting['aggregate_cell'] = for_plotting['aggregate_cell'].fillna(0)
+for_plotting['aggregate_cell'] = for_plotting['aggregate_cell'].fillna(0).astype(int)
 for_plotting['sample_key'] = for_plotting['treatment'] +' '+ for_plotting['chaperone']
 
+ratio_histograms, ratio_quantiles = condition_distributions(for_plotting, 'nuc-cyto_ratio', ['sample_key', 'aggregate_cell'], bins=plot_bins)
+ratio_histograms.to_csv(f'{output_folder}ratio_histograms.csv')
+ratio_quantiles.to_csv(f'{output_folder}ratio_quantiles.csv')
 
 color_dict = {1: 'rebeccapurple', 0: 'darkorange'}
 
-fig, ax = plt.subplots()
-sns.swarmplot(x='sample_key', y='nuc-cyto_ratio', data=for_plotting, hue='aggregate_cell', palette=color_dict, dodge=True)
-plt.legend(title='Aggregate cell')
-plt.xlabel('Sample')
-plt.ylabel('Mean intensity ratio (Nucleus/Cytoplasm)')
-plt.show()
+ax = plot_distributions(ratio_histograms, ratio_quantiles, x_col='sample_key', hue_col='aggregate_cell', kind=plot_kind, palette=color_dict)
+ax.legend(title='Aggregate cell')
+ax.set_xlabel('Sample')
+ax.set_ylabel('Mean intensity ratio (Nucleus/Cytoplasm)')
+save_figure(ax, f'{output_folder}nuc-cyto_ratio_{plot_kind}.png')
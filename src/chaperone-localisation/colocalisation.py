@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+from utilities.colocalisation import colocalisation
+from utilities.compartments import load_compartments
+from utilities.manifest import load_manifest, cell_manifest, dataset_name
+from utilities.prefetch import prefetch
+from utilities.results_db import append_results
+from utilities.image_cache import read_image
+
+logger.info('Import OK')
+
+# define location parameters
+mask_folder = f'results/chaperone_localisation/napari_masking/'
+output_folder = f'results/chaperone_localisation/colocalisation/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
+
+# channel 0: Hoechst
+# channel 1: Htt cyto
+# channel 2: Htt incl
+# channel 3: Alexa647 (chaperone)
+channel_pairs = [(3, 1), (3, 2)]
+# intensity above which each channel is considered present for Manders coefficients, channels not listed use Otsu thresholds
+thresholds = {}
+
+if not os.path.exists(output_folder):
+    os.mkdir(output_folder)
+
+
+# --------------Initialise file lists--------------
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+image_paths = {image_name: image_path for image_name, image_path in manifest[['image_name', 'image_path']].values if os.path.exists(f'{mask_folder}{image_name}/')}
+
+# ---------------calculate colocalisation---------------
+# stack format is [cytoplasm, aggregate, nucleus], where each layer is labelled by cell number
+results = []
+for image_name, image in prefetch(list(image_paths.keys()), lambda image_name: read_image(image_paths[image_name])):
+    mask_stack = load_compartments(f'{mask_folder}{image_name}/')
+    result = colocalisation(image, mask_stack, ['cytoplasm', 'aggregate', 'nucleus'], channel_pairs=channel_pairs, thresholds=thresholds)
+    result['image_name'] = image_name
+    results.append(result.rename(columns={'label': 'cell_number'}))
+    logger.info(f'Colocalisation calculated for {len(np.unique(mask_stack)) - 1} cells in {image_name}')
+results = pd.concat(results).reset_index(drop=True)
+
+# assign identifiers from the cell manifest
+cells = cell_manifest(manifest, mask_folder)
+results = pd.merge(results, cells[['image_name', 'cell_number', 'cell', 'treatment', 'chaperone', 'image_number']], on=['image_name', 'cell_number'], how='left')
+
+# save to csv and results database
+results.to_csv(f'{output_folder}colocalisation.csv')
+append_results(results, 'chaperone_colocalisation', experiment)
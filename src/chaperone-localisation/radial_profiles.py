@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+from utilities.compartments import load_compartments
+from utilities.image_cache import read_image
+from utilities.manifest import load_manifest, cell_manifest, dataset_name
+from utilities.prefetch import prefetch
+from utilities.radial import radial_profiles, eroded_statistics
+from utilities.results_db import append_results
+
+logger.info('Import OK')
+
+# define location parameters
+mask_folder = f'results/chaperone_localisation/napari_masking/'
+output_folder = f'results/chaperone_localisation/radial_profiles/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
+
+# channel 0: Hoechst
+# channel 1: Htt cyto
+# channel 2: Htt incl
+# channel 3: Alexa647 (chaperone) ----> used for eroded nuc/cyto ratios
+quant_channel = 3
+# profiles are binned by distance (pixels) from the nuclear boundary, positive inside the nucleus
+bin_width = 2
+max_distance = 60
+# compartments are eroded by each depth (pixels) from their boundaries, excluding pixels at the nuclear envelope and cell edge
+depths = [0, 1, 2, 4, 8]
+
+if not os.path.exists(output_folder):
+    os.mkdir(output_folder)
+
+
+# --------------Initialise file lists--------------
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+image_paths = {image_name: image_path for image_name, image_path in manifest[['image_name', 'image_path']].values if os.path.exists(f'{mask_folder}{image_name}/')}
+
+# ---------------calculate profiles and eroded statistics---------------
+# stack format is [cytoplasm, aggregate, nucleus], where each layer is labelled by cell number
+profiles, eroded = [], []
+for image_name, image in prefetch(list(image_paths.keys()), lambda image_name: read_image(image_paths[image_name])):
+    mask_stack = load_compartments(f'{mask_folder}{image_name}/')
+    profile = radial_profiles(image, mask_stack.max(axis=0), mask_stack[2], bin_width=bin_width, max_distance=max_distance)
+    profile['image_name'] = image_name
+    profiles.append(profile)
+    statistics = eroded_statistics(image, mask_stack, ['cytoplasm', 'aggregate', 'nucleus'], depths=depths)
+    statistics['image_name'] = image_name
+    eroded.append(statistics)
+    logger.info(f'Radial profiles calculated for {len(np.unique(mask_stack)) - 1} cells in {image_name}')
+profiles = pd.concat(profiles).rename(columns={'label': 'cell_number'}).reset_index(drop=True)
+eroded = pd.concat(eroded).rename(columns={'label': 'cell_number'}).reset_index(drop=True)
+
+# nuc/cyto ratio of eroded compartments at each depth
+ratios = pd.pivot_table(eroded[eroded['channel'] == quant_channel], index=['image_name', 'cell_number', 'depth'], columns='mask_type', values='mean').reset_index()
+ratios['nuc-cyto_ratio'] = ratios['nucleus'] / ratios['cytoplasm']
+
+# assign identifiers from the cell manifest
+cells = cell_manifest(manifest, mask_folder)[['image_name', 'cell_number', 'cell', 'treatment', 'chaperone', 'image_number']]
+profiles, eroded, ratios = [pd.merge(df, cells, on=['image_name', 'cell_number'], how='left') for df in [profiles, eroded, ratios]]
+
+# save to csv and results database
+profiles.to_csv(f'{output_folder}radial_profiles.csv')
+eroded.to_csv(f'{output_folder}eroded_statistics.csv')
+ratios.to_csv(f'{output_folder}eroded_ratios.csv')
+append_results(profiles, 'chaperone_radial_profiles', experiment)
+append_results(eroded, 'chaperone_eroded_statistics', experiment)
+append_results(ratios, 'chaperone_eroded_ratios', experiment)
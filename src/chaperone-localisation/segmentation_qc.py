@@ -0,0 +1,68 @@
+import os
+import pandas as pd
+from scipy import ndimage
+
+from loguru import logger
+
+from utilities.label_metrics import segmentation_agreement, aggregate_agreement
+from utilities.label_store import load_labels, load_mask, mask_exists
+from utilities.manifest import load_manifest, dataset_name
+from utilities.results_db import append_results
+
+logger.info('Import OK')
+
+# define location parameters
+cellpose_folder = f'results/chaperone_localisation/cellpose/'
+mask_folder = f'results/chaperone_localisation/napari_masking/'
+output_folder = f'results/chaperone_localisation/segmentation_qc/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
+
+# raw cellpose label store compared with each layer of the curated [cells, aggregates, nuclei] _mask stacks from 2_define_masks.py
+# curated inclusion and nuclear layers are labelled by the owning cell number (one label may cover several blobs), so both layers are split into connected components before comparison
+layers = {
+    'cells': ('cellpose_masks', 0, False),
+    'inclusions': ('cellpose_inclusions', 1, True),
+    'nuclei': ('cellpose_nuclei', 2, True),
+}
+iou_threshold = 0.5
+min_fraction = 0.1
+
+if not os.path.exists(output_folder):
+    os.mkdir(output_folder)
+
+
+# --------------Initialise file lists--------------
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+image_names = [image_name for image_name in manifest['image_name'] if mask_exists(f'{mask_folder}{image_name}_mask')]
+
+# ---------------compare raw and curated labels---------------
+# curated labels are the reference, so unmatched predictions are objects removed during filtering
+objects, summaries = [], []
+for image_name in image_names:
+    curated = load_mask(f'{mask_folder}{image_name}_mask')
+    for layer, (store, index, components) in layers.items():
+        reference = curated[index]
+        raw = load_labels(f'{cellpose_folder}{store}', image_name, image_names=manifest['image_name'].tolist())
+        if components:
+            reference, raw = ndimage.label(reference != 0)[0], ndimage.label(raw != 0)[0]
+        agreement, summary = segmentation_agreement(reference, raw, iou_threshold=iou_threshold, min_fraction=min_fraction)
+        agreement['image_name'], agreement['layer'] = image_name, layer
+        objects.append(agreement)
+        summaries.append({'image_name': image_name, 'layer': layer, **summary})
+    logger.info(f'Segmentation agreement calculated for {image_name}')
+objects = pd.concat(objects).reset_index(drop=True)
+summaries = pd.merge(pd.DataFrame(summaries), manifest[['image_name', 'treatment', 'chaperone']], on='image_name', how='left')
+
+# aggregate reports for the whole experiment and each condition
+experiment_summary = aggregate_agreement(summaries, ['layer'])
+condition_summary = aggregate_agreement(summaries, ['layer', 'treatment', 'chaperone'])
+for _, row in experiment_summary.iterrows():
+    logger.info(f"{row['layer']}: F1 {row['f1']:.3f}, {row['split']} split, {row['merged']} merged, {row['missed']} missed of {row['num_reference']} curated objects")
+
+# save to csv and results database
+objects.to_csv(f'{output_folder}object_agreement.csv')
+summaries.to_csv(f'{output_folder}image_agreement.csv')
+experiment_summary.to_csv(f'{output_folder}experiment_agreement.csv')
+condition_summary.to_csv(f'{output_folder}condition_agreement.csv')
+append_results(summaries, 'chaperone_segmentation_qc', experiment)
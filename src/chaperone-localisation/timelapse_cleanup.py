@@ -0,0 +1,49 @@
+import os
+import re
+import skimage.io
+
+from loguru import logger
+
+from utilities.chunked import concatenate_stack, file_shape, open_stack, read_array
+from utilities.manifest import build_manifest, save_manifest, dataset_folder_name
+
+logger.info('Import OK')
+
+# define location parameters
+# each movie is a folder named as for exported single images (e.g. 'Project.lif - DMSO_Hsp70_1'), holding one (rows, columns, channels) TIF per timepoint numbered in the filename (e.g. 't003.tif')
+input_path = 'data/example_chaperone-localisation/'
+movie_folder = f'{input_path}timelapse/'
+output_folder = f'results/chaperone_localisation/timelapse/'
+image_folder = f'results/chaperone_localisation/initial_cleanup/'
+manifest_path = f'results/chaperone_localisation/manifest.csv'
+
+for folder in [output_folder, image_folder]:
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+
+def frame_number(filename):
+    """Timepoint of an exported frame, taken from the last number in its filename"""
+    return int(re.findall(r'\d+', filename)[-1])
+
+
+# --------------stack movies--------------
+# frames are combined into (timepoints, rows, columns, channels) stacks, written to disk one frame at a time as for FRAP stacks
+# timepoints are the first axis so each frame is a single contiguous block of the file when read by timelapse_ratios.py
+movie_names = sorted(folder for folder in os.listdir(movie_folder) if os.path.isdir(f'{movie_folder}{folder}'))
+for folder in movie_names:
+    frames = sorted((filename for filename in os.listdir(f'{movie_folder}{folder}') if '.tif' in filename), key=frame_number)
+    if not frames:
+        logger.info(f'{folder} not processed as no frames found')
+        continue
+    movie_name = folder.replace('.lif - ', '_').replace('_5x-', '_')
+    shape = concatenate_stack([f'{movie_folder}{folder}/{filename}' for filename in frames], f'{output_folder}{movie_name}.npy', load=lambda path: read_array(path)[None], axis=0, shape=lambda path: (1, ) + file_shape(path))
+
+    # the first frame is saved alongside single images, so cellpose (1_cellpose.py) and mask review (2_define_masks.py) define the compartments timelapse_ratios.py propagates
+    skimage.io.imsave(f'{image_folder}{movie_name}.tif', open_stack(f'{output_folder}{movie_name}.npy')[0], check_contrast=False)
+    logger.info(f'{movie_name} stacked with shape {shape}')
+
+# re-index cleaned images to include first frames, as in 0_initial_cleanup.py
+save_manifest(
+    build_manifest(image_folder, metadata_cols=['treatment', 'chaperone', 'image_number'], dataset=dataset_folder_name(input_path)),
+    manifest_path)
@@ -0,0 +1,65 @@
+import os
+
+from loguru import logger
+
+from utilities.chunked import open_stack
+from utilities.compartments import load_compartments
+from utilities.timelapse import timelapse_ratios
+
+logger.info('Import OK')
+
+# define location parameters
+# time-lapse stacks are (timepoints, rows, columns, channels) '.npy' arrays from timelapse_cleanup.py
+# compartment masks for the first frame of each movie (saved with the cleaned images by timelapse_cleanup.py) are defined as for single images (1_cellpose.py, 2_define_masks.py), in a folder named for the movie
+movie_folder = f'results/chaperone_localisation/timelapse/'
+mask_folder = f'results/chaperone_localisation/napari_masking/'
+output_folder = f'results/chaperone_localisation/timelapse_ratios/'
+
+# channel 0: Hoechst
+# channel 1: Htt cyto
+# channel 2: Htt incl
+# channel 3: Alexa647 ----> chaperone, used for nuc/cyto ratios
+quant_channel = 3
+# masks follow drift of the Hoechst channel, set to None for static fields
+register_channel = 0
+# re-segment cells and nuclei with cellpose every N frames, where cells inherit the number of the tracked cell they overlap. None propagates first-frame masks only
+resegment_every = None
+
+if not os.path.exists(output_folder):
+    os.mkdir(output_folder)
+
+
+def cellpose_frame_segmenter():
+    """Load cyto and nuclei models once, returning a function segmenting cells (Alexa647) and nuclei (Hoechst) in a single frame"""
+    from cellpose import models
+    cyto_model = models.Cellpose(model_type='cyto')
+    nuclei_model = models.Cellpose(model_type='nuclei')
+
+    def segment(frame):
+        cells = cyto_model.eval([frame[:, :, 3]], diameter=100, channels=[0, 0])[0][0]
+        nuclei = nuclei_model.eval([frame[:, :, 0]], diameter=100, channels=[0, 0], resample=True)[0][0]
+        return cells, nuclei
+
+    return segment
+
+
+# --------------Initialise file lists--------------
+movie_names = sorted(filename.replace('.npy', '') for filename in os.listdir(movie_folder) if filename.endswith('.npy'))
+segment_fn = cellpose_frame_segmenter() if resegment_every else None
+
+# ---------------stream per-frame ratios---------------
+# stack format is [cytoplasm, aggregate, nucleus], where each layer is labelled by cell number
+for movie_name in movie_names:
+    try:
+        mask_stack = load_compartments(f'{mask_folder}{movie_name}/')
+    except FileNotFoundError:
+        logger.info(f'{movie_name} not processed as no mask found')
+        continue
+    # only the frame being processed is read from the memory-mapped stack
+    stack = open_stack(f'{movie_folder}{movie_name}.npy')
+    output_path = f'{output_folder}{movie_name}.csv'
+    for timepoint_ratios in timelapse_ratios(stack, mask_stack, ['cytoplasm', 'aggregate', 'nucleus'], quant_channel=quant_channel, register_channel=register_channel, segment_fn=segment_fn, resegment_every=resegment_every):
+        timepoint_ratios.insert(0, 'movie_name', movie_name)
+        # append each frame as it is processed, writing the header with the first frame
+        timepoint_ratios.to_csv(output_path, mode='w' if timepoint_ratios['timepoint'].iloc[0] == 0 else 'a', header=bool(timepoint_ratios['timepoint'].iloc[0] == 0), index=False)
+    logger.info(f'Ratios saved for {stack.shape[0]} timepoints of {movie_name}')
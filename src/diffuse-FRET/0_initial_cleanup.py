@@ -6,6 +6,7 @@ import skimage.io
 
 
 from loguru import logger
+from utilities.manifest import build_manifest, save_manifest, dataset_folder_name
 logger.info('Import ok')
 
 def jarvis(input_path, output_path):
@@ -39,5 +40,11 @@ def jarvis(input_path, output_path):
 
 if __name__ == "__main__":
 
-    jarvis(input_path='data/example_diffuse-FRET/',
+    input_path = 'data/example_diffuse-FRET/'
+    jarvis(input_path=input_path,
            output_path='results/example_diffuse-FRET/initial_cleanup/')
+
+    # index cleaned images once, with metadata parsed from filenames, for all later stages
+    save_manifest(
+        build_manifest('results/example_diffuse-FRET/initial_cleanup/', metadata_cols=['mutant', 'target', 'image_number'], dataset=dataset_folder_name(input_path)),
+        'results/example_diffuse-FRET/manifest.csv')
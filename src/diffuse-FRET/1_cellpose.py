@@ -10,10 +10,28 @@ from cellpose import models
 from cellpose import plot
 import collections
 
+from utilities.label_store import save_label_store
+from utilities.manifest import load_manifest
+from utilities.prefetch import prefetch
+from utilities.segmentation import segment_tiled, watershed_segment, apply_watershed, backend_report, spot_segment, apply_spots
+from utilities.image_cache import read_image
+
 
 input_folder = f'results/example_diffuse-FRET/initial_cleanup/'
+manifest_path = f'results/example_diffuse-FRET/manifest.csv'
 output_folder = f'results/example_diffuse-FRET/cellpose_masking/'
 
+# segment large tiled/mosaic acquisitions tile-by-tile, stitching labels across tile seams
+# flows are not stitched, so cellpose results are not visualised in tiled mode
+tiled = False
+
+# segmentation backend for each channel, either 'cellpose' or 'watershed' (classical smoothing, threshold and seeded watershed, requiring no model weights)
+# inclusions can also use 'spots' (multi-scale LoG spot detection with region growing, applied to batches of images)
+backends = {'cyto': 'cellpose', 'nuclei': 'cellpose', 'inclusions': 'cellpose'}
+# compare throughput and agreement of the watershed (and for inclusions, spots) backend against cellpose for the first validation_size images of each channel
+backend_validation = False
+validation_size = 3
+
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
@@ -26,6 +44,41 @@ def apply_cellpose(images, image_type='cyto', channels=[0,0], diameter=None):
     masks, flows, styles, diams = model.eval(images, diameter=diameter, channels=channels)
     return masks, flows, styles, diams
 
+def apply_cellpose_tiled(images, image_type='cyto', channels=[0,0], diameter=None, tile_size=2048, overlap=256, max_workers=1):
+    """Apply model to list of large (e.g. mosaic) images tile-by-tile, stitching tile labels into a single label image per image. Returns masks only, as flows are not stitched.
+    - overlap (pixels) should exceed the largest expected object diameter
+    - images can be memory-mapped arrays, in which case only the tiles currently being segmented are held in memory
+    """
+    model = models.Cellpose(model_type=image_type)
+
+    def segment_tile(tile):
+        masks, flows, styles, diams = model.eval([tile], diameter=diameter, channels=channels)
+        return masks[0]
+
+    return [segment_tiled(image, segment_tile, tile_size=tile_size, overlap=overlap, max_workers=max_workers) for image in images]
+
+def cellpose_segmenter(image_type='cyto', channels=[0,0], diameter=None):
+    """Load model once and return a function segmenting a single image"""
+    model = models.Cellpose(model_type=image_type)
+
+    def segment(image):
+        masks, flows, styles, diams = model.eval([image], diameter=diameter, channels=channels)
+        return masks[0]
+
+    return segment
+
+def write_backend_report(images, channel, image_type='cyto', diameter=None, spots=False, **kwargs):
+    """Compare watershed (and spots if spots) against cellpose for the first validation_size images, saving the report to backend_report_{channel}.csv"""
+    segmenters = {
+        'cellpose': cellpose_segmenter(image_type=image_type, diameter=diameter, **kwargs),
+        'watershed': lambda image: watershed_segment(image, diameter=diameter),
+    }
+    if spots:
+        segmenters['spots'] = lambda image: spot_segment(image, diameter=diameter)
+    report = backend_report(images[:validation_size], segmenters, reference='cellpose', image_names=img_names[:validation_size])
+    report.to_csv(f'{output_folder}backend_report_{channel}.csv')
+    return report
+
 def visualise_cell_pose(images, masks, flows, channels=[0,0]):
     """Display cellpose results for each image
     """
@@ -40,35 +93,32 @@ def visualise_cell_pose(images, masks, flows, channels=[0,0]):
 
 def edge_filter(mask):
     """Collect boundary pixel values for all edges, return unique values
-    which correspond to cells that are touching/over the edge boundaries""" 
-    size = mask.shape[0]
-    edge_1_cells = set(list(mask[0:1, 0:size].flatten()))
-    edge_2_cells = set(list(mask[0:size, (size-1):size].flatten()))
-    edge_3_cells = set(list(mask[(size-1):size, 0:size].flatten()))
-    edge_4_cells = set(list(mask[0:size, 0:1].flatten()))
-    return edge_1_cells | edge_2_cells | edge_3_cells | edge_4_cells
+    which correspond to cells that are touching/over the edge boundaries. Handles non-square (e.g. stitched mosaic) masks""" 
+    edges = np.concatenate([mask[0, :], mask[:, -1], mask[-1, :], mask[:, 0]])
+    return set(np.unique(edges).tolist())
 
 def size_filter(mask, lower_size=1500, upper_size=10000):
     """Collect cells that are outside the cell size bounds as those to
     be excluded""" 
-    cell_size = dict(collections.Counter(mask.flatten()))
+    cell_size = np.bincount(mask.ravel())
     bs_cells = [
         cell_number
-        for cell_number, cell_size in cell_size.items()
-        if cell_size < lower_size or cell_size > upper_size
+        for cell_number, size in enumerate(cell_size)
+        if size > 0 and (size < lower_size or size > upper_size)
     ]
 
     return set(bs_cells)
 
 # --------------------------------------Initialise file list--------------------------------------
 
-file_list = [filename for filename in os.listdir(input_folder) if '.tif' in filename]
+manifest = load_manifest(manifest_path)
 
 # reading in all channels for each image, and transposing to correct dimension of array
-imgs = [skimage.io.imread(f'{input_folder}{filename}').transpose(1, 2, 0) for filename in file_list]
+# images are decoded in parallel on background threads
+imgs = [image for image_path, image in prefetch(manifest['image_path'], lambda image_path: read_image(image_path).transpose(1, 2, 0))]
 
 # clean filenames
-img_names = [filename.replace('.tif', '') for filename in file_list]
+img_names = manifest['image_name'].tolist()
 
 # -----------------------Complete cellpose with cytoplasm channel---------------------------------
 # channel 0: Venus ----> use this for making masks
@@ -81,24 +131,50 @@ img_names = [filename.replace('.tif', '') for filename in file_list]
 cytoplasm_images = [image[:, :, 0] for image in imgs]
 plt.imshow(cytoplasm_images[0])
 
-# Apply cellpose then visualise
-masks, flows, styles, diams = apply_cellpose(cytoplasm_images, image_type='cyto', diameter=50)
-visualise_cell_pose(cytoplasm_images, masks, flows, channels=[0, 0])
+# Apply cellpose (or watershed) then visualise
+if backend_validation:
+    write_backend_report(cytoplasm_images, 'cyto', image_type='cyto', diameter=50)
+
+if backends['cyto'] == 'watershed':
+    masks = apply_watershed(cytoplasm_images, diameter=50, tiled=tiled, overlap=128)
+elif tiled:
+    masks = apply_cellpose_tiled(cytoplasm_images, image_type='cyto', diameter=50, overlap=128)
+else:
+    masks, flows, styles, diams = apply_cellpose(cytoplasm_images, image_type='cyto', diameter=50)
+    visualise_cell_pose(cytoplasm_images, masks, flows, channels=[0, 0])
 
 # -----------------------If NES image, use inversion of venus channel to define nuclei---------------------------------
-nuc_masks, nuc_flows, nuc_styles, nuc_diams = apply_cellpose([65000 - array for array in cytoplasm_images], image_type='nuclei', diameter=20)
-visualise_cell_pose([65000 - array for array in cytoplasm_images], nuc_masks, nuc_flows, channels=[0, 0])
+if backend_validation:
+    write_backend_report([65000 - array for array in cytoplasm_images], 'nuclei', image_type='nuclei', diameter=20)
+
+if backends['nuclei'] == 'watershed':
+    nuc_masks = apply_watershed([65000 - array for array in cytoplasm_images], diameter=20, tiled=tiled, overlap=64)
+elif tiled:
+    nuc_masks = apply_cellpose_tiled([65000 - array for array in cytoplasm_images], image_type='nuclei', diameter=20, overlap=64)
+else:
+    nuc_masks, nuc_flows, nuc_styles, nuc_diams = apply_cellpose([65000 - array for array in cytoplasm_images], image_type='nuclei', diameter=20)
+    visualise_cell_pose([65000 - array for array in cytoplasm_images], nuc_masks, nuc_flows, channels=[0, 0])
 
 
 # -----------------------outline inclusions---------------------------------
 incl_images = [image[:, :, 4] for image in imgs]
 plt.imshow(incl_images[0])
-incl_masks, incl_flows, incl_styles, incl_diams = apply_cellpose(incl_images, image_type='nuclei', diameter=20)
-visualise_cell_pose(incl_images, incl_masks, incl_flows, channels=[0, 0])
+if backend_validation:
+    write_backend_report(incl_images, 'inclusions', image_type='nuclei', diameter=20, spots=True)
+
+if backends['inclusions'] == 'watershed':
+    incl_masks = apply_watershed(incl_images, diameter=20, tiled=tiled, overlap=64)
+elif backends['inclusions'] == 'spots':
+    incl_masks = apply_spots(incl_images, diameter=20)
+elif tiled:
+    incl_masks = apply_cellpose_tiled(incl_images, image_type='nuclei', diameter=20, overlap=64)
+else:
+    incl_masks, incl_flows, incl_styles, incl_diams = apply_cellpose(incl_images, image_type='nuclei', diameter=20)
+    visualise_cell_pose(incl_images, incl_masks, incl_flows, channels=[0, 0])
 
 
 
-# save associated cell mask arrays
-np.save(f'{output_folder}cellpose_masks.npy', masks)
-np.save(f'{output_folder}cellpose_nuclei.npy', nuc_masks)
-np.save(f'{output_folder}cellpose_inclusions.npy', incl_masks)
+# save associated cell mask arrays, keyed by image name
+save_label_store(f'{output_folder}cellpose_masks.npz', dict(zip(img_names, masks)))
+save_label_store(f'{output_folder}cellpose_nuclei.npz', dict(zip(img_names, nuc_masks)))
+save_label_store(f'{output_folder}cellpose_inclusions.npz', dict(zip(img_names, incl_masks)))
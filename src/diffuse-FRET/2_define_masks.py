@@ -13,106 +13,117 @@ from skimage.morphology import closing, square, remove_small_objects
 
 from loguru import logger
 
+from utilities.label_store import load_labels, save_mask, load_mask, mask_exists
+from utilities.compartments import derive_compartments, compartment_stack, save_compartments
+from utilities.manifest import load_manifest
+from utilities.review import ReviewSession
+from utilities.pyramid import build_pyramid, open_pyramid, pyramid_layer, pyramid_current
+from utilities.image_cache import read_image
+
 image_folder = f'results/example_diffuse-FRET/initial_cleanup/'
 mask_folder = f'results/example_diffuse-FRET/cellpose_masking/'
 output_folder = f'results/example_diffuse-FRET/napari_masking/'
+manifest_path = f'results/example_diffuse-FRET/manifest.csv'
+pyramid_folder = f'results/example_diffuse-FRET/pyramids/'
+
+# review images from cached multiscale pyramids, so only the visible region and resolution is read
+use_pyramids = False
 
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
-def filter_masks(image_stack, image_name, mask_stack):
-
-    barnase = mask_stack[0, :, :].copy()
-    # Setting nuc masks and agg masks to single value so they are same colour
-    # easier to identify when editing masks
-    # user will relabel with matching numbers to corresponding cells
-    nuc_mask = np.where(mask_stack[1, :, :].copy() != 0, 200, 0)
-    incl = np.where(mask_stack[2, :, :].copy() != 0, 100, 0)
-
-    with napari.gui_qt():
-        # create the viewer and add the image
-        viewer = napari.view_image(image_stack, name='image_stack')
-        # add the labels
-        viewer.add_labels(barnase, name='barnase')
-        viewer.add_labels(incl, name='aggregates')
-        viewer.add_labels(nuc_mask, name='mask_features')
-        
-        """
-        - Select the cell layer and using the fill tool set to 0, remove all unwanted cells.
-        - Repeat with the inclusions and mask_features layer.
-        - Next, select the cell layer and reassign each cell of interest sequentially using the fill tool so that cells are numbered 1 --> n.
-        - Repeat with inclusions and mask_features layer, such that inclusion and feature labels correspond to the cell number of interest.
-        - Finally, using the brush tool add or adjust any additional features (e.g. Barnase inclusions not associated with incl should be added to the mask_features layer to be removed from diffuse Barnase).
-        """
-    # collect shapes from inclusions into labels --> can this be coloured easily?
-
-    np.save(f'{output_folder}{image_name}_mask.npy', np.stack([barnase, incl, nuc_mask]))
+def mask_layers(image_name):
+    """Layers for reviewing one image, read only when the image is shown"""
+    if use_pyramids:
+        image_stack, image_kwargs = pyramid_layer(open_pyramid(f'{pyramid_folder}{image_name}/'))
+    else:
+        image_stack, image_kwargs = read_image(image_paths[image_name]), {}
+    if mask_exists(f'{output_folder}{image_name}_mask'):
+        # previously curated masks are reviewed in place of raw cellpose labels, so they are never replaced by unedited raw masks
+        barnase, incl, nuc_mask = [np.array(layer) for layer in load_mask(f'{output_folder}{image_name}_mask')]
+    else:
+        mask_stack = raw_masks(image_name)
+
+        barnase = mask_stack[0, :, :].copy()
+        # Setting nuc masks and agg masks to single value so they are same colour
+        # easier to identify when editing masks
+        # user will relabel with matching numbers to corresponding cells
+        # stored in the cell label dtype rather than int64, which still allows relabelling to any cell number
+        nuc_mask = np.where(mask_stack[1, :, :] != 0, 200, 0).astype(barnase.dtype)
+        incl = np.where(mask_stack[2, :, :] != 0, 100, 0).astype(barnase.dtype)
+
+    return [
+        ('image_stack', 'image', image_stack, image_kwargs),
+        ('barnase', 'labels', barnase, {}),
+        ('aggregates', 'labels', incl, {}),
+        ('mask_features', 'labels', nuc_mask, {}),
+    ]
+
+
+def save_filtered(image_name, layers):
+    """
+    - Select the cell layer and using the fill tool set to 0, remove all unwanted cells.
+    - Repeat with the inclusions and mask_features layer.
+    - Next, select the cell layer and reassign each cell of interest sequentially using the fill tool so that cells are numbered 1 --> n.
+    - Repeat with inclusions and mask_features layer, such that inclusion and feature labels correspond to the cell number of interest.
+    - Finally, using the brush tool add or adjust any additional features (e.g. Barnase inclusions not associated with incl should be added to the mask_features layer to be removed from diffuse Barnase).
+    - Move to the next image with PageDown (edited images, and images without a saved mask, are saved automatically), or back with PageUp. Closing the viewer saves the current image.
+    """
+    mask_stack = np.stack([layers['barnase'], layers['aggregates'], layers['mask_features']])
+    save_mask(f'{output_folder}{image_name}_mask', mask_stack)
     logger.info(f'Processed {image_name}. Mask saved to {output_folder}{image_name}')
 
-    return np.stack([barnase, incl, nuc_mask])
+    return mask_stack
 
 
 # --------------Initialise file list--------------
 
-# reading in all images, and transposing to correct dimension of array
-file_list = [filename for filename in os.listdir(image_folder) if '.tif' in filename]
-images = {filename.replace('.tif', ''): skimage.io.imread(f'{image_folder}{filename}') for filename in file_list}
+# images are read only when reviewed
+manifest = load_manifest(manifest_path)
+image_paths = dict(manifest[['image_name', 'image_path']].values)
 
 # with napari.gui_qt():
-#     viewer = napari.view_image(images.values()[0])
+#     viewer = napari.view_image(read_image(list(image_paths.values())[0]))
 
 # ----------read in masks----------
-wholecell = np.load(f'{mask_folder}cellpose_masks.npy')
-nucleus = np.load(f'{mask_folder}cellpose_nuclei.npy')
-incl = np.load(f'{mask_folder}cellpose_inclusions.npy')
-
-# interleave masks to create single stack per image
-raw_masks = {}
-for x, image_name in (enumerate(images.keys())):
-    raw_masks[image_name] = np.stack([wholecell[x, :, :], nucleus[x, :, :], incl[x, :, :]])
+# masks are read for one image at a time from the name-indexed label stores
+def raw_masks(image_name):
+    return np.stack([
+        load_labels(f'{mask_folder}{layer}', image_name, image_names=list(image_paths.keys()))
+        for layer in ['cellpose_masks', 'cellpose_nuclei', 'cellpose_inclusions']])
+
+# optionally build pyramids once for all images, which are reused on later runs until the image changes
+if use_pyramids:
+    for image_name, image_path in image_paths.items():
+        # cached pyramids are checked against the image file before it is decoded
+        if not pyramid_current(f'{pyramid_folder}{image_name}/', source=image_path):
+            build_pyramid(read_image(image_path), f'{pyramid_folder}{image_name}/', source=image_path)
 
 # Manually filter masks, label according to grouped features (i.e. one cell, nucleus (optional) and inclusion per cell of interest, with individual labels)
-filtered_masks = {}
-for image_name, image_stack in images.items():
-    mask_stack = raw_masks[image_name].copy()
-    filtered_masks[image_name] = filter_masks(image_stack, image_name, mask_stack)
+# all images are reviewed in a single viewer, see save_filtered for instructions
+filtered_masks = ReviewSession(list(image_paths.keys()), load_item=mask_layers, save_item=save_filtered, needs_save=lambda image_name: not mask_exists(f'{output_folder}{image_name}_mask'), title='filter masks').run()
 
 # # to reprocess individual images:
-# filtered_masks = {}
 # images_to_process = ['WT_compiled_8']
-# for image_name, image_stack in images.items():
-#     if image_name in images_to_process:
-#         mask_stack = raw_masks[image_name].copy()
-#         # remove existing masks
-#         if os.path.exists(f'{output_folder}{image_name}/'):
-#             shutil.rmtree(f'{output_folder}{image_name}/') 
-#         filtered_masks[image_name] = filter_masks(image_stack, image_name, mask_stack)
+# for image_name in images_to_process:
+#     # remove existing masks
+#     if os.path.exists(f'{output_folder}{image_name}/'):
+#         shutil.rmtree(f'{output_folder}{image_name}/')
+# filtered_masks = ReviewSession(images_to_process, load_item=mask_layers, save_item=save_filtered, needs_save=lambda image_name: not mask_exists(f'{output_folder}{image_name}_mask'), title='filter masks').run()
 
 # # To reload previous masks for per-cell extraction
-filtered_masks = {masks.replace('_mask.npy', ''): np.load(f'{output_folder}{masks}') for masks in os.listdir(f'{output_folder}') if '.npy' in masks}
+filtered_masks = {image_name: load_mask(f'{output_folder}{image_name}_mask') for image_name in manifest['image_name'] if mask_exists(f'{output_folder}{image_name}_mask')}
 
-# For each set of masks, separate according to cell number
+# For each set of masks, derive compartments for all cells at once, labelled by cell number
+compartment_names = ['cytoplasm', 'aggregate', 'unmasked']
 final_masks = {}
-for image_name, image in images.items():
-    image_name
-    mask_stack = filtered_masks[image_name].copy()
-    # plt.imshow(cyto_mask+nuc_mask)
-    for cell_number in np.unique(mask_stack[0, :, :]):
-        logger.info(cell_number)
-        if cell_number > 0:
-            whole_cell = np.where(mask_stack[0, :, :] == cell_number, 1, 0)
-            mask = np.where(mask_stack[2, :, :] == cell_number, 1, 0)
-            aggregates = np.where(mask_stack[1, :, :] == cell_number, 1, 0)
-            barnase = np.where(mask == 0, whole_cell, 0)
-            barnase = np.where(aggregates == 0, barnase, 0)
-            final_masks[(image_name, cell_number)] = np.stack([barnase, aggregates, np.where(mask == 0, whole_cell, 0)])
+for image_name in filtered_masks.keys():
+    mask_stack = filtered_masks[image_name]
+    compartments = derive_compartments(cells=mask_stack[0, :, :], aggregates=mask_stack[1, :, :], nuclei=mask_stack[2, :, :], match='label')
+    final_masks[image_name] = compartment_stack(compartments, compartment_names)
+    logger.info(f'Compartments derived for {len(np.unique(mask_stack[0, :, :])) - 1} cells in {image_name}')
 
 # ------------------save arrays------------------
-for (image_name, cell_number), array_stack in final_masks.items():
-
-    #create folder for each image output
-    if not os.path.exists(f'{output_folder}{image_name}/'):
-        os.makedirs(f'{output_folder}{image_name}/')
-    
-    # save associated cell mask arrays
-    np.save(f'{output_folder}{image_name}/cell_{int(cell_number)}.npy', array_stack)
\ No newline at end of file
+# one compartment label stack per image (stack format is [cytoplasm, aggregate, unmasked]) with cell index
+for image_name, array_stack in final_masks.items():
+    save_compartments(f'{output_folder}{image_name}/', array_stack, compartment_names)
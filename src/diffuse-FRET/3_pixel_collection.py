@@ -4,7 +4,11 @@ import pandas as pd
 import skimage.io
 import functools
 
-from utilities.pixel_operations import pixel_collector
+from utilities.compartments import load_compartments
+from utilities.pixel_operations import label_pixel_collector
+from utilities.prefetch import prefetch
+from utilities.manifest import load_manifest
+from utilities.image_cache import read_image
 
 from loguru import logger
 
@@ -14,23 +18,25 @@ logger.info('Import OK')
 image_folder = f'results/example_diffuse-FRET/initial_cleanup/'
 mask_folder = f'results/example_diffuse-FRET/napari_masking/'
 output_folder = f'results/example_diffuse-FRET/pixel_collection/'
+manifest_path = f'results/example_diffuse-FRET/manifest.csv'
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
 
 # --------------Initialise file lists--------------
-# reading in all images, and transposing to correct dimension of array
-images = { image_name.replace('.tif', ''): skimage.io.imread(f'{image_folder}{image_name}').transpose(1, 2, 0) for image_name in os.listdir(f'{image_folder}') if '.tif' in image_name}
+# collect image names - images are read one at a time during pixel collection, with the next images decoded in the background
+manifest = load_manifest(manifest_path)
+image_names = manifest['image_name'].tolist()
 
 # read in masks
-# - remember that stack format is [barnase, aggregates]
+# - remember that stack format is [barnase, aggregates, unmasked], where each layer is labelled by cell number
 masks = {}
-for image_name in images.keys():
+for image_name in image_names:
     logger.info(f'Processing {image_name}')
     try:
-        masks[f'{image_name}'] = {cell.replace('.npy', ''): np.load(f'{mask_folder}{image_name}/{cell}') for cell in os.listdir(f'{mask_folder}{image_name}/')}
-        logger.info(f'Masks loaded for {len(masks[f"{image_name}"].keys())} cells')
+        masks[f'{image_name}'] = load_compartments(f'{mask_folder}{image_name}/')
+        logger.info(f'Masks loaded for {len(np.unique(masks[f"{image_name}"])) - 1} cells')
     except:
         logger.info(f'{image_name} not processed as no mask found')
 
@@ -40,27 +46,27 @@ for image_name in images.keys():
 # image_test_name = 'WT_1'
 # with napari.gui_qt():
 #     viewer = napari.Viewer()
-#     viewer.add_image(images[image_test_name][:, :, 0], name='raw_image')
-#     viewer.add_labels(masks[f'{image_test_name}']['cell_1'][0, :, :], name='barnase')
-#     viewer.add_labels(masks[f'{image_test_name}']['cell_1'][1, :, :], name='aggregate')
+#     viewer.add_image(read_image(f'{image_folder}{image_test_name}.tif')[0, :, :], name='raw_image')
+#     viewer.add_labels(masks[f'{image_test_name}'][0, :, :], name='barnase')
+#     viewer.add_labels(masks[f'{image_test_name}'][1, :, :], name='aggregate')
 
 # ---------------collect pixel information---------------
 pixel_information = {}
-for image_name in masks.keys():
+for image_name, image in prefetch(list(masks.keys()), lambda image_name: read_image(f'{image_folder}{image_name}.tif').transpose(1, 2, 0)):
     logger.info(f'Processing {image_name}')
-    image = images[image_name].copy()
+    mask_stack = masks[image_name]
     pixels = []
     for channel in range(image.shape[2]):
-        image_array = image[:, :, channel].copy()
-        for cell, mask_stack in masks[image_name].items():
-            # for each cell, collect barnase and aggregate pixels
-            cell_pixels = pd.concat([pixel_collector(image_array, mask_stack[i, :, :], visualise=False, mask_type=mask_type) for i, mask_type in enumerate(['barnase', 'aggregate', 'unmasked'])])
-            # add identifiers
-            cell_pixels['channel'] = channel
-            cell_pixels['cell'] = f'{image_name}_{cell}'
-            pixels.append(cell_pixels)
+        image_array = image[:, :, channel]
+        # collect barnase, aggregate and unmasked pixels for all cells at once
+        for i, mask_type in enumerate(['barnase', 'aggregate', 'unmasked']):
+            compartment_pixels = label_pixel_collector(image_array, mask_stack[i, :, :], mask_type=mask_type)
+            compartment_pixels['channel'] = channel
+            pixels.append(compartment_pixels)
     pixels = pd.concat(pixels)
-    pixel_information[image_name] = pixels
+    # add identifiers
+    pixels['cell'] = pixels['label'].map({label: f'{image_name}_cell_{label}' for label in pixels['label'].unique()})
+    pixel_information[image_name] = pixels.drop('label', axis=1)
 logger.info('Completed pixel collection')
 
 # save to csv
@@ -3,46 +3,76 @@ import pandas as pd
 
 from loguru import logger
 
+from utilities.manifest import load_manifest, cell_manifest, dataset_name
+from utilities.incremental import update_partials, moment_partials, combine_moments
+from utilities.results_db import append_results
+from utilities.statistics import condition_statistics, pairwise_permutation_tests
+
 logger.info('Import OK')
 
 # define location parameters, assign number of frames for pre- and bleach portions
 input_folder = f'results/example_diffuse-FRET/pixel_collection/'
+mask_folder = f'results/example_diffuse-FRET/napari_masking/'
 output_folder = f'results/example_diffuse-FRET/summary_calculations/'
+partial_folder = f'results/example_diffuse-FRET/summary_calculations/partials/'
+manifest_path = f'results/example_diffuse-FRET/manifest.csv'
 
+# number of bootstrap resamples and permutations used for per-condition statistics
+num_resamples = 10000
 fret_channel = 3
 overlap_threshold = 0.5
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
-# read in calculated pixel data
-file_list = [filename for filename in os.listdir(input_folder) if '.csv' in filename]
-pixels = {filename.replace('.csv', ''): pd.read_csv(f'{input_folder}{filename}') for filename in file_list}
-pixels.update({key: value.drop([col for col in value.columns.tolist() if 'Unnamed: ' in col], axis=1) for key, value in pixels.items()})
-
-# generate summary df, collect only channel of interest
-pixels_compiled = pd.concat(pixels.values())
-pixels_compiled = pd.pivot_table(pixels_compiled, index=['x', 'y', 'mask_type', 'cell'], columns=['channel'], values=['intensity']).reset_index()
-pixels_compiled.columns = ['_'.join([str(val) for val in x]) if type(x[1]) == int else x[0] for x in pixels_compiled.columns]
-
-# Add label if aggregate inside unmasked (i.e. same compartment)
-aggregate_cells = pixels_compiled[pixels_compiled['mask_type'] == 'aggregate']['cell'].unique()
-aggregate_pixels = pixels_compiled[pixels_compiled['cell'].isin(aggregate_cells)]
-aggregate_labels = {}
-for cell, df in aggregate_pixels.groupby('cell'):
-    agg_loc = set(tuple(zip(df[df['mask_type'] == 'aggregate']['x'], df[df['mask_type'] == 'aggregate']['y'])))
-    barnase_loc = set(tuple(zip(df[df['mask_type'] == 'unmasked']['x'], df[df['mask_type'] == 'unmasked']['y'])))
-    logger.info(len(agg_loc.intersection(barnase_loc)) / len(agg_loc))
-    aggregate_labels[cell] = (round(len(agg_loc.intersection(barnase_loc)) / len(agg_loc), 2), 'inside' if len(agg_loc.intersection(barnase_loc)) / len(agg_loc) > overlap_threshold else 'outside')
-
-# generate mean values for each ROI for each timepoint
-pixels_mean = pixels_compiled.copy().groupby(['cell', 'mask_type']).mean().reset_index()
-
-# assign identifiers
-pixels_mean[['mutant', 'target', 'image_number', 'discard', 'cell_number']] = pixels_mean['cell'].str.split('_', expand=True)
-pixels_mean.drop('discard', axis=1, inplace=True)
-pixels_mean[['overlap', 'agg_location']] = pd.DataFrame(pixels_mean['cell'].map(aggregate_labels).tolist(), index=pixels_mean.index)  
-pixels_mean['agg_location'] = ['None' if entry == None else entry for entry in pixels_mean['agg_location']]
+# pixel data for each image
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+sources = {image_name: f'{input_folder}{image_name}.csv' for image_name in manifest['image_name'] if os.path.exists(f'{input_folder}{image_name}.csv')}
+
+def image_partials(image_name):
+    """Mergeable per-cell, per-compartment pixel counts, sums and sums of squares for one image, with aggregate overlap for each cell"""
+    pixels = pd.read_csv(sources[image_name])
+    pixels = pixels.drop([col for col in pixels.columns.tolist() if 'Unnamed: ' in col], axis=1)
+
+    # generate summary df, one intensity column per channel
+    pixels_compiled = pd.pivot_table(pixels, index=['x', 'y', 'mask_type', 'cell'], columns=['channel'], values=['intensity']).reset_index()
+    pixels_compiled.columns = ['_'.join([str(val) for val in x]) if type(x[1]) == int else x[0] for x in pixels_compiled.columns]
+
+    # Add label if aggregate inside unmasked (i.e. same compartment)
+    aggregate_cells = pixels_compiled[pixels_compiled['mask_type'] == 'aggregate']['cell'].unique()
+    aggregate_pixels = pixels_compiled[pixels_compiled['cell'].isin(aggregate_cells)]
+    aggregate_labels = {}
+    for cell, df in aggregate_pixels.groupby('cell'):
+        agg_loc = set(tuple(zip(df[df['mask_type'] == 'aggregate']['x'], df[df['mask_type'] == 'aggregate']['y'])))
+        barnase_loc = set(tuple(zip(df[df['mask_type'] == 'unmasked']['x'], df[df['mask_type'] == 'unmasked']['y'])))
+        logger.info(len(agg_loc.intersection(barnase_loc)) / len(agg_loc))
+        aggregate_labels[cell] = (round(len(agg_loc.intersection(barnase_loc)) / len(agg_loc), 2), 'inside' if len(agg_loc.intersection(barnase_loc)) / len(agg_loc) > overlap_threshold else 'outside')
+
+    partials = moment_partials(pixels_compiled, ['cell', 'mask_type'], [col for col in pixels_compiled.columns if col not in ['mask_type', 'cell']])
+    partials['overlap'] = partials['cell'].map({cell: overlap for cell, (overlap, location) in aggregate_labels.items()})
+    partials['agg_location'] = partials['cell'].map({cell: location for cell, (overlap, location) in aggregate_labels.items()})
+    return partials
+
+# every cell belongs to a single image, so partials are only recalculated for new or changed images
+partials = update_partials(sources, image_partials, partial_folder, params=overlap_threshold)
+
+# generate mean values for each ROI
+value_cols = [col[:-len('_sum')] for col in partials.columns if col.endswith('_sum')]
+pixels_mean = combine_moments(partials, ['cell', 'mask_type'], value_cols)
+pixels_mean = pd.merge(pixels_mean, partials[['cell', 'overlap', 'agg_location']].drop_duplicates('cell'), on='cell', how='left')
+
+# assign identifiers from the cell manifest
+cells = cell_manifest(manifest, mask_folder)
+pixels_mean = pd.merge(pixels_mean, cells[['cell', 'image_name', 'mutant', 'target', 'image_number', 'cell_number']], on='cell', how='left')
+pixels_mean['agg_location'] = pixels_mean['agg_location'].fillna('None')
 
 # save to csv
 pixels_mean.to_csv(f'{output_folder}pixel_summary.csv')
+
+# per-condition FRET means and medians with bootstrap confidence intervals, and permutation tests between conditions in each compartment
+fret_statistics = condition_statistics(pixels_mean, f'intensity_{fret_channel}', ['mutant', 'target', 'mask_type'], num_resamples=num_resamples)
+fret_statistics.to_csv(f'{output_folder}fret_statistics.csv')
+fret_tests = pairwise_permutation_tests(pixels_mean, f'intensity_{fret_channel}', ['mutant', 'target'], within=['mask_type'], num_permutations=num_resamples)
+fret_tests.to_csv(f'{output_folder}fret_tests.csv')
+append_results(pixels_mean, 'fret_cells', experiment)
@@ -0,0 +1,100 @@
+import os
+import pandas as pd
+import skimage.io
+
+from loguru import logger
+
+from utilities.compartments import load_compartments
+from utilities.fret import channel_background, control_bleedthrough, fret_maps, label_means
+from utilities.label_store import load_labels
+from utilities.manifest import load_manifest, cell_manifest
+from utilities.image_cache import read_image
+
+logger.info('Import OK')
+
+# define location parameters
+image_folder = f'results/example_diffuse-FRET/initial_cleanup/'
+cellpose_folder = f'results/example_diffuse-FRET/cellpose_masking/'
+mask_folder = f'results/example_diffuse-FRET/napari_masking/'
+output_folder = f'results/example_diffuse-FRET/fret_maps/'
+manifest_path = f'results/example_diffuse-FRET/manifest.csv'
+
+# channel 0: Venus (acceptor)
+# channel 2: mTFP (donor)
+# channel 3: FRET
+acceptor_channel = 0
+donor_channel = 2
+fret_channel = 3
+
+# names (as in the manifest) of donor-only and acceptor-only control images, from which bleed-through coefficients are estimated within cells
+# leave empty to use the coefficients below, e.g. as previously determined for the same acquisition settings
+donor_controls = []
+acceptor_controls = []
+donor_bleedthrough = 0.0
+acceptor_bleedthrough = 0.0
+g_factor = 1.0
+
+if not os.path.exists(output_folder):
+    os.mkdir(output_folder)
+
+
+# --------------Initialise file lists--------------
+manifest = load_manifest(manifest_path)
+image_paths = dict(manifest[['image_name', 'image_path']].values)
+
+
+def controls_bleedthrough(control_names, reference_channel):
+    """Bleed-through into the FRET channel pooled over all cells of the named control images"""
+    controls = [(read_image(image_paths[image_name]).transpose(1, 2, 0), load_labels(f'{cellpose_folder}cellpose_masks', image_name)) for image_name in control_names]
+    return control_bleedthrough(controls, reference_channel, fret_channel)
+
+
+# ---------------estimate bleed-through from controls---------------
+if donor_controls:
+    donor_bleedthrough = controls_bleedthrough(donor_controls, donor_channel)
+    logger.info(f'Donor bleed-through of {donor_bleedthrough:.3f} estimated from {len(donor_controls)} controls')
+if acceptor_controls:
+    acceptor_bleedthrough = controls_bleedthrough(acceptor_controls, acceptor_channel)
+    logger.info(f'Acceptor bleed-through of {acceptor_bleedthrough:.3f} estimated from {len(acceptor_controls)} controls')
+if donor_bleedthrough == 0 and acceptor_bleedthrough == 0:
+    logger.warning('Donor and acceptor bleed-through are both 0, so FRET maps are not corrected for bleed-through. Provide donor_controls and acceptor_controls, or known coefficients.')
+
+# ---------------calculate FRET maps---------------
+summaries = []
+for image_name, image_path in manifest[['image_name', 'image_path']].values:
+    try:
+        mask_stack = load_compartments(f'{mask_folder}{image_name}/')
+    except:
+        logger.info(f'{image_name} not processed as no mask found')
+        continue
+    # reading in all channels, and transposing to correct dimension of array
+    image = read_image(image_path).transpose(1, 2, 0)
+
+    # background is estimated from pixels outside all (unfiltered) cells
+    cell_labels = load_labels(f'{cellpose_folder}cellpose_masks', image_name)
+    background = channel_background(image, cell_labels)[[donor_channel, acceptor_channel, fret_channel]]
+
+    maps = fret_maps(
+        donor=image[:, :, donor_channel], acceptor=image[:, :, acceptor_channel], fret=image[:, :, fret_channel],
+        donor_bleedthrough=donor_bleedthrough, acceptor_bleedthrough=acceptor_bleedthrough,
+        background=background, g_factor=g_factor)
+    for map_name, array in maps.items():
+        skimage.io.imsave(f'{output_folder}{image_name}_{map_name}.tif', array, check_contrast=False)
+
+    # per-cell summary for each compartment - remember that stack format is [barnase, aggregates, unmasked]
+    summary = pd.concat([label_means(maps, mask_stack[i, :, :], mask_type=mask_type) for i, mask_type in enumerate(['barnase', 'aggregate', 'unmasked'])])
+    summary['image_name'] = image_name
+    summary['cell_number'] = summary['label']
+    for channel_name, value in zip(['donor', 'acceptor', 'fret'], background):
+        summary[f'{channel_name}_background'] = value
+    summaries.append(summary.drop('label', axis=1))
+    logger.info(f'FRET maps calculated for {image_name}')
+
+summaries = pd.concat(summaries).reset_index(drop=True)
+
+# assign identifiers from the cell manifest
+cells = cell_manifest(manifest, mask_folder)
+summaries = pd.merge(summaries, cells[['image_name', 'cell_number', 'cell_id', 'cell', 'mutant', 'target', 'image_number']], on=['image_name', 'cell_number'], how='left')
+
+# save to csv
+summaries.to_csv(f'{output_folder}fret_summary.csv')
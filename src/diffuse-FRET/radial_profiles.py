@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+from utilities.compartments import load_compartments
+from utilities.image_cache import read_image
+from utilities.manifest import load_manifest, cell_manifest, dataset_name
+from utilities.prefetch import prefetch
+from utilities.radial import radial_profiles, eroded_statistics
+from utilities.results_db import append_results
+
+logger.info('Import OK')
+
+# define location parameters
+mask_folder = f'results/example_diffuse-FRET/napari_masking/'
+output_folder = f'results/example_diffuse-FRET/radial_profiles/'
+manifest_path = f'results/example_diffuse-FRET/manifest.csv'
+
+# channel 0: Venus
+# channel 2: mTFP
+# channel 3: FRET
+# channel 4: inclusions
+# no nuclear compartment is kept for FRET, so profiles are binned by distance (pixels) from the aggregate boundary, positive inside the aggregate
+bin_width = 2
+max_distance = 40
+# compartments are eroded by each depth (pixels) from their boundaries, excluding pixels at the cell edge and around masked features
+depths = [0, 1, 2, 4, 8]
+
+if not os.path.exists(output_folder):
+    os.mkdir(output_folder)
+
+
+# --------------Initialise file lists--------------
+manifest = load_manifest(manifest_path)
+experiment = dataset_name(manifest)
+image_paths = {image_name: image_path for image_name, image_path in manifest[['image_name', 'image_path']].values if os.path.exists(f'{mask_folder}{image_name}/')}
+
+# ---------------calculate profiles and eroded statistics---------------
+# stack format is [barnase, aggregates, unmasked], where each layer is labelled by cell number
+profiles, eroded = [], []
+for image_name, image in prefetch(list(image_paths.keys()), lambda image_name: read_image(image_paths[image_name]).transpose(1, 2, 0)):
+    mask_stack = load_compartments(f'{mask_folder}{image_name}/')
+    profile = radial_profiles(image, mask_stack.max(axis=0), mask_stack[1], bin_width=bin_width, max_distance=max_distance)
+    profile['image_name'] = image_name
+    profiles.append(profile)
+    statistics = eroded_statistics(image, mask_stack, ['barnase', 'aggregate', 'unmasked'], depths=depths)
+    statistics['image_name'] = image_name
+    eroded.append(statistics)
+    logger.info(f'Radial profiles calculated for {len(np.unique(mask_stack)) - 1} cells in {image_name}')
+profiles = pd.concat(profiles).rename(columns={'label': 'cell_number'}).reset_index(drop=True)
+eroded = pd.concat(eroded).rename(columns={'label': 'cell_number'}).reset_index(drop=True)
+
+# assign identifiers from the cell manifest
+cells = cell_manifest(manifest, mask_folder)[['image_name', 'cell_number', 'cell', 'mutant', 'target', 'image_number']]
+profiles, eroded = [pd.merge(df, cells, on=['image_name', 'cell_number'], how='left') for df in [profiles, eroded]]
+
+# save to csv and results database
+profiles.to_csv(f'{output_folder}radial_profiles.csv')
+eroded.to_csv(f'{output_folder}eroded_statistics.csv')
+append_results(profiles, 'fret_radial_profiles', experiment)
+append_results(eroded, 'fret_eroded_statistics', experiment)
@@ -0,0 +1,93 @@
+import numpy as np
+from scipy import ndimage
+from skimage.morphology import disk
+
+from utilities.chunked import map_chunks, reduce_chunks
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def otsu_thresholds(stack, nbins=256):
+    """Otsu threshold for every frame of an (H, W, T) stack, computed from all frame histograms at once.
+
+    Parameters
+    ----------
+    stack : 3D-array
+        image stack where the last dimension is timepoints
+    nbins : int, optional
+        number of histogram bins per frame, by default 256
+
+    Returns
+    -------
+    array
+        threshold for each frame
+    """
+    num_frames = stack.shape[-1]
+    frames = stack.reshape(-1, num_frames).astype(np.float64)
+    lower = frames.min(axis=0)
+    width = np.maximum(frames.max(axis=0) - lower, np.finfo(np.float64).eps) / nbins
+    bins = np.minimum(((frames - lower) / width).astype(np.int64), nbins - 1)
+
+    # one bincount over (frame, bin) gives the histogram of every frame
+    histograms = np.bincount((bins + np.arange(num_frames) * nbins).ravel(), minlength=num_frames * nbins).reshape(num_frames, nbins).astype(np.float64)
+    centres = lower[:, None] + width[:, None] * (np.arange(nbins)[None, :] + 0.5)
+
+    weight_below = np.cumsum(histograms, axis=1)
+    weight_above = weight_below[:, -1:] - weight_below
+    sum_below = np.cumsum(histograms * centres, axis=1)
+    sum_above = sum_below[:, -1:] - sum_below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between_variance = weight_below * weight_above * (sum_below / weight_below - sum_above / weight_above) ** 2
+    between_variance = np.nan_to_num(between_variance)
+    return centres[np.arange(num_frames), np.argmax(between_variance, axis=1)]
+
+
+def background_surface(stack, radius=25, memory_limit=None, out=None):
+    """Morphological (rolling-ball style) background estimate for every frame of an (H, W, T) stack, via a single grey opening with a flat disk of the given radius applied across all frames at once. If memory_limit (bytes) is provided, frames are processed in chunks and written to out, which may be memory-mapped."""
+    footprint = disk(radius)[:, :, None].astype(bool)
+    if memory_limit:
+        return map_chunks(stack, lambda values: ndimage.grey_opening(values, footprint=footprint), axis=-1, memory_limit=memory_limit, out=out)
+    return ndimage.grey_opening(stack, footprint=footprint)
+
+
+def frame_background(stack, method='percentile', percentile=5, radius=25, nbins=256, memory_limit=None):
+    """Automatically estimates background for every frame of an (H, W, T) stack in a single batched pass, as an alternative to a manually placed background ROI.
+
+    Parameters
+    ----------
+    stack : 3D-array
+        image stack where the last dimension is timepoints
+    method : str, optional
+        - 'percentile': the given percentile of each frame
+        - 'otsu': mean of pixels below the Otsu threshold of each frame
+        - 'morphological': median of the grey-opened (rolling-ball style) background surface of each frame
+        By default 'percentile'.
+    percentile : int, optional
+        percentile used by the 'percentile' method, by default 5
+    radius : int, optional
+        structuring element radius used by the 'morphological' method, which should exceed the largest bright feature, by default 25
+    nbins : int, optional
+        number of histogram bins used by the 'otsu' method, by default 256
+    memory_limit : int, optional
+        maximum bytes of the stack held in memory at once, by default None processes all frames together. Providing a memory-mapped stack (e.g. from utilities.chunked.open_stack) with a memory_limit processes frames chunk by chunk.
+
+    Returns
+    -------
+    array
+        background intensity for each frame
+    """
+    if memory_limit:
+        return reduce_chunks(stack, lambda values: frame_background(values, method=method, percentile=percentile, radius=radius, nbins=nbins), axis=-1, memory_limit=memory_limit)
+
+    num_frames = stack.shape[-1]
+    if method == 'percentile':
+        return np.percentile(stack.reshape(-1, num_frames), percentile, axis=0)
+    if method == 'otsu':
+        thresholds = otsu_thresholds(stack, nbins=nbins)
+        below = stack <= thresholds
+        return np.sum(np.where(below, stack, 0), axis=(0, 1), dtype=np.float64) / np.maximum(np.count_nonzero(below, axis=(0, 1)), 1)
+    if method == 'morphological':
+        return np.median(background_surface(stack, radius=radius).reshape(-1, num_frames), axis=0)
+    raise ValueError(f"method must be 'percentile', 'otsu' or 'morphological', not {method}")
@@ -0,0 +1,188 @@
+import numpy as np
+import tifffile
+from numpy.lib.format import open_memmap
+from scipy import sparse
+
+from utilities.image_cache import read_image
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# default maximum number of bytes of any stack held in memory at once
+MEMORY_LIMIT = 2 * 1024 ** 3
+
+
+def open_stack(path, mmap=True):
+    """Opens an image stack lazily where possible, so that only the slices which are accessed are read from disk.
+
+    Parameters
+    ----------
+    path : str
+        path to '.npy' array or '.tif' image
+    mmap : bool, optional
+        memory-map '.npy' arrays rather than reading them in full, by default True
+
+    Returns
+    -------
+    array
+        np.memmap for '.npy' arrays if mmap, otherwise a read-only in-memory array shared through utilities.image_cache
+    """
+    if path.endswith('.npy') and mmap:
+        return np.load(path, mmap_mode='r')
+    return read_image(path)
+
+
+def file_shape(path):
+    """Shape of a '.npy' array or '.tif' image as decoded by read_array, from the file header without reading any pixels"""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r').shape
+    with tifffile.TiffFile(path) as tif:
+        return tuple(tif.series[0].shape)
+
+
+def read_array(path):
+    """Decode a '.npy' array or '.tif' image in full, with axes in file order (unlike skimage.io.imread, which moves a leading axis of length 3 or 4 last as colour channels)"""
+    if path.endswith('.npy'):
+        return np.load(path)
+    return tifffile.imread(path)
+
+
+def concatenate_stack(paths, output_path, load=read_array, axis=-1, shape=file_shape):
+    """Concatenates arrays read from paths along one axis into a single '.npy' stack on disk, written one file at a time so the full stack is never held in memory.
+
+    Parameters
+    ----------
+    paths : list of str
+        files in the order they are stacked, e.g. FRAP series or time-lapse frames
+    output_path : str
+        path of the '.npy' stack
+    load : callable, optional
+        function reading one file as an array, by default read_array. Each file is decoded once, as it is written to the stack.
+    axis : int, optional
+        axis along which arrays are concatenated, by default -1 (timepoints of FRAP (H, W, T) stacks). Stacks read one index at a time (e.g. time-lapse frames) should be concatenated along axis 0, so each index is contiguous on disk.
+    shape : callable, optional
+        function returning the shape of load(path) from file metadata, used to size the stack before any file is decoded, by default file_shape. Must be given whenever load reshapes or transposes the decoded array.
+
+    Returns
+    -------
+    tuple
+        shape of the saved stack
+    """
+    shapes = [tuple(int(size) for size in shape(path)) for path in paths]
+    axis = axis % len(shapes[0])
+    stack_shape = shapes[0][:axis] + (sum(values_shape[axis] for values_shape in shapes), ) + shapes[0][axis + 1:]
+    stack = None
+    position = 0
+    for path in paths:
+        values = load(path)
+        if stack is None:
+            stack = open_memmap(output_path, mode='w+', dtype=values.dtype, shape=stack_shape)
+        index = [slice(None)] * len(stack_shape)
+        index[axis] = slice(position, position + values.shape[axis])
+        stack[tuple(index)] = values
+        position += values.shape[axis]
+    stack.flush()
+    del stack
+    return stack_shape
+
+
+def chunk_slices(length, slice_bytes, memory_limit=MEMORY_LIMIT):
+    """Split an axis of the given length into consecutive slices, each holding at most memory_limit bytes where a single index along the axis holds slice_bytes"""
+    step = max(1, int(memory_limit // max(slice_bytes, 1)))
+    return [slice(start, min(start + step, length)) for start in range(0, length, step)]
+
+
+def iter_chunks(stack, axis=-1, memory_limit=MEMORY_LIMIT):
+    """Yield (slice, in-memory chunk) pairs along one axis of a (possibly memory-mapped) stack, each chunk holding at most memory_limit bytes.
+
+    Chunks along the first axis (rows) are contiguous on disk for C-ordered stacks and therefore cheapest to read, while chunks along the last axis (timepoints) suit per-frame operations.
+    """
+    axis = axis % stack.ndim
+    slice_bytes = stack.nbytes // stack.shape[axis]
+    for chunk in chunk_slices(stack.shape[axis], slice_bytes, memory_limit):
+        index = [slice(None)] * stack.ndim
+        index[axis] = chunk
+        yield chunk, np.asarray(stack[tuple(index)])
+
+
+def map_chunks(stack, func, axis=-1, memory_limit=MEMORY_LIMIT, out=None, dtype=None):
+    """Applies func to each chunk of a stack along axis, writing results into out.
+
+    Parameters
+    ----------
+    stack : array
+        (possibly memory-mapped) stack
+    func : callable
+        function mapping a chunk to an array of the same shape, which must treat each index along axis independently (e.g. a spatial filter applied to each frame)
+    axis : int, optional
+        axis along which to chunk, by default -1 (timepoints of an (H, W, T) stack)
+    memory_limit : int, optional
+        maximum bytes per input chunk, by default MEMORY_LIMIT
+    out : array, optional
+        output array (e.g. from np.lib.format.open_memmap to keep the result on disk), by default None creates a new in-memory array
+    dtype : numpy dtype, optional
+        dtype of out if not provided, by default None matches stack
+
+    Returns
+    -------
+    array
+        out, holding func applied to every chunk
+    """
+    if out is None:
+        out = np.empty(stack.shape, dtype=dtype or stack.dtype)
+    axis = axis % stack.ndim
+    for chunk, values in iter_chunks(stack, axis=axis, memory_limit=memory_limit):
+        index = [slice(None)] * stack.ndim
+        index[axis] = chunk
+        out[tuple(index)] = func(values)
+    return out
+
+
+def reduce_chunks(stack, func, axis=-1, memory_limit=MEMORY_LIMIT):
+    """Applies a per-index reduction (e.g. per-frame background) to each chunk along axis, concatenating the results"""
+    return np.concatenate([func(values) for chunk, values in iter_chunks(stack, axis=axis, memory_limit=memory_limit)])
+
+
+def label_frame_means(stack, labels, memory_limit=MEMORY_LIMIT):
+    """Mean intensity of every label at every timepoint of an (H, W, T) stack, accumulated over contiguous chunks of rows.
+
+    Chunks are sized so that the chunk of the stack together with every temporary derived from it (float64 values and int64 label keys) stays within memory_limit. A single (H, W) label image is applied to all timepoints at once without being repeated along time.
+
+    Parameters
+    ----------
+    stack : array
+        (possibly memory-mapped) image stack where the last dimension is timepoints
+    labels : array
+        (H, W) label image applied to every timepoint, or (H, W, T) label stack, background is 0
+    memory_limit : int, optional
+        maximum bytes held in memory for each chunk of rows, by default MEMORY_LIMIT
+
+    Returns
+    -------
+    array
+        (num_labels + 1, T) array of means, where row 0 holds the background and labels without pixels are NaN
+    """
+    num_rows, num_cols, num_frames = stack.shape
+    num_labels = int(np.max(labels)) + 1
+    static = np.ndim(labels) == 2
+    # bytes per row: the stack chunk read from disk and its float64 copy, plus int64 keys for every pixel of each frame (or, for static labels, the labels and sparse indicator of each pixel once)
+    row_bytes = num_cols * num_frames * (stack.dtype.itemsize + 8) + num_cols * 8 * (4 if static else num_frames)
+    sums = np.zeros((num_labels, num_frames))
+    counts = np.zeros((num_labels, num_frames))
+    for rows in chunk_slices(num_rows, row_bytes, memory_limit):
+        values = np.asarray(stack[rows], dtype=np.float64).reshape(-1, num_frames)
+        if static:
+            chunk_labels = np.asarray(labels[rows]).astype(np.int64).ravel()
+            # sparse (label, pixel) indicator sums every frame of each label in one product
+            indicator = sparse.csr_matrix((np.ones(len(chunk_labels)), (chunk_labels, np.arange(len(chunk_labels)))), shape=(num_labels, len(chunk_labels)))
+            sums += indicator @ values
+            counts += np.bincount(chunk_labels, minlength=num_labels)[:, None]
+        else:
+            keys = np.asarray(labels[rows]).astype(np.int64).reshape(-1, num_frames)
+            keys *= num_frames
+            keys += np.arange(num_frames)
+            sums += np.bincount(keys.ravel(), weights=values.ravel(), minlength=num_labels * num_frames).reshape(num_labels, num_frames)
+            counts += np.bincount(keys.ravel(), minlength=num_labels * num_frames).reshape(num_labels, num_frames)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
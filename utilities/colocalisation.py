@@ -0,0 +1,153 @@
+import itertools
+import numpy as np
+import pandas as pd
+from skimage.filters import threshold_otsu
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def label_moments(first, second, labels):
+    """Per-label pixel count, sums, sums of squares and cross-products of two channels, accumulated in a single pass with np.bincount.
+
+    Parameters
+    ----------
+    first, second : 2D-array
+        intensity images of the two channels
+    labels : 2D-array
+        label image, background is 0
+
+    Returns
+    -------
+    dict
+        'n', 'sx', 'sy', 'sxx', 'syy' and 'sxy' arrays indexed by label
+    """
+    labels = np.asarray(labels).ravel().astype(np.int64)
+    x = np.asarray(first, dtype=np.float64).ravel()
+    y = np.asarray(second, dtype=np.float64).ravel()
+    minlength = int(labels.max()) + 1 if labels.size else 1
+    return {
+        'n': np.bincount(labels, minlength=minlength).astype(np.float64),
+        'sx': np.bincount(labels, weights=x, minlength=minlength),
+        'sy': np.bincount(labels, weights=y, minlength=minlength),
+        'sxx': np.bincount(labels, weights=x * x, minlength=minlength),
+        'syy': np.bincount(labels, weights=y * y, minlength=minlength),
+        'sxy': np.bincount(labels, weights=x * y, minlength=minlength),
+    }
+
+
+def moments_pearson(moments):
+    """Pearson correlation for every label from label_moments, NaN where either channel is constant"""
+    n = moments['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = moments['sxy'] - moments['sx'] * moments['sy'] / n
+        variance_x = moments['sxx'] - moments['sx'] ** 2 / n
+        variance_y = moments['syy'] - moments['sy'] ** 2 / n
+        return covariance / np.sqrt(variance_x * variance_y)
+
+
+def label_ranks(values, labels):
+    """Rank of every pixel among pixels with the same label (1 --> n, ties given their average rank), computed for all labels with one sort"""
+    values = np.asarray(values).ravel()
+    labels = np.asarray(labels).ravel().astype(np.int64)
+    order = np.lexsort((values, labels))
+    sorted_values, sorted_labels = values[order], labels[order]
+
+    # runs of equal (label, value) share the average of their positions
+    new_run = np.ones(len(order), dtype=bool)
+    new_run[1:] = (sorted_labels[1:] != sorted_labels[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    run = np.cumsum(new_run) - 1
+    positions = np.arange(len(order), dtype=np.float64)
+    average = np.bincount(run, weights=positions) / np.bincount(run)
+
+    # ranks restart at 1 for each label
+    label_start = np.zeros(len(order), dtype=np.float64)
+    new_label = np.ones(len(order), dtype=bool)
+    new_label[1:] = sorted_labels[1:] != sorted_labels[:-1]
+    label_start[new_label] = positions[new_label]
+    label_start = np.maximum.accumulate(label_start)
+
+    ranks = np.empty(len(order), dtype=np.float64)
+    ranks[order] = average[run] - label_start + 1
+    return ranks
+
+
+def label_colocalisation(first, second, labels, thresholds=(None, None)):
+    """Pearson, Manders M1/M2 and Spearman colocalisation of two channels for every label at once.
+
+    Parameters
+    ----------
+    first, second : 2D-array
+        intensity images of the two channels
+    labels : 2D-array
+        label image (e.g. one compartment labelled by cell number), background is 0
+    thresholds : tuple, optional
+        intensity above which each channel is considered present for Manders coefficients, by default (None, None) uses the Otsu threshold of each channel over all labelled pixels
+
+    Returns
+    -------
+    DataFrame
+        label, pixels, pearson, manders_m1 (fraction of first channel intensity where second is present), manders_m2 (fraction of second channel intensity where first is present) and spearman
+    """
+    labels = np.asarray(labels)
+    foreground = labels != 0
+    x, y, label_values = np.asarray(first)[foreground], np.asarray(second)[foreground], labels[foreground].astype(np.int64)
+    if label_values.size == 0:
+        return pd.DataFrame(columns=['label', 'pixels', 'pearson', 'manders_m1', 'manders_m2', 'spearman'])
+
+    threshold_x, threshold_y = [
+        (threshold_otsu(values) if np.ptp(values) > 0 else values.min()) if threshold is None else threshold
+        for values, threshold in zip([x, y], thresholds)]
+
+    moments = label_moments(x, y, label_values)
+    rank_moments = label_moments(label_ranks(x, label_values), label_ranks(y, label_values), label_values)
+    minlength = len(moments['n'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        manders_m1 = np.bincount(label_values, weights=np.where(y > threshold_y, x, 0), minlength=minlength) / moments['sx']
+        manders_m2 = np.bincount(label_values, weights=np.where(x > threshold_x, y, 0), minlength=minlength) / moments['sy']
+
+    present = np.flatnonzero(moments['n'][1:]) + 1
+    return pd.DataFrame({
+        'label': present,
+        'pixels': moments['n'][present].astype(int),
+        'pearson': moments_pearson(moments)[present],
+        'manders_m1': manders_m1[present],
+        'manders_m2': manders_m2[present],
+        'spearman': moments_pearson(rank_moments)[present],
+    })
+
+
+def colocalisation(image, mask_stack, mask_types, channel_pairs=None, thresholds=None):
+    """Colocalisation of channel pairs for every label in every compartment of an image.
+
+    Parameters
+    ----------
+    image : 3D-array
+        (rows, columns, channels) image
+    mask_stack : 3D-array
+        compartment label images stacked along the first axis, e.g. [cytoplasm, aggregate, nucleus] labelled by cell number
+    mask_types : list of str
+        compartment name for each layer of mask_stack
+    channel_pairs : list of tuple, optional
+        (first, second) channels to compare, by default None compares all pairs
+    thresholds : dict, optional
+        mapping of channel to Manders threshold, by default None uses Otsu thresholds for all channels
+
+    Returns
+    -------
+    DataFrame
+        label, mask_type, channel_1, channel_2 and colocalisation metrics from label_colocalisation
+    """
+    thresholds = thresholds or {}
+    if channel_pairs is None:
+        channel_pairs = list(itertools.combinations(range(image.shape[2]), 2))
+    results = []
+    for i, mask_type in enumerate(mask_types):
+        for first, second in channel_pairs:
+            result = label_colocalisation(image[:, :, first], image[:, :, second], mask_stack[i], thresholds=(thresholds.get(first), thresholds.get(second)))
+            result.insert(1, 'mask_type', mask_type)
+            result.insert(2, 'channel_1', first)
+            result.insert(3, 'channel_2', second)
+            results.append(result)
+    return pd.concat(results).reset_index(drop=True)
@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import pandas as pd
+
+from utilities.label_store import compact_labels
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def derive_compartments(cells, aggregates, nuclei, match='any'):
+    """Split every cell into compartments at once using label arithmetic on the whole-cell, aggregate and nuclear label layers.
+
+    Parameters
+    ----------
+    cells : 2D-array
+        whole-cell label image, where background is 0 and cells are numbered 1 -> n
+    aggregates : 2D-array
+        aggregate label image
+    nuclei : 2D-array
+        nuclear (or masked feature) label image
+    match : str, optional
+        'any' assigns any non-zero aggregate/nuclear pixel inside a cell to that cell (as for chaperone-localisation), while 'label' only assigns pixels whose aggregate/nuclear label equals the cell number (as for diffuse-FRET, where aggregate labels are also kept outside the cell outline). By default 'any'.
+
+    Returns
+    -------
+    dict
+        Mapping compartment name to a label image where each pixel holds the number of the cell it belongs to:
+        - cytoplasm: cell excluding nucleus and aggregate
+        - aggregate: aggregate pixels
+        - nucleus: nucleus excluding aggregate
+        - unmasked: cell excluding nucleus (i.e. including aggregate)
+    """
+    cells = compact_labels(cells)
+    in_cell = cells != 0
+
+    if match == 'any':
+        in_nucleus = in_cell & (nuclei != 0)
+        in_aggregate = in_cell & (aggregates != 0)
+        aggregate = np.where(in_aggregate, cells, 0)
+    elif match == 'label':
+        in_nucleus = in_cell & (nuclei == cells)
+        in_aggregate = in_cell & (aggregates == cells)
+        cell_numbers = np.unique(cells[in_cell])
+        aggregate = np.where(np.isin(aggregates, cell_numbers), aggregates, 0)
+    else:
+        raise ValueError(f"match must be 'any' or 'label', not {match}")
+
+    return {
+        'cytoplasm': np.where(in_cell & ~in_nucleus & ~in_aggregate, cells, 0).astype(cells.dtype),
+        'aggregate': aggregate.astype(cells.dtype),
+        'nucleus': np.where(in_nucleus & ~in_aggregate, cells, 0).astype(cells.dtype),
+        'unmasked': np.where(in_cell & ~in_nucleus, cells, 0).astype(cells.dtype),
+    }
+
+
+def compartment_stack(compartments, compartment_names):
+    """Stack compartment label images in the order given by compartment_names"""
+    return np.stack([compartments[name] for name in compartment_names])
+
+
+def cell_index(stack, compartment_names):
+    """Tabulate the number of pixels in each compartment for every cell in a compartment label stack.
+
+    Parameters
+    ----------
+    stack : 3D-array
+        compartment label images stacked along the first axis, as from compartment_stack
+    compartment_names : list of str
+        name of each compartment in stack
+
+    Returns
+    -------
+    DataFrame
+        cell_number with one {compartment}_pixels column per compartment
+    """
+    max_label = int(stack.max())
+    counts = pd.DataFrame({
+        f'{name}_pixels': np.bincount(stack[i].ravel(), minlength=max_label + 1)
+        for i, name in enumerate(compartment_names)
+    })
+    counts['cell_number'] = counts.index
+    counts = counts[(counts['cell_number'] > 0) & (counts.drop('cell_number', axis=1).sum(axis=1) > 0)]
+    return counts[['cell_number'] + [f'{name}_pixels' for name in compartment_names]].reset_index(drop=True)
+
+
+def save_compartments(output_folder, stack, compartment_names):
+    """Saves compartment label stack and cell index to output_folder as compartments.npy and cell_index.csv"""
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    np.save(f'{output_folder}compartments.npy', compact_labels(stack))
+    cell_index(stack, compartment_names).to_csv(f'{output_folder}cell_index.csv')
+
+
+def load_compartments(input_folder):
+    """Reads compartment label stack for one image, converting legacy per-cell mask stacks (cell_n.npy) if no compartments.npy is found.
+
+    Parameters
+    ----------
+    input_folder : str
+        folder containing compartments.npy, or legacy cell_n.npy files
+
+    Returns
+    -------
+    3D-array
+        compartment label images stacked along the first axis
+    """
+    if os.path.exists(f'{input_folder}compartments.npy'):
+        return np.load(f'{input_folder}compartments.npy')
+
+    cell_files = sorted(filename for filename in os.listdir(input_folder) if filename.startswith('cell_') and filename.endswith('.npy'))
+    if not cell_files:
+        raise FileNotFoundError(f'No compartment masks found in {input_folder}')
+    stack = None
+    for filename in cell_files:
+        cell_number = int(filename.replace('cell_', '').replace('.npy', ''))
+        cell_stack = np.load(f'{input_folder}{filename}')
+        if stack is None:
+            stack = np.zeros(cell_stack.shape, dtype=np.uint16)
+        stack[cell_stack != 0] = cell_number
+    return stack
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def channel_background(image, cell_labels, percentile=50):
+    """Estimates background for every channel at once from pixels outside all cells.
+
+    Parameters
+    ----------
+    image : 3D-array
+        image with channels as the last dimension
+    cell_labels : 2D-array
+        label image of all cells (e.g. unfiltered cellpose masks), background is 0
+    percentile : int, optional
+        percentile of cell-free pixels used as background, by default 50 (median)
+
+    Returns
+    -------
+    array
+        background value for each channel
+    """
+    return np.percentile(image[cell_labels == 0], percentile, axis=0)
+
+
+def bleedthrough_coefficient(fret_image, reference_image, mask):
+    """Estimates bleed-through of a single fluorophore into the FRET channel from a donor-only or acceptor-only control, as the least-squares slope through the origin of background-subtracted FRET versus reference intensity within mask"""
+    fret_values = fret_image[mask].astype(np.float64)
+    reference_values = reference_image[mask].astype(np.float64)
+    return np.sum(fret_values * reference_values) / np.sum(reference_values ** 2)
+
+
+def control_bleedthrough(controls, reference_channel, fret_channel, percentile=50):
+    """Estimates bleed-through into the FRET channel from one or more single-fluorophore control images, pooling cell pixels of all controls.
+
+    Parameters
+    ----------
+    controls : list of tuple(array, array)
+        (image, cell_labels) for each donor-only or acceptor-only control, where images have channels as the last dimension and cell_labels are label images of all cells (background is 0)
+    reference_channel : int
+        channel of the fluorophore present in the controls, i.e. the donor channel for donor-only controls
+    fret_channel : int
+        FRET channel
+    percentile : int, optional
+        percentile of cell-free pixels used as background of each control, by default 50 (median)
+
+    Returns
+    -------
+    float
+        bleed-through coefficient for use in fret_maps
+    """
+    fret_values, reference_values = [], []
+    for image, cell_labels in controls:
+        background = channel_background(image, cell_labels, percentile=percentile)
+        in_cells = cell_labels != 0
+        fret_values.append(image[:, :, fret_channel][in_cells] - background[fret_channel])
+        reference_values.append(image[:, :, reference_channel][in_cells] - background[reference_channel])
+    fret_values, reference_values = np.concatenate(fret_values), np.concatenate(reference_values)
+    return bleedthrough_coefficient(fret_values, reference_values, np.ones(len(fret_values), dtype=bool))
+
+
+def fret_maps(donor, acceptor, fret, donor_bleedthrough, acceptor_bleedthrough, background=(0, 0, 0), g_factor=1.0):
+    """Computes bleed-through corrected sensitised emission FRET maps for a whole image at once.
+
+    Parameters
+    ----------
+    donor : 2D-array
+        donor (e.g. mTFP) channel, excited and collected at donor wavelengths
+    acceptor : 2D-array
+        acceptor (e.g. Venus) channel, excited and collected at acceptor wavelengths
+    fret : 2D-array
+        FRET channel, excited at donor and collected at acceptor wavelengths
+    donor_bleedthrough : float
+        fraction of donor signal collected in the FRET channel, from donor-only controls
+    acceptor_bleedthrough : float
+        fraction of acceptor signal collected in the FRET channel, from acceptor-only controls
+    background : tuple of float, optional
+        background for (donor, acceptor, fret) channels, by default (0, 0, 0)
+    g_factor : float, optional
+        ratio of sensitised acceptor emission to donor quenching used for efficiency, by default 1.0
+
+    Returns
+    -------
+    dict
+        Mapping map name to float32 image, where pixels with non-positive denominators are NaN:
+        - corrected_fret: Fc = F - a*D - b*A
+        - fret_ratio: Fc / A
+        - nfret: Fc / sqrt(D*A)
+        - efficiency: Fc / (Fc + G*D)
+    """
+    donor = donor.astype(np.float32) - background[0]
+    acceptor = acceptor.astype(np.float32) - background[1]
+    fret = fret.astype(np.float32) - background[2]
+
+    corrected = fret - donor_bleedthrough * donor - acceptor_bleedthrough * acceptor
+    with np.errstate(divide='ignore', invalid='ignore'):
+        maps = {
+            'corrected_fret': corrected,
+            'fret_ratio': np.where(acceptor > 0, corrected / acceptor, np.nan),
+            'nfret': np.where((donor > 0) & (acceptor > 0), corrected / np.sqrt(donor * acceptor), np.nan),
+            'efficiency': np.where(corrected + g_factor * donor > 0, corrected / (corrected + g_factor * donor), np.nan),
+        }
+    return {name: array.astype(np.float32) for name, array in maps.items()}
+
+
+def label_means(maps, labels, mask_type=None):
+    """Mean of each map within every label in a single pass, ignoring non-finite pixels.
+
+    Parameters
+    ----------
+    maps : dict
+        Mapping map name to 2D-array, as from fret_maps
+    labels : 2D-array
+        label image (e.g. compartment labelled by cell number), background is 0
+    mask_type : str, optional
+        provided name of ROI type to be appended to summary df, by default None means column is not added
+
+    Returns
+    -------
+    DataFrame
+        label with one mean column per map
+    """
+    labels = labels.ravel()
+    num_labels = int(labels.max()) + 1
+    summary = pd.DataFrame({'label': np.arange(num_labels)})
+    for name, array in maps.items():
+        values = array.ravel()
+        finite = np.isfinite(values)
+        totals = np.bincount(labels[finite], weights=values[finite], minlength=num_labels)
+        counts = np.bincount(labels[finite], minlength=num_labels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary[name] = totals / counts
+    summary = summary[(summary['label'] > 0) & np.isin(summary['label'], np.unique(labels))]
+
+    if mask_type != None:
+        summary['mask_type'] = mask_type
+
+    return summary.reset_index(drop=True)
@@ -0,0 +1,107 @@
+import os
+import threading
+import collections
+import numpy as np
+import skimage.io
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# default maximum number of bytes of decoded images held by the shared cache
+CACHE_BYTES = 4 * 1024 ** 3
+
+
+def read_file(path):
+    """Decode a '.npy' array or image file (e.g. '.tif') in full"""
+    if path.endswith('.npy'):
+        return np.load(path)
+    return skimage.io.imread(path)
+
+
+class ImageCache:
+    """Thread-safe in-process cache of decoded images with a byte budget and least-recently-used eviction.
+
+    Entries are keyed by path together with file size and modification time, so files rewritten by an earlier stage are decoded again rather than served stale. Arrays are handed out read-only as they are shared between all callers; copy before modifying in place. Concurrent requests for the same file (e.g. from prefetch threads) decode it once.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        maximum total bytes of cached arrays, by default CACHE_BYTES. Arrays larger than max_bytes are returned without being cached.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, path, loader=read_file):
+        """Return the decoded (read-only) array for path, calling loader(path) only if no current entry is cached"""
+        key = self.key(path)
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # another thread is decoding this file, wait then look again
+            loading.wait()
+
+        try:
+            array = np.asarray(loader(path))
+            array.setflags(write=False)
+            self._insert(key, array)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return array
+
+    def _insert(self, key, array):
+        with self._lock:
+            # drop entries for earlier versions of the same file
+            for stale in [entry for entry in self._entries if entry[0] == key[0]]:
+                self.nbytes -= self._entries.pop(stale).nbytes
+            if array.nbytes > self.max_bytes:
+                return
+            self._entries[key] = array
+            self.nbytes += array.nbytes
+            while self.nbytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """Summary of cache usage, e.g. for logging after each stage"""
+        with self._lock:
+            return {'entries': len(self._entries), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# single cache shared by every stage run in the same session (e.g. repeated %run of scripts in IPython)
+image_cache = ImageCache()
+
+
+def read_image(path):
+    """Read an image or '.npy' stack through the shared image_cache, returning a read-only array"""
+    return image_cache.get(path)
@@ -0,0 +1,109 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def fingerprint(paths, params=None):
+    """Cheap fingerprint of input files from their size and modification time, plus any parameters the partial aggregates depend on"""
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    stats = [f'{path}:{os.stat(path).st_size}:{os.stat(path).st_mtime_ns}' for path in paths]
+    return hashlib.sha1('|'.join(stats + [repr(params)]).encode('utf-8')).hexdigest()
+
+
+def moment_partials(df, group_cols, value_cols):
+    """Mergeable partial aggregates (count, sum and sum of squares of each value column) per group
+
+    Partials for disjoint sets of rows can be combined by summing (see combine_moments)
+    """
+    values = df[group_cols + value_cols].copy()
+    for col in value_cols:
+        values[f'{col}_sum_sq'] = values[col].astype(np.float64) ** 2
+    grouped = values.groupby(group_cols)
+    partials = grouped[value_cols + [f'{col}_sum_sq' for col in value_cols]].sum()
+    partials = partials.rename(columns={col: f'{col}_sum' for col in value_cols})
+    partials.insert(0, 'count', grouped.size())
+    return partials.reset_index()
+
+
+def combine_moments(partials, group_cols, value_cols):
+    """Combine moment_partials for any number of images, returning count, mean and (sample) standard deviation of each value column per group"""
+    sums = partials.groupby(group_cols)[['count'] + [f'{col}_{stat}' for col in value_cols for stat in ['sum', 'sum_sq']]].sum()
+    combined = sums[['count']].astype(int)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col in value_cols:
+            combined[col] = sums[f'{col}_sum'] / sums['count']
+            variance = (sums[f'{col}_sum_sq'] - sums[f'{col}_sum'] ** 2 / sums['count']) / (sums['count'] - 1)
+            combined[f'{col}_std'] = np.sqrt(np.maximum(variance, 0))
+    return combined.reset_index()
+
+
+def save_partials(partials, partial_folder):
+    """Saves partials to partials.csv, with the dtype of every column in dtypes.csv so that integer keys (e.g. channel) are not read back as floats"""
+    partials.to_csv(f'{partial_folder}partials.csv', index=False)
+    pd.DataFrame({'column': partials.columns, 'dtype': [str(dtype) for dtype in partials.dtypes]}).to_csv(f'{partial_folder}dtypes.csv', index=False)
+
+
+def read_partials(partial_folder):
+    """Reads partials saved by save_partials, restoring the saved dtype of each column where it holds no missing values"""
+    partials = pd.read_csv(f'{partial_folder}partials.csv', keep_default_na=False, na_values=[''], dtype={'image_name': str})
+    partials = partials.drop([col for col in partials.columns.tolist() if 'Unnamed: ' in col], axis=1)
+    if os.path.exists(f'{partial_folder}dtypes.csv'):
+        for col, dtype in pd.read_csv(f'{partial_folder}dtypes.csv', dtype=str)[['column', 'dtype']].values:
+            if col in partials.columns and dtype != 'object' and not partials[col].isna().any():
+                partials[col] = partials[col].astype(dtype)
+    return partials
+
+
+def update_partials(sources, partial_fn, partial_folder, params=None):
+    """Keeps per-image partial aggregates up to date, only recalculating partials for new or changed images and retracting those for removed images.
+
+    Partials are stored as a single partials.csv (with an image_name column, and column dtypes in dtypes.csv) alongside fingerprints.csv recording the inputs each partial was calculated from, so unchanged images are never re-read.
+
+    Parameters
+    ----------
+    sources : dict
+        mapping of image name to the input path (or list of paths) its partial is calculated from
+    partial_fn : callable
+        function mapping an image name to a DataFrame of partial aggregates for that image
+    partial_folder : str
+        folder in which partials are stored
+    params : any, optional
+        parameters the partials depend on, which invalidate all partials when changed, by default None
+
+    Returns
+    -------
+    DataFrame
+        partial aggregates for all images in sources
+    """
+    if not os.path.exists(partial_folder):
+        os.makedirs(partial_folder)
+    fingerprints = {image_name: fingerprint(paths, params) for image_name, paths in sources.items()}
+
+    if os.path.exists(f'{partial_folder}partials.csv') and os.path.exists(f'{partial_folder}fingerprints.csv'):
+        partials = read_partials(partial_folder)
+        previous = dict(pd.read_csv(f'{partial_folder}fingerprints.csv', dtype=str)[['image_name', 'fingerprint']].values)
+    else:
+        partials, previous = None, {}
+
+    changed = [image_name for image_name, value in fingerprints.items() if previous.get(image_name) != value]
+    removed = [image_name for image_name in previous if image_name not in fingerprints]
+
+    # partials are combined from a list of frames, so key columns keep their dtype rather than being upcast by an empty placeholder
+    frames = [] if partials is None else [partials[~partials['image_name'].isin(changed + removed)]]
+    for image_name in changed:
+        partial = partial_fn(image_name)
+        partial.insert(0, 'image_name', image_name)
+        frames.append(partial)
+    frames = [frame for frame in frames if len(frame)]
+    partials = pd.concat(frames, sort=False).reset_index(drop=True) if frames else pd.DataFrame(columns=['image_name'])
+
+    if changed or removed:
+        save_partials(partials, partial_folder)
+        pd.DataFrame({'image_name': list(fingerprints.keys()), 'fingerprint': list(fingerprints.values())}).to_csv(f'{partial_folder}fingerprints.csv', index=False)
+    logger.info(f'Partials updated for {len(changed)} new or changed images, {len(removed)} removed, {len(fingerprints) - len(changed)} unchanged')
+    return partials
@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def label_contingency(reference, prediction):
+    """Sparse contingency table of overlapping pixels between two label images, computed in a single pass.
+
+    Parameters
+    ----------
+    reference : 2D-array
+        reference label image, background is 0
+    prediction : 2D-array
+        label image to be compared with reference, background is 0
+
+    Returns
+    -------
+    DataFrame
+        reference, prediction and overlap (number of shared pixels) for every pair of labels which share at least one pixel, including background (0) pairs
+    """
+    reference = np.asarray(reference).ravel().astype(np.int64)
+    prediction = np.asarray(prediction).ravel().astype(np.int64)
+    width = int(prediction.max()) + 1
+    pairs, overlap = np.unique(reference * width + prediction, return_counts=True)
+    return pd.DataFrame({'reference': pairs // width, 'prediction': pairs % width, 'overlap': overlap})
+
+
+def object_iou(reference, prediction):
+    """Intersection over union of each reference object with its best-matching predicted object.
+
+    Parameters
+    ----------
+    reference : 2D-array
+        reference label image, background is 0
+    prediction : 2D-array
+        label image to be compared with reference, background is 0
+
+    Returns
+    -------
+    DataFrame
+        reference label, best-matching prediction label (0 if unmatched) and IoU for each reference object
+    """
+    table = label_contingency(reference, prediction)
+    reference_size = table.groupby('reference')['overlap'].sum()
+    prediction_size = table.groupby('prediction')['overlap'].sum()
+
+    objects = table[(table['reference'] != 0) & (table['prediction'] != 0)].copy()
+    objects['iou'] = objects['overlap'] / (
+        objects['reference'].map(reference_size).values
+        + objects['prediction'].map(prediction_size).values
+        - objects['overlap'].values
+    )
+    best = objects.sort_values('iou', ascending=False).drop_duplicates('reference')
+
+    ious = pd.DataFrame({'reference': reference_size.index[reference_size.index != 0]})
+    ious = pd.merge(ious, best[['reference', 'prediction', 'iou']], on='reference', how='left')
+    ious['prediction'] = ious['prediction'].fillna(0).astype(int)
+    ious['iou'] = ious['iou'].fillna(0)
+    return ious
+
+
+def foreground_iou(reference, prediction):
+    """Intersection over union of the foreground (non-zero) pixels of two label images"""
+    reference = np.asarray(reference) != 0
+    prediction = np.asarray(prediction) != 0
+    union = np.count_nonzero(reference | prediction)
+    return np.count_nonzero(reference & prediction) / union if union else 1.0
+
+
+def segmentation_agreement(reference, prediction, iou_threshold=0.5, min_fraction=0.1):
+    """Object-level agreement between a reference (e.g. curated) and predicted (e.g. raw cellpose) label image, from a single sparse contingency table.
+
+    Parameters
+    ----------
+    reference : 2D-array
+        reference label image, background is 0
+    prediction : 2D-array
+        label image to be compared with reference, background is 0
+    iou_threshold : float, optional
+        minimum IoU for a reference and predicted object to be matched, by default 0.5
+    min_fraction : float, optional
+        minimum fraction of an object's pixels which must overlap another object for the two to be considered overlapping when counting splits and merges, by default 0.1
+
+    Returns
+    -------
+    tuple(DataFrame, dict)
+        per-reference-object table of reference, pixels, prediction (best match by IoU, 0 if none), iou, num_predictions (predicted objects overlapping it) and outcome ('matched', 'split', 'merged' or 'missed'), and a summary of object counts with precision, recall, f1 and mean matched IoU
+    """
+    table = label_contingency(reference, prediction)
+    reference_size = table.groupby('reference')['overlap'].sum()
+    prediction_size = table.groupby('prediction')['overlap'].sum()
+
+    objects = table[(table['reference'] != 0) & (table['prediction'] != 0)].copy()
+    reference_pixels = objects['reference'].map(reference_size).values
+    prediction_pixels = objects['prediction'].map(prediction_size).values
+    objects['iou'] = objects['overlap'] / (reference_pixels + prediction_pixels - objects['overlap'].values)
+    # overlaps counted towards splits use the predicted object's pixels, and towards merges the reference object's pixels
+    objects['split_overlap'] = objects['overlap'] / prediction_pixels >= min_fraction
+    objects['merge_overlap'] = objects['overlap'] / reference_pixels >= min_fraction
+
+    matches = objects[objects['iou'] > iou_threshold]
+    num_predictions = objects[objects['split_overlap']].groupby('reference').size()
+    merging = objects[objects['merge_overlap']].groupby('prediction').size()
+    merged_references = objects.loc[objects['merge_overlap'] & objects['prediction'].isin(merging.index[merging > 1]), 'reference'].unique()
+    best = objects.sort_values('iou', ascending=False).drop_duplicates('reference').set_index('reference')
+
+    agreement = pd.DataFrame({'reference': reference_size.index[reference_size.index != 0]})
+    agreement['pixels'] = agreement['reference'].map(reference_size).values
+    agreement['prediction'] = agreement['reference'].map(best['prediction']).fillna(0).astype(int).values
+    agreement['iou'] = agreement['reference'].map(best['iou']).fillna(0).values
+    agreement['num_predictions'] = agreement['reference'].map(num_predictions).fillna(0).astype(int).values
+    agreement['outcome'] = 'missed'
+    agreement.loc[agreement['reference'].isin(merged_references), 'outcome'] = 'merged'
+    agreement.loc[agreement['num_predictions'] > 1, 'outcome'] = 'split'
+    agreement.loc[agreement['reference'].isin(matches['reference']), 'outcome'] = 'matched'
+
+    summary = {
+        'num_reference': len(agreement),
+        'num_prediction': int((prediction_size.index != 0).sum()),
+        'matched': len(matches),
+        'split': int((agreement['outcome'] == 'split').sum()),
+        'merged': int((agreement['outcome'] == 'merged').sum()),
+        'missed': int((agreement['outcome'] == 'missed').sum()),
+        'unmatched_predictions': int((prediction_size.index != 0).sum()) - len(matches),
+        'matched_iou_sum': float(matches['iou'].sum()),
+    }
+    return agreement, agreement_scores(summary)
+
+
+def agreement_scores(counts):
+    """Precision, recall, F1 and mean matched IoU from (summed) segmentation_agreement counts, so that scores can be recalculated after combining images"""
+    scores = dict(counts)
+    matched = scores['matched']
+    scores['precision'] = matched / scores['num_prediction'] if scores['num_prediction'] else np.nan
+    scores['recall'] = matched / scores['num_reference'] if scores['num_reference'] else np.nan
+    total = scores['num_prediction'] + scores['num_reference']
+    scores['f1'] = 2 * matched / total if total else np.nan
+    scores['mean_matched_iou'] = scores['matched_iou_sum'] / matched if matched else np.nan
+    return scores
+
+
+def aggregate_agreement(summaries, group_cols):
+    """Combine per-image segmentation_agreement summaries (one row per image) into scores per group, summing object counts before recalculating scores"""
+    count_cols = ['num_reference', 'num_prediction', 'matched', 'split', 'merged', 'missed', 'unmatched_predictions', 'matched_iou_sum']
+    counts = summaries.groupby(group_cols)[count_cols].sum()
+    counts['num_images'] = summaries.groupby(group_cols).size()
+    return pd.DataFrame([{**dict(zip(group_cols, key if isinstance(key, tuple) else (key,))), **agreement_scores(row)} for key, row in counts.iterrows()])
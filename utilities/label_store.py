@@ -0,0 +1,153 @@
+import os
+import zipfile
+import numpy as np
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def compact_dtype(max_value):
+    """Smallest unsigned integer dtype able to hold max_value"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def compact_labels(labels):
+    """Cast a label image to the smallest unsigned integer dtype which fits all labels"""
+    labels = np.asarray(labels)
+    if labels.min() < 0:
+        raise ValueError('Label images must not contain negative values')
+    return labels.astype(compact_dtype(int(labels.max())), copy=False)
+
+
+def save_label_store(output_path, labels):
+    """Saves label images to a single compressed store keyed by image name.
+
+    Parameters
+    ----------
+    output_path : str
+        Full path to which the store will be saved. '.npz' is appended if not provided.
+    labels : dict
+        Mapping of image name to label image. Each label image is stored in the smallest unsigned dtype which fits its labels.
+
+    Returns
+    -------
+    None.
+    """
+    if not output_path.endswith('.npz'):
+        output_path = f'{output_path}.npz'
+    # arrays are written to the archive directly (as np.savez_compressed does), so any image name can be used as a key rather than being passed as a keyword argument
+    with zipfile.ZipFile(output_path, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as store:
+        for image_name, array in labels.items():
+            with store.open(f'{image_name}.npy', mode='w', force_zip64=True) as member:
+                np.lib.format.write_array(member, compact_labels(array), allow_pickle=False)
+    logger.info(f'Saved labels for {len(labels)} images to {output_path}')
+
+
+def label_store_names(store_path):
+    """Image names held in a label store, in sorted order"""
+    if not store_path.endswith('.npz'):
+        store_path = f'{store_path}.npz'
+    with np.load(store_path) as store:
+        return sorted(store.files)
+
+
+def load_labels(store_path, image_name, image_names=None):
+    """Reads the label image for a single image from a label store, without loading labels for any other image.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store, with or without the '.npz' extension
+    image_name : str
+        name of the image whose labels should be returned
+    image_names : list of str, optional
+        Only required for legacy positional '.npy' arrays (as saved previously by 1_cellpose.py), where the list must be in the order images were segmented. By default None.
+
+    Returns
+    -------
+    array
+        label image for image_name
+    """
+    store_path = store_path[:-4] if store_path.endswith(('.npz', '.npy')) else store_path
+
+    if os.path.exists(f'{store_path}.npz'):
+        with np.load(f'{store_path}.npz') as store:
+            return store[image_name]
+
+    # fall back to legacy positional arrays, which can only be matched to images by order
+    if image_names is None:
+        raise ValueError(f'No label store found at {store_path}.npz, and image_names must be provided to read legacy positional arrays')
+    logger.info(f'Reading {image_name} from legacy positional array {store_path}.npy')
+    try:
+        legacy = np.load(f'{store_path}.npy', mmap_mode='r')
+    except ValueError:
+        # ragged (object) arrays cannot be memory-mapped
+        legacy = np.load(f'{store_path}.npy', allow_pickle=True)
+    return np.asarray(legacy[list(image_names).index(image_name)])
+
+
+def pack_mask(mask):
+    """Bit-pack a boolean mask (of any shape) to 1 bit per pixel, returning (packed bits, original shape)"""
+    mask = np.asarray(mask)
+    return np.packbits(mask.astype(bool, copy=False).ravel()), np.array(mask.shape, dtype=np.int64)
+
+
+def unpack_mask(packed, shape):
+    """Restore a boolean mask from bits and shape as returned by pack_mask"""
+    shape = tuple(int(size) for size in shape)
+    return np.unpackbits(packed, count=int(np.prod(shape))).astype(bool).reshape(shape)
+
+
+def save_mask(output_path, mask):
+    """Saves a mask or mask stack according to the repository dtype policy: boolean masks are bit-packed (1 bit per pixel), any other mask is treated as labels and stored in the smallest unsigned dtype which fits.
+
+    Parameters
+    ----------
+    output_path : str
+        Full path to which the mask will be saved. Any '.npy' or '.npz' extension is replaced by '.npz'.
+    mask : array
+        boolean mask, or integer label image/stack (background is 0)
+
+    Returns
+    -------
+    None.
+    """
+    output_path = output_path[:-4] if output_path.endswith(('.npz', '.npy')) else output_path
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        packed, shape = pack_mask(mask)
+        np.savez_compressed(f'{output_path}.npz', packed=packed, shape=shape)
+    else:
+        np.savez_compressed(f'{output_path}.npz', labels=compact_labels(mask))
+
+
+def load_mask(input_path):
+    """Reads a mask saved by save_mask, falling back to a legacy '.npy' array at the same path if no '.npz' is found.
+
+    Parameters
+    ----------
+    input_path : str
+        Path to the mask, with or without the '.npz'/'.npy' extension
+
+    Returns
+    -------
+    array
+        boolean mask for bit-packed masks, otherwise the label image/stack as saved
+    """
+    input_path = input_path[:-4] if input_path.endswith(('.npz', '.npy')) else input_path
+    if os.path.exists(f'{input_path}.npz'):
+        with np.load(f'{input_path}.npz') as store:
+            if 'packed' in store.files:
+                return unpack_mask(store['packed'], store['shape'])
+            return store['labels']
+    return np.load(f'{input_path}.npy')
+
+
+def mask_exists(input_path):
+    """Whether a mask has been saved at input_path, in either the current or legacy format"""
+    input_path = input_path[:-4] if input_path.endswith(('.npz', '.npy')) else input_path
+    return os.path.exists(f'{input_path}.npz') or os.path.exists(f'{input_path}.npy')
@@ -0,0 +1,153 @@
+import os
+import hashlib
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def stable_id(name):
+    """Short identifier derived only from name, so it does not change as other images are added or removed"""
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]
+
+
+def parse_names(names, metadata_cols, sep='_'):
+    """Split names into metadata columns once per name. Any extra separators are kept in the last column.
+
+    Parameters
+    ----------
+    names : Series
+        names to parse, e.g. image names
+    metadata_cols : list of str
+        names of metadata columns, in the order they appear in each name
+    sep : str, optional
+        separator between metadata fields, by default '_'
+
+    Returns
+    -------
+    DataFrame
+        one column per metadata field, indexed as names
+    """
+    metadata = names.str.split(sep, n=len(metadata_cols) - 1, expand=True)
+    metadata = metadata.reindex(columns=range(len(metadata_cols)))
+    metadata.columns = metadata_cols
+    return metadata
+
+
+def build_manifest(image_folder, metadata_cols, extension='.tif', sep='_', dataset=None):
+    """Builds an indexed table of all images in image_folder, with metadata parsed from image names, sorted by image name.
+
+    Parameters
+    ----------
+    image_folder : str
+        folder containing images
+    metadata_cols : list of str
+        names of metadata fields encoded in image names, e.g. ['treatment', 'chaperone', 'image_number']
+    extension : str, optional
+        file extension of images, by default '.tif'
+    sep : str, optional
+        separator between metadata fields in image names, by default '_'
+    dataset : str, optional
+        name of the dataset the images belong to (e.g. the raw data folder), stored in a 'dataset' column and used to identify results from this dataset in the results database, by default None
+
+    Returns
+    -------
+    DataFrame
+        image_id, image_name, image_path, metadata columns and dataset (if given)
+    """
+    filenames = sorted(filename for filename in os.listdir(image_folder) if filename.endswith(extension))
+    manifest = pd.DataFrame({'image_name': [filename[:-len(extension)] for filename in filenames]})
+    manifest.insert(0, 'image_id', manifest['image_name'].map(stable_id))
+    manifest['image_path'] = [f'{image_folder}{filename}' for filename in filenames]
+    manifest = pd.concat([manifest, parse_names(manifest['image_name'], metadata_cols, sep=sep)], axis=1)
+    if dataset is not None:
+        manifest['dataset'] = dataset
+    logger.info(f'Manifest built for {len(manifest)} images in {image_folder}')
+    return manifest
+
+
+def dataset_folder_name(input_path):
+    """Name of the dataset held in input_path, i.e. the last folder of the path"""
+    return os.path.basename(os.path.normpath(input_path))
+
+
+def dataset_name(manifest):
+    """Dataset the manifest was built for, used as the experiment identifier of results saved to the results database. Results are replaced per dataset, so results of other datasets processed by the same workflow are kept.
+
+    Raises
+    ------
+    ValueError
+        if the manifest has no single dataset, e.g. it was built before datasets were recorded and the cleanup stage should be re-run
+    """
+    datasets = manifest['dataset'].unique().tolist() if 'dataset' in manifest.columns else []
+    if len(datasets) != 1 or not datasets[0]:
+        raise ValueError(f'Manifest must name exactly one dataset, found {datasets}. Re-run the initial cleanup stage to rebuild the manifest.')
+    return datasets[0]
+
+
+def save_manifest(manifest, output_path):
+    """Saves manifest to csv"""
+    manifest.to_csv(output_path, index=False)
+
+
+def load_manifest(input_path):
+    """Reads manifest from csv, keeping all metadata as strings"""
+    return pd.read_csv(input_path, dtype=str, keep_default_na=False)
+
+
+def cell_manifest(manifest, mask_folder):
+    """Indexed table of all cells, from the cell_index.csv saved with each image's compartment masks.
+
+    Parameters
+    ----------
+    manifest : DataFrame
+        image manifest, as from build_manifest
+    mask_folder : str
+        folder containing one {image_name}/cell_index.csv per processed image
+
+    Returns
+    -------
+    DataFrame
+        cell_id, cell (as used in pixel tables), cell_number, image manifest columns and per-compartment pixel counts
+    """
+    cells = []
+    for image_name in manifest['image_name']:
+        if not os.path.exists(f'{mask_folder}{image_name}/cell_index.csv'):
+            continue
+        index = pd.read_csv(f'{mask_folder}{image_name}/cell_index.csv')
+        index = index.drop([col for col in index.columns.tolist() if 'Unnamed: ' in col], axis=1)
+        index['image_name'] = image_name
+        cells.append(index)
+    if not cells:
+        return pd.DataFrame(columns=['cell_id', 'cell', 'cell_number'] + manifest.columns.tolist())
+    cells = pd.merge(manifest, pd.concat(cells), on='image_name')
+    cells.insert(0, 'cell', [f'{image_name}_cell_{cell_number}' for image_name, cell_number in cells[['image_name', 'cell_number']].values])
+    cells.insert(0, 'cell_id', [f'{image_id}-{cell_number}' for image_id, cell_number in cells[['image_id', 'cell_number']].values])
+    return cells.reset_index(drop=True)
+
+
+def roi_manifest(manifest, mask_folder):
+    """Indexed table of all ROIs with saved masks, where ROI folders are named {image_name}_{roi_number}.
+
+    Parameters
+    ----------
+    manifest : DataFrame
+        image manifest, as from build_manifest
+    mask_folder : str
+        folder containing one sub-folder of masks per ROI
+
+    Returns
+    -------
+    DataFrame
+        roi_id, roi_name, roi_number and image manifest columns, sorted by roi_name
+    """
+    roi_names = sorted(folder for folder in os.listdir(mask_folder) if os.path.isdir(f'{mask_folder}{folder}'))
+    rois = pd.DataFrame({
+        'roi_name': roi_names,
+        'image_name': [roi_name.rsplit('_', 1)[0] for roi_name in roi_names],
+        'roi_number': [roi_name.rsplit('_', 1)[-1] for roi_name in roi_names],
+    })
+    rois = pd.merge(rois, manifest, on='image_name')
+    rois.insert(0, 'roi_id', rois['roi_name'].map(stable_id))
+    return rois.sort_values('roi_name').reset_index(drop=True)
@@ -54,3 +54,29 @@ def pixel_collector(image_array, mask, mask_type=None, visualise=False, size=(10
         plt.xlim(0, size[1])
 
     return coords
+
+
+def label_pixel_collector(image_array, labels, mask_type=None):
+    """Obtains individual pixel coordinates and intensity values for every labelled ROI in a single pass.
+
+    Parameters
+    ----------
+    image_array : 2D-array
+        numpy array containing original image intensity values
+    labels : 2D-array
+        numpy array containing ROI labels (e.g. cell numbers). Background pixels considered to be 0
+    mask_type : [str], optional
+        provided name of ROI type to be appended to coords df, by default None means column is not added
+
+    Returns
+    -------
+    DataFrame
+        Pandas df containing x, y, intensity, label and optional mask_type columns
+    """
+    y, x = np.nonzero(labels)
+    coords = pd.DataFrame({'x': x, 'y': y, 'intensity': image_array[y, x], 'label': labels[y, x]})
+
+    if mask_type != None:
+        coords['mask_type'] = mask_type
+
+    return coords
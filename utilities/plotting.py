@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# quantiles kept for each condition, where the outer pair are used as box plot whiskers
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def condition_distributions(df, value_col, group_cols, bins=100, value_range=None, quantiles=QUANTILES):
+    """Pre-aggregate the distribution of a value for every condition into histograms on shared bins and quantiles, in one pass over all rows.
+
+    Parameters
+    ----------
+    df : DataFrame
+        one row per observation (e.g. cell)
+    value_col : str
+        column to be summarised, non-finite values are dropped
+    group_cols : list of str
+        columns defining each condition
+    bins : int, optional
+        number of histogram bins shared by all conditions, by default 100
+    value_range : tuple, optional
+        (min, max) of histogram bins, by default None uses the range of all finite values
+    quantiles : tuple, optional
+        quantiles calculated for each condition, by default QUANTILES
+
+    Returns
+    -------
+    tuple(DataFrame, DataFrame)
+        histograms: group_cols, bin_left, bin_right, count and density (count normalised to the largest bin of each condition)
+        summary: group_cols, count, mean and one q{quantile} column per quantile
+    """
+    values = df[group_cols + [value_col]].copy()
+    values = values[np.isfinite(values[value_col].astype(np.float64))]
+    groups = values.groupby(group_cols, sort=True)
+    codes = groups.ngroup().values
+    keys = pd.DataFrame(list(groups.groups.keys()), columns=group_cols) if len(group_cols) > 1 else pd.DataFrame({group_cols[0]: list(groups.groups.keys())})
+
+    if value_range is None:
+        value_range = (values[value_col].min(), values[value_col].max())
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    positions = np.clip(np.searchsorted(edges, values[value_col].values, side='right') - 1, 0, bins - 1)
+    inside = (values[value_col].values >= edges[0]) & (values[value_col].values <= edges[-1])
+    counts = np.bincount(codes[inside] * bins + positions[inside], minlength=len(keys) * bins).reshape(len(keys), bins)
+
+    histograms = keys.loc[keys.index.repeat(bins)].reset_index(drop=True)
+    histograms['bin_left'] = np.tile(edges[:-1], len(keys))
+    histograms['bin_right'] = np.tile(edges[1:], len(keys))
+    histograms['count'] = counts.ravel()
+    histograms['density'] = (counts / np.maximum(counts.max(axis=1, keepdims=True), 1)).ravel()
+
+    summary = groups[value_col].quantile(list(quantiles)).unstack()
+    summary.columns = [f'q{quantile}' for quantile in quantiles]
+    summary.insert(0, 'mean', groups[value_col].mean())
+    summary.insert(0, 'count', groups.size())
+    return histograms, summary.reset_index()
+
+
+def _positions(summary, x_col, hue_col, width):
+    """x position of each condition, dodging hue levels within each x category"""
+    x_levels = list(pd.unique(summary[x_col]))
+    hue_levels = list(pd.unique(summary[hue_col])) if hue_col else [None]
+    offsets = (np.arange(len(hue_levels)) - (len(hue_levels) - 1) / 2) * width / len(hue_levels)
+    positions = [x_levels.index(x) + (offsets[hue_levels.index(hue)] if hue_col else 0) for x, hue in zip(summary[x_col], summary[hue_col] if hue_col else [None] * len(summary))]
+    return np.array(positions), x_levels, hue_levels
+
+
+def plot_distributions(histograms, summary, x_col, hue_col=None, kind='violin', palette=None, width=0.8, ax=None):
+    """Draw per-condition distributions from pre-aggregated histograms and quantiles (see condition_distributions), so drawing time is independent of the number of observations.
+
+    Parameters
+    ----------
+    histograms, summary : DataFrame
+        as returned by condition_distributions, grouped by x_col and optionally hue_col
+    x_col : str
+        column defining categories along the x-axis
+    hue_col : str, optional
+        column defining conditions dodged within each category, by default None
+    kind : str, optional
+        'violin' (histogram outline mirrored about each position, with median and quartiles), 'box' (quartile box with whiskers at the outer quantiles) or 'strip' (one point per occupied bin sized by count), by default 'violin'
+    palette : dict, optional
+        mapping of hue level to colour, by default None uses matplotlib default colours
+    width : float, optional
+        total width available to each x category, by default 0.8
+    ax : matplotlib Axes, optional
+        axes to draw on, by default None creates a new (headless) figure
+
+    Returns
+    -------
+    matplotlib Axes
+    """
+    if ax is None:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+    group_cols = [x_col] + ([hue_col] if hue_col else [])
+    positions, x_levels, hue_levels = _positions(summary, x_col, hue_col, width)
+    half_width = width / len(hue_levels) / 2 * 0.9
+    quantile_cols = [col for col in summary.columns if col.startswith('q')]
+
+    for position, (_, condition) in zip(positions, summary.iterrows()):
+        hue = condition[hue_col] if hue_col else None
+        colour = palette[hue] if palette and hue in palette else f'C{hue_levels.index(hue)}'
+        selected = np.logical_and.reduce([histograms[col] == condition[col] for col in group_cols])
+        bins = histograms[selected]
+        centres = ((bins['bin_left'] + bins['bin_right']) / 2).values
+
+        if kind == 'violin':
+            ax.fill_betweenx(centres, position - bins['density'].values * half_width, position + bins['density'].values * half_width, facecolor=colour, alpha=0.6, linewidth=0)
+            ax.vlines(position, condition[quantile_cols[1]], condition[quantile_cols[-2]], colors='black', linewidth=2)
+            ax.scatter([position], [condition['q0.5']], color='white', edgecolor='black', zorder=3, s=12)
+        elif kind == 'box':
+            stats = {'med': condition['q0.5'], 'q1': condition[quantile_cols[1]], 'q3': condition[quantile_cols[-2]], 'whislo': condition[quantile_cols[0]], 'whishi': condition[quantile_cols[-1]], 'mean': condition['mean'], 'fliers': []}
+            ax.bxp([stats], positions=[position], widths=half_width * 2, patch_artist=True, showfliers=False, boxprops={'facecolor': colour, 'alpha': 0.6})
+        elif kind == 'strip':
+            occupied = bins['count'].values > 0
+            ax.scatter(np.full(occupied.sum(), position), centres[occupied], s=4 + 60 * bins['density'].values[occupied], color=colour, alpha=0.6, linewidth=0)
+        else:
+            raise ValueError(f"kind must be 'violin', 'box' or 'strip', not {kind}")
+
+    ax.set_xticks(range(len(x_levels)))
+    ax.set_xticklabels(x_levels)
+    ax.set_xlim(-0.5, len(x_levels) - 0.5)
+    if hue_col:
+        for hue in hue_levels:
+            ax.scatter([], [], color=palette[hue] if palette and hue in palette else f'C{hue_levels.index(hue)}', label=hue)
+        ax.legend(title=hue_col)
+    return ax
+
+
+def save_figure(ax, output_path, dpi=300):
+    """Render the figure holding ax to file without display"""
+    fig = ax.get_figure()
+    fig.tight_layout()
+    fig.savefig(output_path, dpi=dpi)
+    logger.info(f'Figure saved to {output_path}')
@@ -0,0 +1,48 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def prefetch(items, loader, max_prefetch=4, max_workers=2):
+    """Loads items on background threads while the caller processes the current one, yielding results in the original order.
+
+    At most max_prefetch items are loaded (or loading) ahead of the item currently being processed, so memory is capped at roughly max_prefetch + 1 loaded items regardless of how many items there are.
+
+    Parameters
+    ----------
+    items : iterable
+        items to load, e.g. file paths or image names
+    loader : callable
+        function mapping a single item to its loaded value, e.g. lambda path: skimage.io.imread(path)
+    max_prefetch : int, optional
+        maximum number of items loaded ahead of the current item, by default 4
+    max_workers : int, optional
+        number of threads used for loading, by default 2
+
+    Yields
+    -------
+    tuple
+        (item, loader(item)) for each item, in order
+    """
+    items = iter(items)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(loader, item)))
+                if len(pending) >= max_prefetch:
+                    break
+            while pending:
+                item, future = pending.popleft()
+                result = future.result()
+                # queue the next load before handing over the current item, so decoding overlaps processing
+                for next_item in items:
+                    pending.append((next_item, executor.submit(loader, next_item)))
+                    break
+                yield item, result
+        finally:
+            for item, future in pending:
+                future.cancel()
@@ -0,0 +1,138 @@
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from utilities.chunked import MEMORY_LIMIT
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def pyramid_shapes(shape, downscale=2, min_size=512):
+    """Shapes of each pyramid level for an array whose last two axes are rows and columns, halving (by downscale) until both fit within min_size"""
+    shapes = [tuple(shape)]
+    while max(shapes[-1][-2:]) > min_size and min(shapes[-1][-2:]) >= downscale:
+        shapes.append(shapes[-1][:-2] + tuple(size // downscale for size in shapes[-1][-2:]))
+    return shapes
+
+
+def downsample(array, downscale=2, is_labels=False):
+    """Reduce the last two (spatial) axes of array by downscale.
+
+    Intensities are averaged over each block and kept in their native dtype, while labels take the top-left pixel of each block so that no new label values are created. Any rows or columns beyond a whole number of blocks are dropped.
+    """
+    rows, cols = (size // downscale * downscale for size in array.shape[-2:])
+    array = array[..., :rows, :cols]
+    if is_labels:
+        return array[..., ::downscale, ::downscale]
+    blocks = array.reshape(array.shape[:-2] + (rows // downscale, downscale, cols // downscale, downscale))
+    reduced = blocks.mean(axis=(-3, -1))
+    if np.issubdtype(array.dtype, np.integer):
+        reduced = np.round(reduced)
+    return reduced.astype(array.dtype)
+
+
+def pyramid_metadata(source=None, array=None, downscale=2, min_size=512, is_labels=False):
+    """Description of what a cached pyramid was built from: path, size and modification time of the source file (if any), shape and dtype of the array (if given) and pyramid parameters"""
+    metadata = {'downscale': downscale, 'min_size': min_size, 'is_labels': is_labels}
+    if source is not None:
+        stat = os.stat(source)
+        metadata['source'] = {'path': os.path.abspath(source), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if array is not None:
+        metadata.update({'shape': list(array.shape), 'dtype': str(array.dtype)})
+    return metadata
+
+
+def pyramid_current(output_folder, source=None, array=None, downscale=2, min_size=512, is_labels=False):
+    """Whether the pyramid cached in output_folder was built from the current version of source (and/or an array of the same shape and dtype) with the same parameters.
+
+    Checking against source alone needs no decoding of the image, so it can be called before reading the source. Caches without saved metadata (or left incomplete by an interrupted build) are never current.
+    """
+    if not os.path.exists(f'{output_folder}level_0.npy') or not os.path.exists(f'{output_folder}pyramid.json'):
+        return False
+    with open(f'{output_folder}pyramid.json') as stored:
+        cached = json.load(stored)
+    expected = pyramid_metadata(source=source, array=array, downscale=downscale, min_size=min_size, is_labels=is_labels)
+    return all(cached.get(key) == value for key, value in expected.items())
+
+
+def build_pyramid(array, output_folder, downscale=2, min_size=512, is_labels=False, memory_limit=MEMORY_LIMIT, overwrite=False, source=None):
+    """Builds a multiscale pyramid of array on disk, one memory-mappable level_n.npy per level, or opens the cached pyramid if it is current (see pyramid_current).
+
+    The source file, array shape and dtype and pyramid parameters are saved to pyramid.json alongside the levels, so a pyramid is rebuilt whenever its source changes.
+
+    Parameters
+    ----------
+    array : array
+        (possibly memory-mapped) image or label array in the order it will be displayed, where the last two axes are rows and columns (e.g. (C, H, W) or (T, H, W))
+    output_folder : str
+        folder in which levels are saved
+    downscale : int, optional
+        reduction in rows and columns between consecutive levels, by default 2
+    min_size : int, optional
+        levels are added until rows and columns of the smallest level fit within min_size, by default 512
+    is_labels : bool, optional
+        downsample by taking one pixel per block rather than the block mean, by default False
+    memory_limit : int, optional
+        maximum bytes of the previous level held in memory at once, by default MEMORY_LIMIT
+    overwrite : bool, optional
+        rebuild the pyramid even if it is already cached, by default False
+    source : str, optional
+        path of the file array was read from, by default None checks the cache against the shape and dtype of array only
+
+    Returns
+    -------
+    list
+        memory-mapped levels from full to lowest resolution (see open_pyramid)
+    """
+    metadata = pyramid_metadata(source=source, array=array, downscale=downscale, min_size=min_size, is_labels=is_labels)
+    if not overwrite and pyramid_current(output_folder, source=source, array=array, downscale=downscale, min_size=min_size, is_labels=is_labels):
+        return open_pyramid(output_folder)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    # levels of any earlier pyramid are removed, as the new pyramid may have fewer levels
+    for filename in os.listdir(output_folder):
+        if (filename.startswith('level_') and filename.endswith('.npy')) or filename == 'pyramid.json':
+            os.remove(f'{output_folder}{filename}')
+
+    shapes = pyramid_shapes(array.shape, downscale=downscale, min_size=min_size)
+    previous = array
+    for level, shape in enumerate(shapes):
+        out = open_memmap(f'{output_folder}level_{level}.npy', mode='w+', dtype=array.dtype, shape=shape)
+        # rows are processed in chunks aligned to whole blocks, so that only part of the previous level is read at once
+        factor = 1 if level == 0 else downscale
+        row_bytes = previous.nbytes // max(previous.shape[-2], 1)
+        step = max(factor, int(memory_limit // max(row_bytes, 1)) // factor * factor)
+        for start in range(0, shape[-2] * factor, step):
+            stop = min(start + step, shape[-2] * factor)
+            values = np.asarray(previous[..., start:stop, :shape[-1] * factor])
+            out[..., start // factor:stop // factor, :] = values if level == 0 else downsample(values, downscale=downscale, is_labels=is_labels)
+        out.flush()
+        previous = out
+    # metadata is written last, so an interrupted build is rebuilt on the next call
+    with open(f'{output_folder}pyramid.json', 'w') as stored:
+        json.dump(metadata, stored)
+    logger.info(f'Pyramid of {len(shapes)} levels saved to {output_folder}')
+    return open_pyramid(output_folder)
+
+
+def open_pyramid(input_folder):
+    """Opens all levels of a cached pyramid as read-only memory-maps, ordered from full to lowest resolution, so that only the displayed region of each level is read from disk"""
+    levels = sorted(
+        (filename for filename in os.listdir(input_folder) if filename.startswith('level_') and filename.endswith('.npy')),
+        key=lambda filename: int(filename[len('level_'):-len('.npy')]))
+    return [np.load(f'{input_folder}{filename}', mmap_mode='r') for filename in levels]
+
+
+def pyramid_layer(pyramid):
+    """Data and keyword arguments for displaying a pyramid as a napari layer, as a single array if there is only one level"""
+    if len(pyramid) == 1:
+        return pyramid[0], {}
+    return pyramid, {'multiscale': True}
+
+
+def pyramid_frame(pyramid, index):
+    """Lazily index the first axis of every level, e.g. to display a single timepoint of a (T, H, W) pyramid"""
+    return [level[index] for level in pyramid]
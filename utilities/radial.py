@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def boundary_distance(labels):
+    """Euclidean distance of every labelled pixel to the nearest pixel outside its own label (background or a touching label), from a single distance transform of the whole label image.
+
+    Parameters
+    ----------
+    labels : 2D-array
+        label image, background is 0
+
+    Returns
+    -------
+    array
+        float distance in pixels, where edge pixels of each label are 1 and background is 0
+    """
+    labels = np.asarray(labels)
+    # pixels bordering a different label (including background) are treated as outside, as for a one pixel wide moat between touching labels
+    padded = np.pad(labels, 1, mode='constant')
+    edge = np.zeros(labels.shape, dtype=bool)
+    for axis in range(2):
+        for step in (-1, 1):
+            edge |= np.roll(padded, step, axis=axis)[1:-1, 1:-1] != labels
+    inside = (labels != 0) & ~edge
+    distance = ndimage.distance_transform_edt(inside) + 1
+    distance[labels == 0] = 0
+    return distance
+
+
+def signed_distance(cells, reference):
+    """Signed distance of every cell pixel from the boundary of its own reference object (e.g. nucleus), positive inside and negative outside.
+
+    Pixels whose nearest reference pixel belongs to a different cell (or cells without a reference object) are NaN, so profiles are never measured against a neighbour's nucleus.
+
+    Parameters
+    ----------
+    cells : 2D-array
+        whole-cell label image, background is 0
+    reference : 2D-array
+        reference label image labelled by cell number (e.g. nucleus compartment)
+
+    Returns
+    -------
+    array
+        float signed distance in pixels, NaN outside cells
+    """
+    cells = np.asarray(cells)
+    reference = np.asarray(reference)
+    distance = np.full(cells.shape, np.nan)
+    in_cell = cells != 0
+    if not np.any(reference):
+        return distance
+
+    inside = boundary_distance(reference)
+    outside, indices = ndimage.distance_transform_edt(reference == 0, return_indices=True)
+    nearest = reference[tuple(indices)]
+
+    distance = np.where(reference != 0, inside, -outside)
+    distance[~in_cell | ((reference == 0) & (nearest != cells))] = np.nan
+    return distance
+
+
+def radial_profiles(image, cells, reference, bin_width=1., max_distance=None):
+    """Mean intensity of every cell and channel in bins of signed distance from the boundary of a reference compartment, in one bincount per channel.
+
+    Parameters
+    ----------
+    image : 3D-array
+        (rows, columns, channels) image
+    cells : 2D-array
+        whole-cell label image, background is 0
+    reference : 2D-array
+        reference compartment labelled by cell number (e.g. nucleus), from which distance is measured
+    bin_width : float, optional
+        width of distance bins in pixels, by default 1.
+    max_distance : float, optional
+        pixels further than max_distance from the boundary (either side) are excluded, by default None keeps all
+
+    Returns
+    -------
+    DataFrame
+        label, channel, distance (bin centre, positive inside the reference compartment), pixels and mean for every non-empty bin
+    """
+    distance = signed_distance(cells, reference)
+    valid = ~np.isnan(distance)
+    if max_distance is not None:
+        valid &= np.abs(np.nan_to_num(distance)) <= max_distance
+    if not np.any(valid):
+        return pd.DataFrame(columns=['label', 'channel', 'distance', 'pixels', 'mean'])
+
+    # bins are numbered outwards from the boundary, 1 --> n inside and -1 --> -n outside
+    bins = (np.sign(distance[valid]) * np.ceil(np.abs(distance[valid]) / bin_width)).astype(np.int64)
+    offset = bins.min()
+    num_bins = int(bins.max() - offset) + 1
+    index = np.asarray(cells)[valid].astype(np.int64) * num_bins + (bins - offset)
+
+    counts = np.bincount(index)
+    present = np.flatnonzero(counts)
+    labels, positions = present // num_bins, present % num_bins + offset
+    centres = np.where(positions > 0, (positions - 0.5) * bin_width, (positions + 0.5) * bin_width)
+
+    profiles = []
+    for channel in range(image.shape[2]):
+        sums = np.bincount(index, weights=np.asarray(image[:, :, channel], dtype=np.float64)[valid])
+        profiles.append(pd.DataFrame({'label': labels, 'channel': channel, 'distance': centres, 'pixels': counts[present], 'mean': sums[present] / counts[present]}))
+    return pd.concat(profiles).reset_index(drop=True)
+
+
+def eroded_statistics(image, mask_stack, mask_types, depths=(0, 1, 2, 4)):
+    """Per-label pixel count, mean and standard deviation of every channel within each compartment after eroding it by each depth, from one distance transform per compartment.
+
+    Parameters
+    ----------
+    image : 3D-array
+        (rows, columns, channels) image
+    mask_stack : 3D-array
+        compartment label images stacked along the first axis, e.g. [cytoplasm, aggregate, nucleus] labelled by cell number
+    mask_types : list of str
+        compartment name for each layer of mask_stack
+    depths : tuple of int, optional
+        erosion depths in pixels, where pixels within depth of the compartment boundary are excluded, by default (0, 1, 2, 4)
+
+    Returns
+    -------
+    DataFrame
+        label, mask_type, depth, channel, pixels, mean and std for every label with pixels remaining after erosion
+    """
+    results = []
+    for i, mask_type in enumerate(mask_types):
+        labels = np.asarray(mask_stack[i])
+        distance = boundary_distance(labels)
+        for depth in depths:
+            kept = distance > depth
+            if not np.any(kept):
+                continue
+            label_values = labels[kept].astype(np.int64)
+            counts = np.bincount(label_values)
+            present = np.flatnonzero(counts[1:]) + 1
+            for channel in range(image.shape[2]):
+                values = np.asarray(image[:, :, channel], dtype=np.float64)[kept]
+                means = np.bincount(label_values, weights=values) / np.maximum(counts, 1)
+                # deviations from each label's mean, avoiding cancellation in sum of squares
+                variance = np.bincount(label_values, weights=(values - means[label_values]) ** 2) / np.maximum(counts - 1, 1)
+                results.append(pd.DataFrame({
+                    'label': present, 'mask_type': mask_type, 'depth': depth, 'channel': channel,
+                    'pixels': counts[present], 'mean': means[present], 'std': np.sqrt(variance[present])}))
+    if not results:
+        return pd.DataFrame(columns=['label', 'mask_type', 'depth', 'channel', 'pixels', 'mean', 'std'])
+    return pd.concat(results).reset_index(drop=True)
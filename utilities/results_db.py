@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# default location of the database shared by all experiments
+DATABASE_PATH = 'results/results.db'
+
+# columns indexed wherever they are present, for fast cross-experiment filtering and grouping
+INDEX_COLS = ['experiment', 'mutant', 'treatment', 'chaperone', 'image_name']
+
+
+def connect(db_path=DATABASE_PATH):
+    """Opens (creating if necessary) the results database"""
+    folder = os.path.dirname(db_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    return sqlite3.connect(db_path)
+
+
+def table_columns(connection, table):
+    """Names of columns in table, or an empty list if the table does not exist"""
+    return [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+
+
+def append_results(results, table, experiment, db_path=DATABASE_PATH, index_cols=INDEX_COLS, chunksize=10000):
+    """Appends results for one experiment to table, replacing any rows previously saved for that experiment so stages can be re-run. Rows are deleted and inserted in a single transaction, so a failed insert leaves earlier results in place.
+
+    Parameters
+    ----------
+    results : DataFrame
+        per-cell, per-ROI or per-timepoint results
+    table : str
+        table name, e.g. 'chaperone_cells'
+    experiment : str
+        experiment identifier stored in the 'experiment' column, unique to the dataset (e.g. from dataset_name of the manifest)
+    db_path : str, optional
+        path to database, by default DATABASE_PATH
+    index_cols : list of str, optional
+        columns to index where present, by default INDEX_COLS
+    chunksize : int, optional
+        rows inserted per statement, by default 10000
+    """
+    results = results.drop([col for col in results.columns.tolist() if 'Unnamed: ' in col], axis=1).copy()
+    results.insert(0, 'experiment', experiment)
+    # values converted to python types (with missing values as NULL) for sqlite
+    rows = results.astype(object).where(results.notna(), None).values.tolist()
+
+    connection = connect(db_path)
+    # transactions are managed explicitly, so rows replaced for this experiment are never committed half-written
+    connection.isolation_level = None
+    try:
+        connection.execute('BEGIN')
+        existing = table_columns(connection, table)
+        if existing:
+            # tables grow new columns as stages gain outputs, rather than failing on append
+            for col in results.columns:
+                if col not in existing:
+                    connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{col}"')
+            connection.execute(f'DELETE FROM "{table}" WHERE experiment = ?', (experiment, ))
+        else:
+            connection.execute(pd.io.sql.get_schema(results, table, con=connection))
+        columns = ', '.join(f'"{col}"' for col in results.columns)
+        placeholders = ', '.join('?' for _ in results.columns)
+        for start in range(0, len(rows), chunksize):
+            connection.executemany(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})', rows[start:start + chunksize])
+        for col in index_cols:
+            if col in results.columns:
+                connection.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{col}" ON "{table}" ("{col}")')
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    logger.info(f'{len(results)} rows saved to {table} for {experiment}')
+
+
+def query(sql, db_path=DATABASE_PATH, params=None):
+    """Runs sql against the results database, returning a DataFrame
+
+    e.g. query('SELECT chaperone, AVG("nuc-cyto_ratio") FROM chaperone_ratios GROUP BY chaperone')
+    """
+    connection = connect(db_path)
+    try:
+        return pd.read_sql_query(sql, connection, params=params)
+    finally:
+        connection.close()
+
+
+def experiments(db_path=DATABASE_PATH):
+    """Row count of every experiment in every table"""
+    connection = connect(db_path)
+    try:
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        counts = [pd.read_sql_query(f'SELECT experiment, COUNT(*) AS num_rows FROM "{table}" GROUP BY experiment', connection).assign(table=table) for table in tables]
+    finally:
+        connection.close()
+    if not counts:
+        return pd.DataFrame(columns=['table', 'experiment', 'num_rows'])
+    return pd.concat(counts)[['table', 'experiment', 'num_rows']].reset_index(drop=True)
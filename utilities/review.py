@@ -0,0 +1,166 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# default key bindings for navigating a review session
+KEYS = {
+    'next': 'PageDown',
+    'previous': 'PageUp',
+    'save': 'Shift-S',
+    'reload': 'Shift-R',
+}
+
+
+class ReviewSession:
+    """Reviews a sequence of items (e.g. images, ROIs or frames) in a single napari viewer which stays open for the whole session.
+
+    Layers for each item are only loaded when the item is shown (or preloaded in the background for the following item), existing layers are updated in place rather than re-created, and edits are saved whenever the session moves away from an edited item or is closed. Items which were not edited are never re-saved, so paging through earlier items cannot overwrite their saved results, unless needs_save reports that an item has no saved result yet (e.g. raw labels accepted without edits).
+
+    Parameters
+    ----------
+    items : list
+        items to review, in order
+    load_item : callable
+        maps an item to a list of (name, layer_type, data, kwargs) layer definitions, where layer_type is one of 'image', 'labels' or 'shapes'. Data may be a list of pyramid levels with kwargs {'multiscale': True} (see utilities.pyramid). Called from a background thread when preload is True, so should only read data.
+    save_item : callable, optional
+        called as save_item(item, layers) with a dict mapping layer name to current layer data whenever edits are saved. The returned value is kept in results. By default None does not save.
+    needs_save : callable, optional
+        maps an item to whether it has no saved result yet, so it is saved on leaving even if unedited, by default None saves edited items only
+    title : str, optional
+        prefix for the viewer title, by default 'review'
+    preload : bool, optional
+        load the next item while the current item is reviewed, by default True. Should be False if load_item depends on edits saved for earlier items.
+    keys : dict, optional
+        key bindings for 'next', 'previous', 'save' and 'reload', by default KEYS
+
+    Example
+    -------
+    session = ReviewSession(image_names, load_item=load_layers, save_item=save_layers)
+    results = session.run()
+    """
+
+    def __init__(self, items, load_item, save_item=None, needs_save=None, title='review', preload=True, keys=KEYS):
+        self.items = list(items)
+        self.load_item = load_item
+        self.save_item = save_item
+        self.needs_save = needs_save
+        self.title = title
+        self.keys = keys
+        self.position = 0
+        self.viewer = None
+        self.results = {}
+        self._loaded = {}
+        self._loading = {}
+        self._executor = ThreadPoolExecutor(max_workers=1) if preload else None
+
+    def _request(self, position):
+        if position in self._loading or not 0 <= position < len(self.items):
+            return
+        if self._executor is None:
+            return
+        self._loading[position] = self._executor.submit(self.load_item, self.items[position])
+
+    def _layers(self, position):
+        if position in self._loading:
+            layers = self._loading.pop(position).result()
+        else:
+            layers = self.load_item(self.items[position])
+        # keep at most the following item loading in the background
+        for stale in [key for key in self._loading if key != position + 1]:
+            self._loading.pop(stale).cancel()
+        self._request(position + 1)
+        return layers
+
+    def show(self, position):
+        """Display the item at position, replacing data of existing layers with the same name and type"""
+        self.position = position
+        layers = self._layers(position)
+        names = [name for name, layer_type, data, kwargs in layers]
+        for layer in [layer for layer in self.viewer.layers if layer.name not in names]:
+            self.viewer.layers.remove(layer)
+        for name, layer_type, data, kwargs in layers:
+            existing = {layer.name: layer for layer in self.viewer.layers}
+            layer = existing.get(name)
+            # shapes and multiscale (pyramid) layers are re-created as their type is set on creation, and are cheap to draw
+            if layer is not None and (layer_type == 'shapes' or kwargs.get('multiscale') or getattr(layer, 'multiscale', False) or type(layer).__name__.lower() != layer_type):
+                self.viewer.layers.remove(layer)
+                layer = None
+            if layer is None:
+                getattr(self.viewer, f'add_{layer_type}')(data, name=name, **kwargs)
+            elif layer.data is not data:
+                layer.data = data
+        # copies of editable layers as shown, as napari edits layer data in place
+        self._loaded = {
+            layer.name: _snapshot(layer.data) for layer in self.viewer.layers
+            if type(layer).__name__.lower() in ('labels', 'shapes') and not getattr(layer, 'multiscale', False)}
+        self.viewer.title = f'{self.title}: {self.items[position]} ({position + 1}/{len(self.items)})'
+        logger.info(f'Reviewing {self.items[position]} ({position + 1}/{len(self.items)})')
+
+    def current_layers(self):
+        """Current data of every layer in the viewer, keyed by layer name"""
+        return {layer.name: layer.data for layer in self.viewer.layers}
+
+    def changed(self):
+        """Whether any labels or shapes layer has been edited since the current item was shown"""
+        current = self.current_layers()
+        return any(name not in current or not _equal(current[name], data) for name, data in self._loaded.items())
+
+    def should_save(self):
+        """Whether the current item has been edited, or has never been saved"""
+        item = self.items[self.position]
+        return self.changed() or (self.needs_save is not None and item not in self.results and self.needs_save(item))
+
+    def save(self):
+        """Save edits to the current item"""
+        if self.save_item is None:
+            return
+        item = self.items[self.position]
+        self.results[item] = self.save_item(item, self.current_layers())
+        logger.info(f'Saved {item}')
+
+    def move(self, step):
+        """Save the current item if it has been edited (or has no saved result), then show the item step positions away"""
+        position = self.position + step
+        if not 0 <= position < len(self.items):
+            logger.info('No further items to review')
+            return
+        if self.should_save():
+            self.save()
+        self.show(position)
+
+    def run(self, start=0):
+        """Open the viewer at item start, returning results of save_item for every saved item once the viewer is closed"""
+        if not self.items:
+            return self.results
+        # napari is only needed once a viewer is opened, so modules using ReviewSession import without a display
+        import napari
+        with napari.gui_qt():
+            self.viewer = napari.Viewer(title=self.title)
+            self.viewer.bind_key(self.keys['next'], lambda viewer: self.move(1))
+            self.viewer.bind_key(self.keys['previous'], lambda viewer: self.move(-1))
+            self.viewer.bind_key(self.keys['save'], lambda viewer: self.save())
+            self.viewer.bind_key(self.keys['reload'], lambda viewer: self.show(self.position))
+            self.show(start)
+            logger.info(f"{self.keys['next']}: next, {self.keys['previous']}: previous, {self.keys['save']}: save, {self.keys['reload']}: discard unsaved edits")
+        # closing the viewer saves the item being reviewed, if edited or not yet saved
+        if self.should_save():
+            self.save()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        return self.results
+
+
+def _snapshot(data):
+    """Copy of labels data (an array) or shapes data (a list of arrays)"""
+    if isinstance(data, list):
+        return [np.array(shape, copy=True) for shape in data]
+    return np.array(data, copy=True)
+
+
+def _equal(current, loaded):
+    if isinstance(loaded, list):
+        return len(current) == len(loaded) and all(np.array_equal(np.asarray(shape), original) for shape, original in zip(current, loaded))
+    return np.array_equal(np.asarray(current), loaded)
@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.signal import fftconvolve
+from skimage.draw import polygon2mask
+from skimage.filters import threshold_otsu
+from skimage.morphology import closing, square
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# order of ROI masks in FRAP mask stacks
+ROI_TYPES = ['background', 'non-bleach', 'bleach']
+
+
+def ellipse_axes(data):
+    """Centre and two half-axis vectors of an ellipse given either as napari (centre, radii) data of shape (2, 2) or as the (4, 2) corners of its (possibly rotated) bounding box, in (row, column) coordinates"""
+    data = np.asarray(data, dtype=np.float64)
+    if data.shape == (2, 2):
+        centre, radii = data
+        return centre, np.array([radii[0], 0.]), np.array([0., radii[1]])
+    centre = data.mean(axis=0)
+    return centre, (data[1] - data[0]) / 2, (data[3] - data[0]) / 2
+
+
+def rasterise_ellipses(frame_shape, ellipses):
+    """Rasterise any number of ellipses at once by broadcasting over a (n, rows, columns) grid.
+
+    Parameters
+    ----------
+    frame_shape : tuple
+        (rows, columns) of the output masks
+    ellipses : list of array
+        ellipse data as accepted by ellipse_axes
+
+    Returns
+    -------
+    array
+        boolean array of shape (n, rows, columns), one mask per ellipse
+    """
+    if len(ellipses) == 0:
+        return np.zeros((0,) + tuple(frame_shape), dtype=bool)
+    centres, first, second = [np.stack(values) for values in zip(*[ellipse_axes(data) for data in ellipses])]
+    rows = np.arange(frame_shape[0], dtype=np.float64)[None, :, None] - centres[:, 0, None, None]
+    cols = np.arange(frame_shape[1], dtype=np.float64)[None, None, :] - centres[:, 1, None, None]
+    # position along each half-axis, as a fraction of its length
+    with np.errstate(divide='ignore', invalid='ignore'):
+        along_first = (rows * first[:, 0, None, None] + cols * first[:, 1, None, None]) / (first ** 2).sum(axis=1)[:, None, None]
+        along_second = (rows * second[:, 0, None, None] + cols * second[:, 1, None, None]) / (second ** 2).sum(axis=1)[:, None, None]
+    return along_first ** 2 + along_second ** 2 <= 1
+
+
+def rasterise_shapes(frame_shape, shapes, shape_type='ellipse'):
+    """Rasterise the union of one or more shapes (e.g. the data of one napari Shapes layer) to a boolean mask of any frame size.
+
+    Parameters
+    ----------
+    frame_shape : tuple
+        (rows, columns) of the output mask
+    shapes : array or list of array
+        single shape, or list of shapes, in (row, column) coordinates
+    shape_type : str, optional
+        'ellipse', 'polygon' or 'rectangle', by default 'ellipse'
+
+    Returns
+    -------
+    array
+        boolean mask of frame_shape
+    """
+    shapes = [shapes] if isinstance(shapes, np.ndarray) and shapes.ndim == 2 else list(shapes)
+    if shape_type == 'ellipse':
+        return rasterise_ellipses(frame_shape, shapes).any(axis=0)
+    if shape_type in ('polygon', 'rectangle'):
+        mask = np.zeros(frame_shape, dtype=bool)
+        for vertices in shapes:
+            mask |= polygon2mask(frame_shape, np.asarray(vertices))
+        return mask
+    raise ValueError(f"shape_type must be 'ellipse', 'polygon' or 'rectangle', not {shape_type}")
+
+
+def roi_mask_stacks(frame_shape, roi_shapes):
+    """Boolean [background, non-bleach, bleach] mask stacks for any number of ROIs (or ROI edits at different timepoints), rasterising all ellipses in a single pass.
+
+    Parameters
+    ----------
+    frame_shape : tuple
+        (rows, columns) of the masks
+    roi_shapes : dict
+        mapping of key (e.g. ROI name or (ROI name, timepoint)) to a dict mapping each of ROI_TYPES to one ellipse, or a list of ellipses
+
+    Returns
+    -------
+    dict
+        mapping each key to a boolean array of shape (3, rows, columns)
+    """
+    ellipses, owners = [], []
+    for key, shapes in roi_shapes.items():
+        for i, roi_type in enumerate(ROI_TYPES):
+            members = shapes[roi_type]
+            members = [members] if isinstance(members, np.ndarray) and members.ndim == 2 else list(members)
+            ellipses += members
+            owners += [(key, i)] * len(members)
+    masks = rasterise_ellipses(frame_shape, ellipses)
+
+    stacks = {key: np.zeros((len(ROI_TYPES),) + tuple(frame_shape), dtype=bool) for key in roi_shapes}
+    for (key, i), mask in zip(owners, masks):
+        stacks[key][i] |= mask
+    return stacks
+
+
+def detect_bleach_rois(bleach_image):
+    """Threshold the first bleach frame to find bleached regions, returning their labels and the centroid and radius of each.
+
+    Parameters
+    ----------
+    bleach_image : 2D-array
+        frame acquired during bleaching, where bleached regions are bright
+
+    Returns
+    -------
+    tuple(array, DataFrame)
+        label image of bleached regions, and a DataFrame indexed by label with y, x (centroid) and radii (half the smaller bounding box side)
+    """
+    bleach_image = np.asarray(bleach_image)
+    thresh = threshold_otsu(bleach_image)
+    labels = ndimage.label(closing(bleach_image > thresh, square(4)), structure=np.ones((3, 3)))[0]
+    roi_labels = np.arange(1, labels.max() + 1)
+    centroids = pd.DataFrame(ndimage.center_of_mass(np.ones(labels.shape), labels, roi_labels), columns=['y', 'x'], index=pd.Index(roi_labels, name='label'))
+    boxes = ndimage.find_objects(labels)
+    centroids['radii'] = [min(box[0].stop - 1 - box[0].start, box[1].stop - 1 - box[1].start) / 2 for box in boxes]
+    return labels, centroids
+
+
+def disc_means(image, radius):
+    """Mean intensity within a disc of the given radius centred on every pixel, by FFT convolution"""
+    extent = int(np.ceil(radius))
+    rows, cols = np.mgrid[-extent:extent + 1, -extent:extent + 1]
+    kernel = (rows ** 2 + cols ** 2 <= radius ** 2).astype(np.float64)
+    return fftconvolve(np.asarray(image, dtype=np.float64), kernel / kernel.sum(), mode='same')
+
+
+def place_rois(image, centroids, margin=2, max_offset=None):
+    """Automatically place a non-bleach and a background ROI of the same radius for every bleached ROI.
+
+    The non-bleach ROI is the brightest disc (i.e. unbleached material of the same aggregate) near the bleached ROI, and the background ROI the dimmest disc anywhere in the frame. Neither overlaps any bleached ROI, the other placed ROI nor the frame edge. Candidate positions for all ROIs are scored at once from disc means of the image.
+
+    Parameters
+    ----------
+    image : 2D-array
+        frame used to score positions, e.g. the mean of pre-bleach frames
+    centroids : DataFrame
+        y, x and radii of each bleached ROI, as from detect_bleach_rois
+    margin : float, optional
+        minimum gap in pixels between ROIs, by default 2
+    max_offset : float, optional
+        maximum distance between the centres of the bleached and non-bleach ROIs, by default 4 times the radius
+
+    Returns
+    -------
+    DataFrame
+        centroids with nonbleach_y, nonbleach_x, background_y and background_x columns added
+    """
+    image = np.asarray(image, dtype=np.float64)
+    rows, cols = np.ogrid[:image.shape[0], :image.shape[1]]
+    placed = centroids.copy()
+    for column in ['nonbleach_y', 'nonbleach_x', 'background_y', 'background_x']:
+        placed[column] = np.nan
+
+    for radius, group in centroids.groupby('radii'):
+        means = disc_means(image, radius)
+        inside = (rows >= radius) & (rows < image.shape[0] - radius) & (cols >= radius) & (cols < image.shape[1] - radius)
+        # centres of every bleached ROI, with the clearance needed from each
+        distance_sq = (rows[None] - centroids['y'].values[:, None, None]) ** 2 + (cols[None] - centroids['x'].values[:, None, None]) ** 2
+        clear = inside & (distance_sq > (centroids['radii'].values[:, None, None] + radius + margin) ** 2).all(axis=0)
+
+        for roi_label, roi in group.iterrows():
+            offset = 4 * radius if max_offset is None else max_offset
+            near = clear & ((rows - roi['y']) ** 2 + (cols - roi['x']) ** 2 <= offset ** 2)
+            if not np.any(near):
+                logger.info(f'No clear position found for non-bleach ROI {roi_label}')
+                continue
+            nonbleach = np.unravel_index(np.argmax(np.where(near, means, -np.inf)), image.shape)
+            apart = clear & ((rows - nonbleach[0]) ** 2 + (cols - nonbleach[1]) ** 2 > (2 * radius + margin) ** 2)
+            background = np.unravel_index(np.argmin(np.where(apart, means, np.inf)), image.shape)
+            placed.loc[roi_label, ['nonbleach_y', 'nonbleach_x', 'background_y', 'background_x']] = [nonbleach[0], nonbleach[1], background[0], background[1]]
+    return placed
+
+
+def placed_shapes(placed):
+    """Ellipse data (napari (centre, radii) format in (row, column) coordinates) for the ROIs placed by place_rois, as a dict mapping ROI label to a dict of ROI_TYPES"""
+    shapes = {}
+    for roi_label, roi in placed.iterrows():
+        radii = [roi['radii'], roi['radii']]
+        # ROIs which could not be placed default to the bleach centroid, to be moved during review
+        nonbleach = [roi['y'], roi['x']] if np.isnan(roi['nonbleach_y']) else [roi['nonbleach_y'], roi['nonbleach_x']]
+        background = [roi['radii'] + 1, roi['radii'] + 1] if np.isnan(roi['background_y']) else [roi['background_y'], roi['background_x']]
+        shapes[roi_label] = {
+            'background': np.array([background, radii]),
+            'non-bleach': np.array([nonbleach, radii]),
+            'bleach': np.array([[roi['y'], roi['x']], radii]),
+        }
+    return shapes
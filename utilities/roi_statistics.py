@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def roi_histograms(image, mask_stack, mask_types, channels=None):
+    """Builds exact intensity histograms for every (label, mask_type, channel) combination in one pass per mask type.
+
+    Parameters
+    ----------
+    image : 3D-array
+        integer (e.g. uint16) image with channels as the last dimension
+    mask_stack : 3D-array
+        label images stacked along the first axis (e.g. compartments labelled by cell number), background is 0
+    mask_types : list of str
+        name of each layer in mask_stack
+    channels : list of int, optional
+        channels to be collected, by default None collects all channels
+
+    Returns
+    -------
+    DataFrame
+        sparse histograms with label, mask_type, channel, intensity and count columns, sorted by label, mask_type, channel then intensity
+    """
+    if not np.issubdtype(image.dtype, np.integer):
+        raise ValueError(f'Exact histograms require an integer image, not {image.dtype}')
+    if channels is None:
+        channels = list(range(image.shape[-1]))
+    num_channels = len(channels)
+    num_values = int(np.iinfo(image.dtype).max) + 1 if image.dtype.itemsize <= 2 else int(image.max()) + 1
+
+    histograms = []
+    for i, mask_type in enumerate(mask_types):
+        y, x = np.nonzero(mask_stack[i])
+        labels = mask_stack[i][y, x].astype(np.int64)
+        values = image[y, x][:, channels].astype(np.int64)
+        # combine label, channel and intensity into a single key to count all histograms at once
+        keys = (labels[:, None] * num_channels + np.arange(num_channels)[None, :]) * num_values + values
+        keys, counts = np.unique(keys.ravel(), return_counts=True)
+        histograms.append(pd.DataFrame({
+            'label': keys // (num_channels * num_values),
+            'mask_type': mask_type,
+            'channel': np.asarray(channels)[(keys // num_values) % num_channels],
+            'intensity': keys % num_values,
+            'count': counts,
+        }))
+    histograms = pd.concat(histograms)
+    return histograms.sort_values(['label', 'mask_type', 'channel', 'intensity']).reset_index(drop=True)
+
+
+def _sorted_quantiles(values, counts, group_index, quantiles):
+    """Linearly interpolated quantiles (matching pandas/numpy defaults) from histograms sorted by group then value"""
+    cumulative = np.cumsum(counts)
+    group_total = np.bincount(group_index, weights=counts).astype(np.int64)
+    group_start = np.concatenate([[0], np.cumsum(group_total)[:-1]])
+
+    results = {}
+    for quantile in quantiles:
+        position = (group_total - 1) * quantile
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        lower_value = values[np.searchsorted(cumulative, group_start + lower, side='right')]
+        upper_value = values[np.searchsorted(cumulative, group_start + upper, side='right')]
+        results[quantile] = lower_value + (position - lower) * (upper_value - lower_value)
+    return results
+
+
+def histogram_quantiles(histograms, quantiles=(0.5,), group_cols=['label', 'mask_type', 'channel']):
+    """Computes exact quantiles for each group of sparse intensity histograms.
+
+    Parameters
+    ----------
+    histograms : DataFrame
+        sparse histograms with group_cols, intensity and count columns, as from roi_histograms
+    quantiles : tuple of float, optional
+        quantiles to compute, by default (0.5,) for the median
+    group_cols : list of str, optional
+        columns identifying each histogram, by default ['label', 'mask_type', 'channel']
+
+    Returns
+    -------
+    DataFrame
+        group_cols with one column per quantile (e.g. q0.5)
+    """
+    histograms = histograms.sort_values(group_cols + ['intensity'])
+    groups = histograms.groupby(group_cols, sort=False).ngroup().values
+    results = _sorted_quantiles(histograms['intensity'].values.astype(float), histograms['count'].values, groups, quantiles)
+
+    summary = histograms[group_cols].drop_duplicates().reset_index(drop=True)
+    for quantile, values in results.items():
+        summary[f'q{quantile}'] = values
+    return summary
+
+
+def histogram_summary(histograms, quantiles=(0.25, 0.5, 0.75), saturation=65535, group_cols=['label', 'mask_type', 'channel']):
+    """Summarises sparse intensity histograms with pixel count, mean, median, quantiles, median absolute deviation (MAD) and saturated pixel count.
+
+    Parameters
+    ----------
+    histograms : DataFrame
+        sparse histograms with group_cols, intensity and count columns, as from roi_histograms
+    quantiles : tuple of float, optional
+        quantiles to compute in addition to the median, by default (0.25, 0.5, 0.75)
+    saturation : int, optional
+        intensity at or above which pixels are considered saturated, by default 65535
+    group_cols : list of str, optional
+        columns identifying each histogram, by default ['label', 'mask_type', 'channel']
+
+    Returns
+    -------
+    DataFrame
+        group_cols with count, mean, median, q{quantile}, mad and saturated columns
+    """
+    histograms = histograms.sort_values(group_cols + ['intensity']).reset_index(drop=True)
+    grouped = histograms.assign(weighted=histograms['intensity'] * histograms['count'], saturated=np.where(histograms['intensity'] >= saturation, histograms['count'], 0)).groupby(group_cols, sort=False)
+    summary = grouped[['count', 'weighted', 'saturated']].sum().reset_index()
+    summary['mean'] = summary['weighted'] / summary['count']
+    summary.drop('weighted', axis=1, inplace=True)
+
+    groups = grouped.ngroup().values
+    intensity = histograms['intensity'].values.astype(float)
+    counts = histograms['count'].values
+    results = _sorted_quantiles(intensity, counts, groups, sorted(set(quantiles) | {0.5}))
+    summary['median'] = results[0.5]
+    for quantile in quantiles:
+        summary[f'q{quantile}'] = results[quantile]
+
+    # MAD is the median of absolute deviations from the median, computed from the re-sorted deviation histogram
+    deviation = np.abs(intensity - summary['median'].values[groups])
+    order = np.lexsort((deviation, groups))
+    summary['mad'] = _sorted_quantiles(deviation[order], counts[order], groups[order], (0.5,))[0.5]
+
+    return summary[group_cols + ['count', 'mean', 'median'] + [f'q{quantile}' for quantile in quantiles] + ['mad', 'saturated']]
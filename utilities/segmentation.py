@@ -0,0 +1,469 @@
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from skimage.filters import sobel, threshold_otsu
+from skimage.segmentation import find_boundaries, watershed, relabel_sequential
+from skimage.transform import downscale_local_mean
+
+from utilities.label_metrics import foreground_iou, object_iou
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def tile_windows(shape, tile_size=1024, overlap=128):
+    """Split an image into overlapping tiles, with each tile owning a non-overlapping core region.
+
+    Parameters
+    ----------
+    shape : tuple
+        (rows, columns) of the full image
+    tile_size : int, optional
+        edge length of each tile in pixels, by default 1024
+    overlap : int, optional
+        number of pixels shared between neighbouring tiles, by default 128. Should exceed the diameter of the largest object of interest so that any object is fully contained in the tile which owns it.
+
+    Returns
+    -------
+    list of tuple(tuple(slice, slice), tuple(slice, slice))
+        window: (row, column) slices of the tile in the full image
+        core: (row, column) slices of the region owned by the tile, in full image coordinates. Cores tile the image exactly once.
+    """
+    if overlap >= tile_size:
+        raise ValueError(f'Overlap ({overlap}) must be smaller than tile size ({tile_size})')
+
+    def axis_windows(length):
+        if length <= tile_size:
+            return [(0, length)], [(0, length)]
+        starts = list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+        windows = [(start, start + tile_size) for start in starts]
+        # core boundaries sit midway through the overlap between neighbouring tiles
+        bounds = [0] + [(windows[x + 1][0] + windows[x][1]) // 2 for x in range(len(windows) - 1)] + [length]
+        cores = list(zip(bounds[:-1], bounds[1:]))
+        return windows, cores
+
+    row_windows, row_cores = axis_windows(shape[0])
+    col_windows, col_cores = axis_windows(shape[1])
+
+    return [
+        ((slice(*row_window), slice(*col_window)), (slice(*row_core), slice(*col_core)))
+        for row_window, row_core in zip(row_windows, row_cores)
+        for col_window, col_core in zip(col_windows, col_cores)
+    ]
+
+
+def owned_labels(tile_labels, window, core):
+    """Collect labels within a tile whose centroid falls inside the core region owned by that tile.
+
+    Parameters
+    ----------
+    tile_labels : 2D-array
+        label image returned by segmentation of a single tile, background is 0
+    window : tuple(slice, slice)
+        position of the tile in the full image
+    core : tuple(slice, slice)
+        region of the full image owned by this tile
+
+    Returns
+    -------
+    array
+        label values owned by this tile
+    """
+    tile_labels = np.asarray(tile_labels)
+    max_label = int(tile_labels.max())
+    if max_label == 0:
+        return np.array([], dtype=tile_labels.dtype)
+
+    rows, cols = np.nonzero(tile_labels)
+    values = tile_labels[rows, cols]
+    counts = np.bincount(values, minlength=max_label + 1)
+    present = np.nonzero(counts)[0]
+    present = present[present > 0]
+    # centroids in full image coordinates
+    centroid_rows = np.bincount(values, weights=rows, minlength=max_label + 1)[present] / counts[present] + window[0].start
+    centroid_cols = np.bincount(values, weights=cols, minlength=max_label + 1)[present] / counts[present] + window[1].start
+
+    inside = (
+        (centroid_rows >= core[0].start) & (centroid_rows < core[0].stop)
+        & (centroid_cols >= core[1].start) & (centroid_cols < core[1].stop)
+    )
+    return present[inside]
+
+
+def segment_tiled(image, segment_fn, tile_size=1024, overlap=128, max_workers=1, out=None, dtype=np.int32):
+    """Segment a large image tile-by-tile and stitch the tile labels into a single consistent label image.
+
+    Each object is kept from the tile which contains its centroid in its core region, and relabelled sequentially across the full image. Tiles are read from `image` only when they are submitted, and at most `max_workers` + 1 tiles are held in memory at once, so memory scales with tile size rather than image size when `image` and `out` are memory-mapped.
+
+    Parameters
+    ----------
+    image : array
+        image to be segmented, with rows and columns as the first two dimensions. Any array supporting slicing (e.g. np.memmap or np.load(..., mmap_mode='r')) can be provided.
+    segment_fn : callable
+        function mapping a single tile to a 2D label image of the same (rows, columns), where background is 0
+    tile_size : int, optional
+        edge length of each tile in pixels, by default 1024
+    overlap : int, optional
+        number of pixels shared between neighbouring tiles, by default 128. Should exceed the diameter of the largest object.
+    max_workers : int, optional
+        number of tiles segmented concurrently, by default 1 to stream tiles sequentially (recommended for GPU models)
+    out : array, optional
+        pre-allocated output label array (e.g. from np.lib.format.open_memmap), by default None creates a new in-memory array
+    dtype : numpy dtype, optional
+        dtype of the output label array if `out` is not provided, by default np.int32
+
+    Returns
+    -------
+    array
+        stitched label image with rows and columns matching image, background is 0
+    """
+    shape = image.shape[:2]
+    if out is None:
+        out = np.zeros(shape, dtype=dtype)
+    windows = tile_windows(shape, tile_size=tile_size, overlap=overlap)
+    logger.info(f'Segmenting {shape} image as {len(windows)} tiles')
+
+    next_label = 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        tiles = iter(windows)
+        while True:
+            # keep a bounded number of tiles in flight, collected in submission order so stitching is deterministic
+            while len(pending) <= max_workers:
+                try:
+                    window, core = next(tiles)
+                except StopIteration:
+                    break
+                tile = np.asarray(image[window])
+                pending.append((window, core, executor.submit(segment_fn, tile)))
+            if not pending:
+                break
+            window, core, future = pending.popleft()
+            tile_labels = np.asarray(future.result())
+
+            keep = owned_labels(tile_labels, window, core)
+            if len(keep) == 0:
+                continue
+            lut = np.zeros(int(tile_labels.max()) + 1, dtype=out.dtype)
+            lut[keep] = np.arange(next_label, next_label + len(keep))
+            next_label += len(keep)
+
+            # first owner wins where neighbouring objects disagree along a seam
+            relabelled = lut[tile_labels]
+            region = out[window]
+            np.copyto(region, relabelled, where=(relabelled != 0) & (region == 0))
+            out[window] = region
+
+    logger.info(f'Stitched {next_label - 1} objects')
+    return out
+
+
+def resolution_factor(diameter, model_diameter=30.):
+    """Largest integer downsampling factor which keeps objects at or above the diameter the model was trained on (30 for cellpose 'cyto', 17 for 'nuclei')"""
+    if diameter is None:
+        return 1
+    return max(1, int(diameter // model_diameter))
+
+
+def upsample_labels(labels, factor, shape):
+    """Nearest-neighbour upsampling of a label image by an integer factor, cropped or padded to shape"""
+    upsampled = np.repeat(np.repeat(labels, factor, axis=0), factor, axis=1)[:shape[0], :shape[1]]
+    pad = [(0, shape[0] - upsampled.shape[0]), (0, shape[1] - upsampled.shape[1])]
+    return np.pad(upsampled, pad, mode='edge')
+
+
+def refine_boundaries(labels, image, width=2):
+    """Re-assign pixels close to label boundaries using a seeded watershed on the full-resolution image gradient.
+
+    Pixels further than `width` from any boundary keep their (upsampled) label and act as seeds, including the background. Pixels within the band are re-assigned to whichever seed they are reached from along the image gradient, so that boundaries snap back onto full-resolution edges.
+
+    Parameters
+    ----------
+    labels : 2D-array
+        upsampled label image, background is 0
+    image : 2D-array
+        full-resolution intensity image
+    width : int, optional
+        half-width of the band around boundaries which is re-assigned, by default 2 (usually the downsampling factor)
+
+    Returns
+    -------
+    2D-array
+        refined label image
+    """
+    band = ndimage.binary_dilation(find_boundaries(labels, mode='thick'), iterations=width)
+    background = int(labels.max()) + 1
+    markers = np.where(labels == 0, background, labels)
+    markers[band] = 0
+    refined = watershed(sobel(image.astype(np.float32)), markers)
+    refined[refined == background] = 0
+    return refined.astype(labels.dtype)
+
+
+def segment_downsampled(image, segment_fn, factor, refine=True):
+    """Segment an image at reduced resolution, then upsample the labels back to full resolution.
+
+    Parameters
+    ----------
+    image : 2D-array
+        full-resolution intensity image
+    segment_fn : callable
+        function mapping (image, factor) to a label image of the same shape as the image provided. The factor is passed so that resolution-dependent parameters (e.g. object diameter) can be scaled accordingly.
+    factor : int
+        integer downsampling factor, e.g. from resolution_factor
+    refine : bool, optional
+        re-assign pixels near boundaries at full resolution via refine_boundaries, by default True
+
+    Returns
+    -------
+    2D-array
+        label image matching the image shape, background is 0
+    """
+    if factor <= 1:
+        return segment_fn(image, 1)
+    small = downscale_local_mean(image.astype(np.float32), (factor, factor))
+    labels = upsample_labels(np.asarray(segment_fn(small, factor)), factor, image.shape)
+    if refine:
+        labels = refine_boundaries(labels, image, width=factor)
+    return labels
+
+
+def resolution_report(images, segment_fn, factor, image_names=None, refine=True):
+    """Compare reduced-resolution segmentation against full-resolution segmentation for a validation subset of images.
+
+    Parameters
+    ----------
+    images : list of 2D-array
+        validation images
+    segment_fn : callable
+        function mapping (image, factor) to a label image, as for segment_downsampled
+    factor : int
+        integer downsampling factor
+    image_names : list of str, optional
+        names used to label each image in the report, by default None uses positions
+    refine : bool, optional
+        passed to segment_downsampled, by default True
+
+    Returns
+    -------
+    DataFrame
+        per-image full and reduced runtimes, speedup, foreground IoU and mean per-object IoU against the full-resolution labels
+    """
+    if image_names is None:
+        image_names = list(range(len(images)))
+    report = []
+    for image_name, image in zip(image_names, images):
+        start = time.perf_counter()
+        full = segment_fn(image, 1)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reduced = segment_downsampled(image, segment_fn, factor, refine=refine)
+        reduced_time = time.perf_counter() - start
+
+        report.append(pd.DataFrame([{
+            'image_name': image_name,
+            'factor': factor,
+            'full_time': full_time,
+            'reduced_time': reduced_time,
+            'speedup': full_time / reduced_time,
+            'foreground_iou': foreground_iou(full, reduced),
+            'object_iou': object_iou(full, reduced)['iou'].mean(),
+        }]))
+    report = pd.concat(report).reset_index(drop=True)
+    logger.info(f'Reduced resolution (x{factor}): mean speedup {report["speedup"].mean():.2f}, mean object IoU {report["object_iou"].mean():.3f}')
+    return report
+
+
+def watershed_segment(image, diameter=30., sigma=None, threshold=None, min_distance=None, min_size=None):
+    """Classical segmentation of bright, well separated objects (e.g. stained nuclei) as a fast alternative to cellpose which requires no model weights: gaussian smoothing, Otsu threshold, distance transform and watershed seeded at distance maxima.
+
+    Parameters
+    ----------
+    image : 2D-array
+        image where objects are brighter than background (invert beforehand otherwise, e.g. 65000 - image)
+    diameter : float, optional
+        expected object diameter in pixels, used to set the defaults below, by default 30.
+    sigma : float, optional
+        gaussian smoothing applied before thresholding, by default diameter / 15
+    threshold : float, optional
+        foreground intensity threshold applied to the smoothed image, by default None uses Otsu's method
+    min_distance : int, optional
+        minimum separation of object centres, by default diameter / 4
+    min_size : int, optional
+        objects with fewer pixels are removed, by default the area of a circle of diameter / 2
+
+    Returns
+    -------
+    array
+        int32 label image numbered 1 --> n, background is 0
+    """
+    sigma = diameter / 15 if sigma is None else sigma
+    min_distance = max(1, int(diameter / 4)) if min_distance is None else min_distance
+    min_size = np.pi * (diameter / 4) ** 2 if min_size is None else min_size
+
+    smoothed = ndimage.gaussian_filter(np.asarray(image, dtype=np.float32), sigma=sigma)
+    threshold = threshold_otsu(smoothed) if threshold is None else threshold
+    foreground = ndimage.binary_fill_holes(smoothed > threshold)
+
+    # seeds are the maxima of distance to background within min_distance, merging maxima on the same plateau
+    distance = ndimage.distance_transform_edt(foreground)
+    maxima = foreground & (distance == ndimage.maximum_filter(distance, size=2 * min_distance + 1))
+    markers, num_markers = ndimage.label(maxima)
+    labels = watershed(-distance, markers, mask=foreground)
+
+    sizes = np.bincount(labels.ravel())
+    labels[np.isin(labels, np.flatnonzero(sizes < min_size))] = 0
+    return relabel_sequential(labels)[0].astype(np.int32)
+
+
+def apply_watershed(images, diameter=30., tiled=False, tile_size=2048, overlap=256, max_workers=1, **kwargs):
+    """Apply watershed_segment to list of images, tile-by-tile for large images if tiled (see segment_tiled). Returns masks.
+    - when tiled, a single threshold is estimated per image (from a subsample of at most ~4 megapixels) so that tiles containing only background are not thresholded separately
+    """
+    if not tiled:
+        return [watershed_segment(image, diameter=diameter, **kwargs) for image in images]
+
+    masks = []
+    for image in images:
+        tile_kwargs = dict(kwargs)
+        if tile_kwargs.get('threshold') is None:
+            step = max(1, int(np.sqrt(image.shape[0] * image.shape[1] / 4e6)))
+            sigma = tile_kwargs.get('sigma') or diameter / 15
+            tile_kwargs['threshold'] = threshold_otsu(ndimage.gaussian_filter(np.asarray(image[::step, ::step], dtype=np.float32), sigma=sigma / step))
+        masks.append(segment_tiled(image, lambda tile: watershed_segment(tile, diameter=diameter, **tile_kwargs), tile_size=tile_size, overlap=overlap, max_workers=max_workers))
+    return masks
+
+
+def backend_report(images, segmenters, reference='cellpose', image_names=None):
+    """Compare throughput and agreement of segmentation backends on a validation subset of images.
+
+    Parameters
+    ----------
+    images : list of 2D-array
+        validation images
+    segmenters : dict
+        mapping of backend name to a function mapping a single image to a label image
+    reference : str, optional
+        backend against which agreement is measured, by default 'cellpose'
+    image_names : list of str, optional
+        names used to label each image in the report, by default None uses positions
+
+    Returns
+    -------
+    DataFrame
+        per-image, per-backend runtime, throughput (megapixels per second), number of objects, foreground IoU and mean per-object IoU against the reference backend
+    """
+    if image_names is None:
+        image_names = list(range(len(images)))
+    report = []
+    for image_name, image in zip(image_names, images):
+        labels, times = {}, {}
+        for backend, segment_fn in segmenters.items():
+            start = time.perf_counter()
+            labels[backend] = segment_fn(image)
+            times[backend] = time.perf_counter() - start
+        for backend in segmenters:
+            report.append({
+                'image_name': image_name,
+                'backend': backend,
+                'time': times[backend],
+                'megapixels_per_second': image.shape[0] * image.shape[1] / 1e6 / times[backend],
+                'num_objects': len(np.unique(labels[backend])) - 1,
+                'foreground_iou': foreground_iou(labels[reference], labels[backend]),
+                'object_iou': object_iou(labels[reference], labels[backend])['iou'].mean(),
+            })
+    report = pd.DataFrame(report)
+    for backend, df in report.groupby('backend'):
+        logger.info(f'{backend}: mean {df["megapixels_per_second"].mean():.2f} megapixels/s, mean object IoU against {reference} {df["object_iou"].mean():.3f}')
+    return report
+
+
+def spot_scales(diameter, num_scales=5, scale_range=(0.5, 2.)):
+    """Gaussian scales (sigma) at which the Laplacian of Gaussian responds maximally to blobs from scale_range[0] to scale_range[1] times diameter"""
+    sigma = diameter / (2 * np.sqrt(2))
+    return np.geomspace(sigma * scale_range[0], sigma * scale_range[1], num_scales)
+
+
+def detect_spots(images, diameter=20., num_scales=5, scale_range=(0.5, 2.), threshold=None, grow_threshold=None, min_size=None):
+    """Multi-scale Laplacian of Gaussian spot detection with region growing, as a fast alternative to the cellpose nuclei model for bright blobs (e.g. inclusions and aggregates). All filtering and region growing is applied to the batch of images at once.
+
+    Parameters
+    ----------
+    images : list of 2D-array
+        same-shaped images where spots are brighter than background
+    diameter : float, optional
+        expected spot diameter in pixels, by default 20.
+    num_scales : int, optional
+        number of LoG scales searched, by default 5
+    scale_range : tuple, optional
+        smallest and largest spot diameter searched as a fraction of diameter, by default (0.5, 2.)
+    threshold : float, optional
+        minimum scale-normalised LoG response of a spot centre, by default None uses Otsu's method per image
+    grow_threshold : float, optional
+        intensity (after smoothing at the smallest scale) above which spots are grown, by default None uses Otsu's method per image
+    min_size : int, optional
+        spots with fewer pixels are removed, by default the area of a circle of diameter / 4
+
+    Returns
+    -------
+    list of array
+        int32 label image per image numbered 1 --> n, background is 0
+    """
+    batch = np.stack([np.asarray(image, dtype=np.float32) for image in images])
+    scales = spot_scales(diameter, num_scales=num_scales, scale_range=scale_range)
+    min_size = np.pi * (diameter / 8) ** 2 if min_size is None else min_size
+
+    # scale-normalised LoG, keeping the strongest response over scales for each pixel
+    response = np.full(batch.shape, -np.inf, dtype=np.float32)
+    for sigma in scales:
+        # second derivatives along rows and columns only, as ndimage.gaussian_laplace would also differentiate across the batch
+        laplace = ndimage.gaussian_filter(batch, sigma=(0, sigma, sigma), order=(0, 2, 0)) + ndimage.gaussian_filter(batch, sigma=(0, sigma, sigma), order=(0, 0, 2))
+        np.maximum(response, -sigma ** 2 * laplace, out=response)
+    smoothed = ndimage.gaussian_filter(batch, sigma=(0, scales[0], scales[0]))
+
+    # thresholds are estimated per image, filters and labelling never connect neighbouring images in the batch
+    def per_image(values, value):
+        return np.array([threshold_otsu(image) if value is None and np.ptp(image) > 0 else (image.min() if value is None else value) for image in values], dtype=np.float32)[:, None, None]
+
+    foreground = smoothed > per_image(smoothed, grow_threshold)
+    window = max(3, 2 * int(scales[0]) + 1)
+    peaks = foreground & (response == ndimage.maximum_filter(response, size=(1, window, window))) & (response > per_image(np.maximum(response, 0), threshold))
+
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)
+    markers, num_markers = ndimage.label(peaks, structure=structure)
+    labels = watershed(-smoothed, markers, mask=foreground, connectivity=structure)
+
+    masks = []
+    for image_labels in labels:
+        sizes = np.bincount(image_labels.ravel())
+        image_labels[np.isin(image_labels, np.flatnonzero(sizes < min_size))] = 0
+        masks.append(relabel_sequential(image_labels)[0].astype(np.int32))
+    return masks
+
+
+def spot_segment(image, diameter=20., **kwargs):
+    """Apply detect_spots to a single image, returning its label image"""
+    return detect_spots([image], diameter=diameter, **kwargs)[0]
+
+
+def apply_spots(images, diameter=20., batch_size=8, **kwargs):
+    """Apply detect_spots to list of images in batches of consecutive same-shaped images. Returns masks.
+    - batch_size limits the number of images (and LoG responses) held in memory at once
+    """
+    masks, batch = [], []
+    for image in images:
+        if batch and (len(batch) == batch_size or image.shape != batch[0].shape):
+            masks += detect_spots(batch, diameter=diameter, **kwargs)
+            batch = []
+        batch.append(image)
+    if batch:
+        masks += detect_spots(batch, diameter=diameter, **kwargs)
+    logger.info(f'Spots detected in {len(masks)} images')
+    return masks
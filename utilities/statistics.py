@@ -0,0 +1,193 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+from loguru import logger
+
+logger.info('Import OK')
+
+# maximum number of resampled values held in memory at once
+BATCH_ELEMENTS = 2 ** 24
+
+
+def _batches(num_resamples, num_values, batch_elements=BATCH_ELEMENTS):
+    """Sizes of consecutive batches of resamples, each holding at most batch_elements resampled values"""
+    batch_size = max(1, batch_elements // max(num_values, 1))
+    return [min(batch_size, num_resamples - start) for start in range(0, num_resamples, batch_size)]
+
+
+def _statistic(resampled, statistic):
+    """Apply statistic ('mean' or 'median') along the last axis of a batch of resamples"""
+    if statistic == 'mean':
+        return resampled.mean(axis=-1)
+    if statistic == 'median':
+        return np.median(resampled, axis=-1)
+    raise ValueError(f"statistic must be 'mean' or 'median', not {statistic}")
+
+
+def bootstrap_ci(values, statistic='mean', num_resamples=10000, confidence=0.95, seed=0):
+    """Percentile bootstrap confidence interval, where each batch of resamples is drawn as a single (batch, n) index matrix.
+
+    Parameters
+    ----------
+    values : array
+        observations, NaN values are ignored
+    statistic : str, optional
+        'mean' or 'median', by default 'mean'
+    num_resamples : int, optional
+        number of bootstrap resamples, by default 10000
+    confidence : float, optional
+        confidence level of the interval, by default 0.95
+    seed : int, optional
+        seed for the random number generator, by default 0
+
+    Returns
+    -------
+    tuple
+        (estimate, lower, upper)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan, np.nan, np.nan
+    rng = np.random.default_rng(seed)
+    resampled = np.concatenate([
+        _statistic(values[rng.integers(0, len(values), size=(batch, len(values)))], statistic)
+        for batch in _batches(num_resamples, len(values))])
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(resampled, [alpha, 1 - alpha])
+    return _statistic(values, statistic), lower, upper
+
+
+def permutation_test(first, second, statistic='mean', num_permutations=10000, seed=0):
+    """Two-sided permutation test for a difference in statistic between two groups, where each batch of permutations is drawn as a single (batch, n) index matrix.
+
+    Parameters
+    ----------
+    first, second : array
+        observations for each group, NaN values are ignored
+    statistic : str, optional
+        'mean' or 'median', by default 'mean'
+    num_permutations : int, optional
+        number of random permutations, by default 10000
+    seed : int, optional
+        seed for the random number generator, by default 0
+
+    Returns
+    -------
+    tuple
+        (difference as second - first, p-value), where the p-value includes the observed labelling so is never 0
+    """
+    first = np.asarray(first, dtype=np.float64)
+    second = np.asarray(second, dtype=np.float64)
+    first, second = first[~np.isnan(first)], second[~np.isnan(second)]
+    if len(first) == 0 or len(second) == 0:
+        return np.nan, np.nan
+    pooled = np.concatenate([first, second])
+    observed = _statistic(second, statistic) - _statistic(first, statistic)
+
+    rng = np.random.default_rng(seed)
+    extreme = 0
+    for batch in _batches(num_permutations, len(pooled)):
+        # argsort of uniform random keys gives an independent permutation per row
+        permuted = pooled[np.argsort(rng.random((batch, len(pooled))), axis=1)]
+        differences = _statistic(permuted[:, len(first):], statistic) - _statistic(permuted[:, :len(first)], statistic)
+        extreme += np.count_nonzero(np.abs(differences) >= np.abs(observed) - 1e-12)
+    return observed, (extreme + 1) / (num_permutations + 1)
+
+
+def adjust_pvalues(pvalues):
+    """Benjamini-Hochberg false discovery rate adjustment"""
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    adjusted = np.full(pvalues.shape, np.nan)
+    valid = ~np.isnan(pvalues)
+    if not valid.any():
+        return adjusted
+    order = np.argsort(pvalues[valid])
+    ranked = pvalues[valid][order] * valid.sum() / np.arange(1, valid.sum() + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    values = np.empty(valid.sum())
+    values[order] = np.minimum(ranked, 1)
+    adjusted[valid] = values
+    return adjusted
+
+
+def condition_statistics(df, value_col, group_cols, statistics=('mean', 'median'), num_resamples=10000, confidence=0.95, seed=0):
+    """Per-condition estimates with bootstrap confidence intervals.
+
+    Parameters
+    ----------
+    df : DataFrame
+        one row per observation (e.g. per cell or ROI)
+    value_col : str
+        column containing values, e.g. 'nuc-cyto_ratio'
+    group_cols : list of str
+        columns defining each condition, e.g. ['treatment', 'chaperone', 'aggregate_cell']
+    statistics : tuple of str, optional
+        statistics to estimate, by default ('mean', 'median')
+    num_resamples : int, optional
+        number of bootstrap resamples, by default 10000
+    confidence : float, optional
+        confidence level of the intervals, by default 0.95
+    seed : int, optional
+        seed for the random number generator, by default 0
+
+    Returns
+    -------
+    DataFrame
+        group columns, count, and {statistic}, {statistic}_lower and {statistic}_upper for each statistic
+    """
+    summary = []
+    for condition, values in df.groupby(group_cols)[value_col]:
+        condition = condition if isinstance(condition, tuple) else (condition, )
+        row = dict(zip(group_cols, condition))
+        row['count'] = int(values.notna().sum())
+        for statistic in statistics:
+            row[statistic], row[f'{statistic}_lower'], row[f'{statistic}_upper'] = bootstrap_ci(values.values, statistic=statistic, num_resamples=num_resamples, confidence=confidence, seed=seed)
+        summary.append(row)
+    logger.info(f'Bootstrap {confidence:.0%} intervals calculated for {len(summary)} conditions of {value_col}')
+    return pd.DataFrame(summary)
+
+
+def pairwise_permutation_tests(df, value_col, group_cols, within=None, statistic='mean', num_permutations=10000, seed=0):
+    """Permutation tests between every pair of conditions, optionally only between conditions sharing the same values of within (e.g. the same timepoint or compartment).
+
+    Parameters
+    ----------
+    df : DataFrame
+        one row per observation (e.g. per cell or ROI)
+    value_col : str
+        column containing values
+    group_cols : list of str
+        columns defining each condition
+    within : list of str, optional
+        columns which must match for two conditions to be compared, by default None compares all pairs
+    statistic : str, optional
+        'mean' or 'median', by default 'mean'
+    num_permutations : int, optional
+        number of random permutations, by default 10000
+    seed : int, optional
+        seed for the random number generator, by default 0
+
+    Returns
+    -------
+    DataFrame
+        within columns, {col}_1 and {col}_2 for each group column, count_1, count_2, difference (2 - 1), p_value and p_adjusted (Benjamini-Hochberg over all comparisons)
+    """
+    within = within or []
+    tests = []
+    for block, block_df in (df.groupby(within) if within else [((), df)]):
+        block = block if isinstance(block, tuple) else (block, )
+        conditions = [(condition if isinstance(condition, tuple) else (condition, ), values.values) for condition, values in block_df.groupby(group_cols)[value_col]]
+        for (first_condition, first), (second_condition, second) in itertools.combinations(conditions, 2):
+            difference, p_value = permutation_test(first, second, statistic=statistic, num_permutations=num_permutations, seed=seed)
+            row = dict(zip(within, block))
+            row.update({f'{col}_1': value for col, value in zip(group_cols, first_condition)})
+            row.update({f'{col}_2': value for col, value in zip(group_cols, second_condition)})
+            row.update({'count_1': int(np.count_nonzero(~np.isnan(first.astype(float)))), 'count_2': int(np.count_nonzero(~np.isnan(second.astype(float)))), 'difference': difference, 'p_value': p_value})
+            tests.append(row)
+    tests = pd.DataFrame(tests)
+    if len(tests) > 0:
+        tests['p_adjusted'] = adjust_pvalues(tests['p_value'])
+    logger.info(f'{len(tests)} permutation tests of {value_col} completed')
+    return tests
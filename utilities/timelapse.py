@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from utilities.compartments import derive_compartments, compartment_stack
+from utilities.label_metrics import label_contingency
+
+from loguru import logger
+
+logger.info('Import OK')
+
+
+def estimate_shift(reference, frame):
+    """Integer (row, column) translation of frame relative to reference, from the peak of their phase correlation"""
+    reference = np.asarray(reference, dtype=np.float64)
+    frame = np.asarray(frame, dtype=np.float64)
+    cross_power = np.fft.fft2(frame) * np.conj(np.fft.fft2(reference))
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(np.float64).eps)
+    correlation = np.abs(np.fft.ifft2(cross_power))
+    peak = np.array(np.unravel_index(np.argmax(correlation), correlation.shape))
+    # peaks beyond half the image correspond to negative shifts
+    shape = np.array(correlation.shape)
+    peak[peak > shape // 2] -= shape[peak > shape // 2]
+    return tuple(int(value) for value in peak)
+
+
+def shift_labels(labels, shift):
+    """Translate label images (the last two axes) by an integer (row, column) shift, filling uncovered pixels with background"""
+    shifted = np.zeros_like(labels)
+    rows, cols = labels.shape[-2:]
+    dy, dx = shift
+    source = (..., slice(max(0, -dy), rows - max(0, dy)), slice(max(0, -dx), cols - max(0, dx)))
+    target = (..., slice(max(0, dy), rows - max(0, -dy)), slice(max(0, dx), cols - max(0, -dx)))
+    shifted[target] = labels[source]
+    return shifted
+
+
+def match_labels(tracked, labels, min_overlap=0.5):
+    """Renumber objects in labels with the number of the tracked object they overlap most, so that re-segmented cells keep their cell number.
+
+    Parameters
+    ----------
+    tracked : 2D-array
+        label image of tracked objects (e.g. cells from the previous frame)
+    labels : 2D-array
+        newly segmented label image
+    min_overlap : float, optional
+        minimum fraction of a new object which must overlap a tracked object to inherit its number, by default 0.5. Unmatched new objects are removed, as are all but the largest overlapping object matched to the same tracked object.
+
+    Returns
+    -------
+    array
+        labels renumbered to tracked object numbers, in the dtype of tracked
+    """
+    table = label_contingency(labels, tracked)
+    sizes = table.groupby('reference')['overlap'].sum()
+    objects = table[(table['reference'] != 0) & (table['prediction'] != 0)].copy()
+    objects['fraction'] = objects['overlap'] / objects['reference'].map(sizes).values
+    objects = objects[objects['fraction'] >= min_overlap]
+    objects = objects.sort_values('overlap', ascending=False).drop_duplicates('reference').drop_duplicates('prediction')
+
+    lookup = np.zeros(int(np.max(labels)) + 1, dtype=tracked.dtype)
+    lookup[objects['reference'].values] = objects['prediction'].values
+    return lookup[labels]
+
+
+def frame_means(frame, mask_stack, mask_types):
+    """Mean intensity of each cell in each compartment of a single frame, via one bincount per compartment
+
+    Returns
+    -------
+    DataFrame
+        cell_number and one column of means per compartment (NaN where the cell has no pixels in that compartment)
+    """
+    num_labels = int(mask_stack.max()) + 1
+    frame = np.asarray(frame, dtype=np.float64).ravel()
+    means = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, mask_type in enumerate(mask_types):
+            labels = mask_stack[i].ravel().astype(np.int64)
+            means[mask_type] = np.bincount(labels, weights=frame, minlength=num_labels) / np.bincount(labels, minlength=num_labels)
+    means = pd.DataFrame(means)
+    means['cell_number'] = np.arange(num_labels)
+    present = np.isin(means['cell_number'], np.unique(mask_stack))
+    return means[present & (means['cell_number'] > 0)][['cell_number'] + list(mask_types)]
+
+
+def timelapse_ratios(stack, mask_stack, mask_types, quant_channel, register_channel=None, segment_fn=None, resegment_every=None, min_overlap=0.5):
+    """Streams per-cell nucleus/cytoplasm ratios for every frame of a time-lapse, reading one frame at a time and propagating compartment masks between frames.
+
+    Parameters
+    ----------
+    stack : array
+        (possibly memory-mapped) time-lapse of shape (timepoints, rows, columns, channels), so each frame is read from disk as one contiguous block
+    mask_stack : 3D-array
+        compartment label stack for the first frame, labelled by cell number, e.g. [cytoplasm, aggregate, nucleus] from 2_define_masks.py
+    mask_types : list of str
+        compartment name for each layer of mask_stack, which must include 'cytoplasm' and 'nucleus' (and 'aggregate' if present)
+    quant_channel : int
+        channel in which intensities are measured
+    register_channel : int, optional
+        channel used to estimate drift of each frame relative to the frame masks were last defined on, with masks translated accordingly. By default None does not move masks.
+    segment_fn : callable, optional
+        function mapping a (rows, columns, channels) frame to (cells, nuclei) label images, used to re-segment every resegment_every frames. New cells inherit the number of the tracked cell they overlap (see match_labels) and aggregates are carried over. By default None.
+    resegment_every : int, optional
+        number of frames between re-segmentation, by default None never re-segments
+    min_overlap : float, optional
+        passed to match_labels, by default 0.5
+
+    Yields
+    -------
+    DataFrame
+        compact per-frame table of cell_number, timepoint, one mean per compartment and nuc-cyto_ratio
+    """
+    mask_stack = np.asarray(mask_stack)
+    base_stack, base_reference = mask_stack, None
+    for timepoint in range(stack.shape[0]):
+        frame = np.asarray(stack[timepoint])
+        if register_channel is not None and base_reference is None:
+            base_reference = frame[:, :, register_channel]
+
+        if segment_fn is not None and resegment_every and timepoint > 0 and timepoint % resegment_every == 0:
+            tracked_cells = mask_stack.max(axis=0)
+            cells, nuclei = segment_fn(frame)
+            cells = match_labels(tracked_cells, np.asarray(cells), min_overlap=min_overlap)
+            aggregates = mask_stack[mask_types.index('aggregate')] if 'aggregate' in mask_types else np.zeros_like(cells)
+            compartments = derive_compartments(cells=cells, aggregates=aggregates, nuclei=nuclei, match='any')
+            base_stack = compartment_stack(compartments, mask_types).astype(mask_stack.dtype)
+            base_reference = frame[:, :, register_channel] if register_channel is not None else None
+            mask_stack = base_stack
+            logger.info(f'Re-segmented {len(np.unique(cells)) - 1} tracked cells at timepoint {timepoint}')
+        elif register_channel is not None:
+            mask_stack = shift_labels(base_stack, estimate_shift(base_reference, frame[:, :, register_channel]))
+
+        means = frame_means(frame[:, :, quant_channel], mask_stack, mask_types)
+        means['timepoint'] = timepoint
+        means['nuc-cyto_ratio'] = means['nucleus'] / means['cytoplasm']
+        means = means[['cell_number', 'timepoint'] + list(mask_types) + ['nuc-cyto_ratio']]
+        yield means.astype({'cell_number': np.uint32, 'timepoint': np.uint32, **{col: np.float32 for col in list(mask_types) + ['nuc-cyto_ratio']}})